@@ -1,22 +1,70 @@
+import itertools
+import math
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
 
 import dash
-import pandas as pd
+import flask
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 from dash.dependencies import Input, Output, State
 from ibapi.contract import Contract
 from ibapi.order import Order
 from fintech_ibkr import *
+from fintech_ibkr.durations import bar_epochs
 from dash import dcc
-from dash import html, dash_table
+from dash import html, dash_table, Patch
+from dash.exceptions import PreventUpdate
 import dash_daq as daq
 from datetime import date
+from background_jobs import thread_job_manager, job_cancelled
 
 # Make a Dash app!
 
-app = dash.Dash(__name__)
+
+# The layout below never changes, so serialize it on the first page load
+# rather than on every one.
+class static_layout_dash(dash.Dash):
+    layout_json = None
+
+    def serve_layout(self):
+        if self.layout_json is None:
+            self.layout_json = dash.Dash.serve_layout(self).get_data()
+        return flask.Response(self.layout_json, mimetype='application/json')
+
+
+# Callbacks that wait on IB run as background jobs on their own threads, so
+# the web server's threads stay free for the layout and assets.
+job_manager = thread_job_manager()
+app = static_layout_dash(__name__, background_callback_manager=job_manager)
 server = app.server
-df = pd.read_csv('submitted_orders.csv')
+orders_page_size = 20
+# IB calls go to the broker gateway at IBKR_GATEWAY (its socket path, or
+# host:port) if it's set, so that several web processes can share its
+# connections; otherwise this process makes them itself.
+broker = broker_functions(os.environ.get('IBKR_GATEWAY'))
+# Indicators that can be drawn with the candles, with default_windows.
+indicator_labels = OrderedDict([
+    ('sma', 'SMA(20)'), ('ema', 'EMA(20)'), ('bollinger', 'Bollinger(20, 2)'),
+    ('vwap', 'VWAP'), ('rsi', 'RSI(14)'), ('atr', 'ATR(14)'),
+    ('volatility', 'Volatility(20)')
+])
+
+
+# Prometheus scrape target: the IB stage timings (from the gateway, if
+# there is one) and this process's Dash callback durations.
+@server.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(
+        broker.ibkr_metrics_text() +
+        default_registry.render(('dash_', 'app_')),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 # Define the layout.
 app.layout = html.Div([
     html.Div(
@@ -170,6 +218,31 @@ app.layout = html.Div([
             style={'display': 'inline-block', 'padding-left': '10px'}
         ),
         html.Br(),
+        html.H3("Keep up to date?", style={'display': 'inline-block'}),
+        html.Div(
+            children=[
+                html.P("NO", style={'display': 'inline-block'}),
+                daq.ToggleSwitch(
+                    id='keep-up-to-date',
+                    value=False,
+                    style={'display': 'inline-block'}
+                ),
+                html.P("YES", style={'display': 'inline-block'}),
+            ],
+            style={'display': 'inline-block', 'padding-left': '10px'}
+        ),
+        html.P("Live charts need endDateTime left empty."),
+        html.Br(),
+        html.H3("Indicators:"),
+        dcc.Checklist(
+            options=[{'label': label, 'value': name}
+                     for name, label in indicator_labels.items()],
+            value=[],
+            id='indicators',
+            inline=True,
+            inputStyle={'margin-left': '15px', 'margin-right': '5px'}
+        ),
+        html.Br(),
         html.H3("Enter a currency pair:"),
         html.P(
             children=[
@@ -192,12 +265,27 @@ app.layout = html.Div([
         ),
         # Submit button
         html.Button('Submit', id='submit-button', n_clicks=0),
+        html.Button('Cancel', id='cancel-button', n_clicks=0, disabled=True),
+        html.Div(id='fetch-progress'),
         html.Br(),
         html.Br(),
         # Div for initial instructions and the updated info once submit is pressed
         html.Div(
             id='currency-output',
             children='Enter a currency code and press submit'),
+        html.Br(),
+        # Watchlist: several pairs fetched at once, each in its own small
+        # candlestick panel below the main chart.
+        html.H3("Or chart a watchlist:"),
+        html.Div(
+            ["Currency pairs: ", dcc.Input(
+                id='watchlist-input', value='EUR.USD, GBP.USD, USD.JPY',
+                type='text', style={'width': '250px'}
+            )],
+            style={'display': 'inline-block', 'padding-top': '5px'}
+        ),
+        html.Button('Chart watchlist', id='watchlist-button', n_clicks=0),
+        html.Div(id='watchlist-progress'),
     ],
         style={'width': '550px', 'display': 'inline-block'}
     ),
@@ -261,6 +349,20 @@ app.layout = html.Div([
         type="circle", color='#7BC043',
         children=html.Div([dcc.Graph(id='candlestick-graph')])
     ),
+    # While a live chart is shown, poll for changed bars and patch them in,
+    # and show the pair's live quote.
+    dcc.Interval(id='live-interval', interval=1000, disabled=True),
+    dcc.Store(id='live-state'),
+    dcc.Store(id='quote-state'),
+    html.Div(id='live-quote'),
+    dcc.Loading(
+        type="circle", color='#7BC043',
+        children=html.Div(id='watchlist-panels')
+    ),
+    # Width of the graph in pixels, and which bars it shows, so that the
+    # figure can be bucketed down to what the screen can show.
+    dcc.Store(id='graph-width'),
+    dcc.Store(id='chart-source'),
     # Another line break
     html.Br(),
     # Section title
@@ -406,11 +508,22 @@ app.layout = html.Div([
     html.Br(),
     # Submit button for the trade
     html.Button('Trade', id='trade-button', n_clicks=0),
+    html.Div(id='trade-progress'),
     html.Br(),
     html.Br(),
+    # Submitted orders, paged, sorted and filtered in the order journal:
+    # only the page on screen is sent to the browser.
     dash_table.DataTable(
-        data=df.to_dict('records'),
-        columns=[{'id': c, 'name': c} for c in df.columns],
+        id='orders-table',
+        columns=[{'id': c, 'name': c} for c in order_journal_columns],
+        page_current=0,
+        page_size=orders_page_size,
+        page_action='custom',
+        sort_action='custom',
+        sort_mode='multi',
+        sort_by=[],
+        filter_action='custom',
+        filter_query='',
         fixed_columns={'headers': True, 'data': 1},
         style_table={'minWidth': '100%'},
         style_cell={
@@ -423,17 +536,159 @@ app.layout = html.Div([
     html.Br()
 ])
 
+def candlestick_trace(cph):
+    return go.Candlestick(
+        x=cph['date'],
+        open=cph['open'],
+        high=cph['high'],
+        low=cph['low'],
+        close=cph['close']
+    )
+
+
+def overlay_columns(names):
+    # [(column, panel)] for the indicator traces that follow the candles:
+    # panel 0 is over the candles, the others each get a panel below.
+    names = [name for name in all_indicators if name in names]
+    panels = [name for name in names if name not in price_indicators]
+    return [(column, 0 if name in price_indicators
+             else panels.index(name) + 1)
+            for name in names for column in indicator_columns[name]]
+
+
+def indicator_traces(values, names):
+    return [go.Scatter(x=values['date'], y=values[column], mode='lines',
+                       name=column, line={'width': 1})
+            for column, panel in overlay_columns(names)]
+
+
+def candlestick_figure(cph, title, values=None, names=()):
+    # The candles, plus `values` (compute_indicators columns for the same
+    # candles, and 'date') for each of the indicators in `names`.
+    columns = overlay_columns(names) if values is not None else []
+    panels = max([panel for column, panel in columns] + [0])
+    if panels:
+        fig = make_subplots(rows=panels + 1, cols=1, shared_xaxes=True,
+                            vertical_spacing=0.03,
+                            row_heights=[3] + [1] * panels)
+        fig.update_xaxes(rangeslider_visible=False)
+        fig.update_layout(height=450 + 150 * panels)
+    else:
+        fig = go.Figure()
+    fig.add_trace(candlestick_trace(cph), **({'row': 1, 'col': 1}
+                                             if panels else {}))
+    if columns:
+        for (column, panel), trace in zip(columns,
+                                          indicator_traces(values, names)):
+            fig.add_trace(trace, **({'row': panel + 1, 'col': 1}
+                                    if panels else {}))
+    # # Give the candlestick figure a title
+    fig.update_layout(title=title)
+    return fig
+
+
+def plot_value(value):
+    # NaN (not enough bars yet) as a gap in the line.
+    return None if math.isnan(value) else value
+
+
+def chart_candles(bars, names, bucket_sec, origin=None):
+    # Candles for full-resolution bars that already have their indicator
+    # columns, and the indicator values for the same candles.
+    columns = [column for column, panel in overlay_columns(names)]
+    return downsample_ohlc(bars, bucket_sec, origin), \
+        downsample_last(bars, columns, bucket_sec, origin)
+
+
+def end_date_time(edt_date, edt_hour, edt_minute, edt_second):
+    # '' (now) unless the whole endDateTime has been picked.
+    if any([i is None for i in [edt_date, edt_hour, edt_minute, edt_second]]):
+        return ''
+    return str(edt_date).replace("-", "") + " " + \
+        '{:0>2}'.format(edt_hour) + ":" + \
+        '{:0>2}'.format(edt_minute) + ":" + \
+        '{:0>2}'.format(edt_second)
+
+
+def max_candles(graph_width):
+    # About one candle per two pixels.
+    if not graph_width:
+        return default_max_buckets
+    return max(100, int(graph_width) // 2)
+
+
+# The full-resolution bars behind the last few charts, so that zooming in
+# can re-bucket the visible range without going back to IB.
+chart_frames = OrderedDict()
+chart_frames_lock = threading.Lock()
+chart_frame_ids = itertools.count(1)
+max_chart_frames = 16
+
+
+# And the incremental indicator state behind the last few live charts.
+live_indicators = OrderedDict()
+
+
+def remember(store, value):
+    with chart_frames_lock:
+        value_id = next(chart_frame_ids)
+        store[value_id] = value
+        while len(store) > max_chart_frames:
+            store.popitem(last=False)
+    return value_id
+
+
+def remember_chart_frame(frame):
+    return remember(chart_frames, frame)
+
+
+def live_candle_key(live_state, index, bar_date):
+    # Which candle a bar belongs to: its own, or its time bucket.
+    if live_state['bucket_sec'] is None:
+        return index
+    return int(bucket_index(bar_epochs([bar_date]), live_state['origin'],
+                            live_state['bucket_sec'])[0])
+
+
+def live_candles(stream_id, seq, bars, max_buckets, names=()):
+    # The candles to draw for a live stream's bars, their indicator values,
+    # and the state that update_live_candles needs to patch the last one.
+    bucket_sec = bucket_seconds(bars, max_buckets)
+    origin = int(bar_epochs(bars['date'][:1])[0]) if bucket_sec else None
+    live_state = {'stream_id': stream_id, 'seq': seq,
+                  'bucket_sec': bucket_sec, 'origin': origin,
+                  'last': None, 'indicators': list(names),
+                  'indicators_id': None}
+    if names:
+        # New bars move the indicators on in O(1) from here.
+        live_state['indicators_id'] = remember(
+            live_indicators, incremental_indicators.from_frame(bars, names)
+        )
+        bars = bars.join(compute_indicators(bars, names))
+    cph, values = chart_candles(bars, names, bucket_sec, origin)
+    live_state['length'] = len(cph)
+    if len(cph):
+        live_state['last'] = [
+            live_candle_key(live_state, len(bars) - 1, bars['date'].iloc[-1])
+        ] + cph[['open', 'high', 'low', 'close']].iloc[-1].tolist()
+    return cph, values, live_state
+
+
 @app.callback(
     [
         Output("connect-indicator", "children"),
         Output("sync-connection-status", "children")
     ],
     Input("connect-button", "n_clicks"),
-    [State("host", "value"), State("port", "value"), State("clientid", "value")]
+    [State("host", "value"), State("port", "value"), State("clientid", "value")],
+    background=True,
+    interval=250,
+    running=[(Output('connect-button', 'disabled'), True, False)]
 )
+@timed(callback_seconds, callback='update_connect_indicator')
 def update_connect_indicator(n_clicks, host, port, clientid):
     try:
-        managed_accounts = fetch_managed_accounts(host, port, clientid)
+        managed_accounts = broker.fetch_managed_accounts(host, port, clientid)
         message = "Connection successful! Managed accounts: " + ", ".join(managed_accounts)
         sync_connection_status = "True"
     except Exception as inst:
@@ -446,7 +701,11 @@ def update_connect_indicator(n_clicks, host, port, clientid):
     [ # there's more than one output here, so you have to use square brackets to
         # pass it in as an array.
         Output(component_id='currency-output', component_property='children'),
-        Output(component_id='candlestick-graph', component_property='figure')
+        Output(component_id='candlestick-graph', component_property='figure'),
+        Output('live-state', 'data'),
+        Output('live-interval', 'disabled'),
+        Output('chart-source', 'data'),
+        Output('quote-state', 'data')
     ],
     Input('submit-button', 'n_clicks'),
     # The callback function will run when the submit button's n_clicks
@@ -463,15 +722,34 @@ def update_connect_indicator(n_clicks, host, port, clientid):
      State('use-rth', 'value'), State('duration-amount', 'value'),
      State('duration-unit', 'value'), State('host', 'value'),
      State('port', 'value'),
-     State('clientid', 'value')],
-    prevent_initial_call = True
+     State('clientid', 'value'), State('keep-up-to-date', 'value'),
+     State('graph-width', 'data'), State('indicators', 'value'),
+     State('quote-state', 'data')],
+    prevent_initial_call = True,
+    background=True,
+    interval=250,
+    progress=Output('fetch-progress', 'children'),
+    progress_default='',
+    running=[(Output('submit-button', 'disabled'), True, False),
+             (Output('cancel-button', 'disabled'), False, True)],
+    cancel=Input('cancel-button', 'n_clicks')
 )
-def update_candlestick_graph(n_clicks, currency_string, what_to_show,
+@timed(callback_seconds, callback='update_candlestick_graph')
+def update_candlestick_graph(set_progress, n_clicks, currency_string, what_to_show,
                              edt_date, edt_hour, edt_minute, edt_second,
                              conn_status, bar_size, use_rth, duration_amount,
-                             duration_unit, host, port, clientid):
+                             duration_unit, host, port, clientid,
+                             keep_up_to_date, graph_width, indicators,
+                             old_quote_id):
+    if old_quote_id is not None:
+        # The new chart replaces the old one's quote, so let its
+        # subscription go; if this fails it lapses once nobody polls it.
+        try:
+            broker.quote_unsubscribe(old_quote_id)
+        except Exception:
+            pass
     if not bool(conn_status):
-        return '', go.Figure()
+        return '', go.Figure(), None, True, None, None
 
     # First things first -- what currency pair history do you want to fetch?
     # Define it as a contract object!
@@ -481,25 +759,24 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show,
     contract.exchange = 'IDEALPRO' # 'IDEALPRO' is the currency exchange.
     contract.currency = currency_string.split(".")[1]
 
+    set_progress("Fetching contract details...")
     try:
-        contract_details = fetch_contract_details(contract, hostname=host, port=port, client_id=clientid)
+        # Contract details hardly ever change: served from a local cache after
+        # the first request.
+        contract_details = broker.fetch_contract_details_cached(contract, hostname=host, port=port, client_id=clientid)
     except:
-        return ("No contract found for " + currency_string), go.Figure()
+        return ("No contract found for " + currency_string), go.Figure(), \
+            None, True, None, None
 
     contract_symbol_ibkr = contract_details.symbol[0]+'.'+contract_details.currency[0]
 
     # If the contract name doesn't equal the one you want:
     if not contract_symbol_ibkr == currency_string:
         return ("Requested contract: " + currency_string + " but received " +
-                "contract: " + contract_symbol_ibkr), go.Figure()
+                "contract: " + contract_symbol_ibkr), go.Figure(), None, True, \
+            None, None
 
-    if any([i is None for i in [edt_date, edt_hour, edt_minute, edt_second]]):
-        endDateTime = ''
-    else:
-        endDateTime = str(edt_date).replace("-","") + " " + \
-                      '{:0>2}'.format(edt_hour) + ":" + \
-                      '{:0>2}'.format(edt_hour) + ":" + \
-                      '{:0>2}'.format(edt_minute)
+    endDateTime = end_date_time(edt_date, edt_hour, edt_minute, edt_second)
 
     # time.sleep(5)
 
@@ -515,41 +792,385 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show,
     # Some default values are provided below to help with your testing.
     # Don't forget -- you'll need to update the signature in this callback
     #   function to include your new vars!
-    cph = fetch_historical_data(
-        contract=contract,
-        endDateTime=endDateTime,
+    live_state = None
+    chart_source = None
+    quote_id = None
+    indicators = indicators or []
+    max_buckets = max_candles(graph_width)
+    def fetch_progress(done, total):
+        # Called between chunks of a long download; stops it if the user
+        # pressed cancel.
+        if job_cancelled():
+            raise PreventUpdate
+        set_progress("Fetched %d of %d requests" % (done, total))
+
+    set_progress("Fetching bars...")
+    if keep_up_to_date and endDateTime == '':
+        # One keepUpToDate subscription; update_live_candles below patches
+        # the bars that change into the figure.
+        stream_id, seq, bars = broker.live_bars_snapshot(
+            contract,
+            durationStr=str(duration_amount) + " " + duration_unit,
+            barSizeSetting=bar_size,
+            whatToShow=what_to_show,
+            useRTH=use_rth,
+            hostname=host,
+            port=port,
+            client_id=clientid
+        )
+        cph, values, live_state = live_candles(stream_id, seq, bars,
+                                               max_buckets, indicators)
+        # One market data line per pair, however many sessions show it; a
+        # session's subscription lapses once it stops polling.
+        quote_id = broker.quote_subscribe(contract, hostname=host, port=port,
+                                          client_id=clientid)
+    else:
+        # Served from the local bar cache where possible -- built from finer
+        # cached bars if the window is covered at a finer bar size; only the
+        # parts of the window that aren't on disk yet are requested from IB,
+        # split into chunks IB accepts for the bar size and sent through the
+        # pacing-aware scheduler, ahead of any background downloads.
+        cph = broker.fetch_chart_bars(
+            contract=contract,
+            endDateTime=endDateTime,
+            durationStr=str(duration_amount) + " " + duration_unit,
+            barSizeSetting=bar_size,
+            whatToShow=what_to_show,
+            useRTH=use_rth,
+            hostname=host,
+            port=port,
+            client_id=clientid,
+            trading_hours=contract_details.liquid_hours[0] if use_rth
+            else contract_details.trading_hours[0],
+            progress=fetch_progress
+        )
+        if indicators:
+            # On every bar, before downsampling: one vectorized pass.
+            cph = cph.join(compute_indicators(cph, indicators))
+        chart_source = {'frame_id': remember_chart_frame(cph),
+                        'indicators': indicators}
+        # Never send more candles than the graph has room for.
+        cph, values = chart_candles(cph, indicators,
+                                    bucket_seconds(cph, max_buckets))
+    # # Make the candlestick figure
+    fig = candlestick_figure(
+        cph, 'Exchange Rate: ' + currency_string + ': ' + what_to_show,
+        values, indicators
+    )
+    ############################################################################
+    ############################################################################
+
+    currency_string = "fetched data for: " + contract_symbol_ibkr
+
+    # Return your updated text to currency-output, and the figure to
+    #   candlestick-graph outputs
+    return currency_string, fig, live_state, live_state is None, \
+        chart_source, quote_id
+
+
+@app.callback(
+    [
+        Output('candlestick-graph', 'figure', allow_duplicate=True),
+        Output('live-state', 'data', allow_duplicate=True),
+        Output('live-interval', 'disabled', allow_duplicate=True)
+    ],
+    Input('live-interval', 'n_intervals'),
+    [State('live-state', 'data'), State('graph-width', 'data')],
+    prevent_initial_call=True
+)
+@timed(callback_seconds, callback='update_live_candles')
+def update_live_candles(n_intervals, live_state, graph_width):
+    # Sends the browser only the candles that changed since the last poll:
+    # the last candle is updated in place, new ones are appended.
+    update = live_state and broker.live_bars_since(live_state['stream_id'],
+                                                   live_state['seq'])
+    if not update:
+        return dash.no_update, None, True
+    kind, seq, rows = update
+    names = live_state.get('indicators') or []
+    if kind == 'snapshot':
+        # Too far behind to patch; redraw from a fresh snapshot.
+        cph, values, live_state = live_candles(
+            live_state['stream_id'], seq, rows, max_candles(graph_width), names
+        )
+        patch = Patch()
+        patch['data'] = list(candlestick_figure(cph, '', values, names).data)
+        return patch, live_state, False
+    if not rows:
+        return dash.no_update, dash.no_update, False
+    patch = Patch()
+    length = live_state['length']
+    last = live_state['last']
+    with chart_frames_lock:
+        state = live_indicators.get(live_state.get('indicators_id'))
+    columns = [column for column, panel in overlay_columns(names)]
+    for index in sorted(rows, key=int):
+        bar_date, bar_open, high, low, close, volume, bar_count, average = \
+            rows[index]
+        key = live_candle_key(live_state, int(index), bar_date)
+        latest = None
+        if state is not None:
+            # O(1) per bar: the forming bar is revised, a new one pushed.
+            with chart_frames_lock:
+                if int(index) == state.state['n'] - 1:
+                    latest = state.revise(high, low, close, volume, average)
+                elif int(index) == state.state['n']:
+                    latest = state.push(high, low, close, volume, average)
+        if last is not None and key == last[0]:
+            # Same candle: a forming bar only ever widens its range.
+            last = [key, last[1], max(last[2], high), min(last[3], low), close]
+            for field, value in zip(['high', 'low', 'close'], last[2:]):
+                patch['data'][0][field][length - 1] = value
+            if latest is not None:
+                for trace, column in enumerate(columns, 1):
+                    patch['data'][trace]['y'][length - 1] = \
+                        plot_value(latest[column])
+        else:
+            last = [key, bar_open, high, low, close]
+            for field, value in zip(['x', 'open', 'high', 'low', 'close'],
+                                    [bar_date] + last[1:]):
+                patch['data'][0][field].append(value)
+            for trace, column in enumerate(columns, 1):
+                patch['data'][trace]['x'].append(bar_date)
+                patch['data'][trace]['y'].append(
+                    None if latest is None else plot_value(latest[column])
+                )
+            length += 1
+    return patch, dict(live_state, seq=seq, length=length, last=last), False
+
+
+def quote_text(quote):
+    parts = []
+    for side in ['BID', 'ASK', 'LAST']:
+        if side in quote:
+            text = "%s %s" % (side, quote[side])
+            if quote.get(side + '_SIZE') is not None:
+                text += " x " + str(quote[side + '_SIZE'])
+            parts.append(text)
+    return "   ".join(parts)
+
+
+@app.callback(
+    Output('live-quote', 'children'),
+    Input('live-interval', 'n_intervals'),
+    State('quote-state', 'data'),
+    prevent_initial_call=True
+)
+@timed(callback_seconds, callback='update_live_quote')
+def update_live_quote(n_intervals, quote_id):
+    if quote_id is None:
+        return ''
+    try:
+        quote = broker.quote_poll(quote_id)
+    except Exception as inst:
+        x, y, z = inst.args
+        return "Error in " + x + ": " + y + ". " + z
+    return quote_text(quote) if quote else ''
+
+
+watchlist_columns = 3
+
+
+def fx_contract(currency_string):
+    symbol, currency = currency_string.split(".")
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = currency
+    return contract
+
+
+def watchlist_figure(pairs, results, graph_width):
+    # One small candlestick panel per pair, watchlist_columns to a row; a
+    # pair that failed shows why in its panel's title.
+    columns = min(watchlist_columns, len(pairs))
+    rows = -(-len(pairs) // columns)
+    titles = []
+    for pair, (bars, error) in zip(pairs, results):
+        if error is not None:
+            titles.append(pair + ": " + str(error.args[-1]))
+        elif bars is None or bars.empty:
+            titles.append(pair + ": no data")
+        else:
+            titles.append(pair)
+    fig = make_subplots(rows=rows, cols=columns, subplot_titles=titles)
+    max_buckets = max_candles((graph_width or 0) // columns)
+    for i, (bars, error) in enumerate(results):
+        if bars is None or bars.empty:
+            continue
+        cph = downsample_ohlc(bars, bucket_seconds(bars, max_buckets))
+        fig.add_trace(candlestick_trace(cph), row=i // columns + 1,
+                      col=i % columns + 1)
+    fig.update_xaxes(rangeslider_visible=False)
+    fig.update_layout(showlegend=False, height=300 * rows)
+    return fig
+
+
+@app.callback(
+    Output('watchlist-panels', 'children'),
+    Input('watchlist-button', 'n_clicks'),
+    [State('watchlist-input', 'value'), State('what-to-show', 'value'),
+     State('edt-date', 'date'), State('edt-hour', 'value'),
+     State('edt-minute', 'value'), State('edt-second', 'value'),
+     State('sync-connection-status', 'children'), State('bar-size', 'value'),
+     State('use-rth', 'value'), State('duration-amount', 'value'),
+     State('duration-unit', 'value'), State('host', 'value'),
+     State('port', 'value'), State('clientid', 'value'),
+     State('graph-width', 'data')],
+    prevent_initial_call=True,
+    background=True,
+    interval=250,
+    progress=Output('watchlist-progress', 'children'),
+    progress_default='',
+    running=[(Output('watchlist-button', 'disabled'), True, False)]
+)
+@timed(callback_seconds, callback='update_watchlist')
+def update_watchlist(set_progress, n_clicks, watchlist, what_to_show,
+                     edt_date, edt_hour, edt_minute, edt_second, conn_status,
+                     bar_size, use_rth, duration_amount, duration_unit, host,
+                     port, clientid, graph_width):
+    if not bool(conn_status):
+        return ''
+    pairs = [pair.strip().upper() for pair in (watchlist or '').split(',')
+             if pair.strip()]
+    if not pairs:
+        return 'Enter currency pairs separated by commas, e.g. EUR.USD, GBP.USD'
+    # Every pair at once: the whole watchlist takes about as long as its
+    # slowest pair rather than the sum of them.
+    results = [None] * len(pairs)
+    contracts = []
+    for i, pair in enumerate(pairs):
+        if pair.count('.') != 1:
+            results[i] = (None, Exception("update_watchlist", "bad_pair",
+                                          "expected e.g. EUR.USD"))
+        else:
+            contracts.append((i, fx_contract(pair)))
+    set_progress("Fetching %d pairs..." % len(contracts))
+    fetched = broker.fetch_watchlist(
+        [contract for i, contract in contracts],
+        endDateTime=end_date_time(edt_date, edt_hour, edt_minute, edt_second),
         durationStr=str(duration_amount) + " " + duration_unit,
         barSizeSetting=bar_size,
         whatToShow=what_to_show,
         useRTH=use_rth,
         hostname=host,
         port=port,
-        client_id=clientid
-    )
-    # # Make the candlestick figure
-    fig = go.Figure(
-        data=[
-            go.Candlestick(
-                x=cph['date'],
-                open=cph['open'],
-                high=cph['high'],
-                low=cph['low'],
-                close=cph['close']
-            )
-        ]
+        client_id=clientid,
+        progress=lambda done, total: set_progress(
+            "Fetched %d of %d pairs" % (done, total)
+        )
     )
-    # # Give the candlestick figure a title
-    fig.update_layout(
-        title=('Exchange Rate: ' + currency_string + ': ' + what_to_show)
+    for (i, contract), result in zip(contracts, fetched):
+        results[i] = result
+    return dcc.Graph(figure=watchlist_figure(pairs, results, graph_width))
+
+
+@app.callback(
+    Output('candlestick-graph', 'figure', allow_duplicate=True),
+    Input('candlestick-graph', 'relayoutData'),
+    [State('chart-source', 'data'), State('graph-width', 'data')],
+    prevent_initial_call=True
+)
+@timed(callback_seconds, callback='rebucket_visible_range')
+def rebucket_visible_range(relayout_data, chart_source, graph_width):
+    # After a zoom or pan, re-bucket just the visible bars, so zooming in
+    # shows more detail without sending everything.
+    if not relayout_data or not chart_source:
+        return dash.no_update
+    if 'xaxis.autorange' in relayout_data:
+        start = end = None
+    elif 'xaxis.range[0]' in relayout_data:
+        start = relayout_data['xaxis.range[0]']
+        end = relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        start, end = relayout_data['xaxis.range']
+    else:
+        return dash.no_update
+    with chart_frames_lock:
+        frame = chart_frames.get(chart_source['frame_id'])
+    if frame is None:
+        return dash.no_update
+    bars = visible_bars(frame, start, end)
+    names = chart_source.get('indicators') or []
+    cph, values = chart_candles(
+        bars, names, bucket_seconds(bars, max_candles(graph_width))
     )
-    ############################################################################
-    ############################################################################
+    patch = Patch()
+    patch['data'] = list(candlestick_figure(cph, '', values, names).data)
+    return patch
 
-    currency_string = "fetched data for: " + contract_symbol_ibkr
 
-    # Return your updated text to currency-output, and the figure to
-    #   candlestick-graph outputs
-    return currency_string, fig
+# Read the graph's width in the browser.
+app.clientside_callback(
+    """
+    function(n_clicks) {
+        var graph = document.getElementById('candlestick-graph');
+        return (graph && graph.offsetWidth) || window.innerWidth;
+    }
+    """,
+    Output('graph-width', 'data'),
+    Input('submit-button', 'n_clicks')
+)
+
+# Dash filter_query operators and the journal operators they map to. With
+# the DataTable's default filter_options, relational operators come with a
+# case prefix: 's' (sensitive, '{symbol} scontains AAPL') or 'i'
+# (insensitive, '{size} i> 5').
+filter_operators = {
+    'ge': 'ge', '>=': 'ge', 'le': 'le', '<=': 'le', 'lt': 'lt', '<': 'lt',
+    'gt': 'gt', '>': 'gt', 'ne': 'ne', '!=': 'ne', 'eq': 'eq', '=': 'eq',
+    'contains': 'contains', 'datestartswith': 'startswith'
+}
+
+# '{column} <case><operator> value', longest operators first.
+filter_part = re.compile(r'\s*\{?([^{}\s]+)\}?\s+([si]?)(%s)\s+(.*?)\s*$' % (
+    '|'.join(re.escape(operator) for operator in
+             sorted(filter_operators, key=len, reverse=True))
+), re.IGNORECASE)
+
+
+def parse_filter_query(filter_query):
+    # '{symbol} scontains AAPL && {size} i> 5' ->
+    # [('symbol', 'contains', 'AAPL'), ('size', 'igt', '5')]
+    filters = []
+    for part in filter(None, (filter_query or '').split(' && ')):
+        match = filter_part.match(part)
+        if match is None:
+            continue
+        name, case, dash_operator, value = match.groups()
+        case, dash_operator = case.lower(), dash_operator.lower()
+        if value[:1] == value[-1:] and value[:1] in ('"', "'", '`'):
+            value = value[1:-1]
+        operator = filter_operators[dash_operator]
+        filters.append((name, 'i' + operator if case == 'i' else operator,
+                        value))
+    return filters
+
+
+@app.callback(
+    [Output('orders-table', 'data'), Output('orders-table', 'page_count')],
+    [Input('orders-table', 'page_current'),
+     Input('orders-table', 'page_size'),
+     Input('orders-table', 'sort_by'),
+     Input('orders-table', 'filter_query'),
+     # Refresh once a trade has gone through.
+     Input('trade-output', 'children')]
+)
+@timed(callback_seconds, callback='update_orders_table')
+def update_orders_table(page_current, page_size, sort_by, filter_query,
+                        trade_output):
+    try:
+        orders, total = default_order_journal().page(
+            offset=page_current * page_size,
+            limit=page_size,
+            sort_by=[(s['column_id'], s['direction']) for s in sort_by],
+            filters=parse_filter_query(filter_query)
+        )
+    except ValueError:
+        # Half-typed filters ('{size} > abc') match nothing.
+        return [], 1
+    return orders.to_dict('records'), max(1, -(-total // page_size))
 
 # Callback for what to do when trade-button is pressed
 @app.callback(
@@ -565,9 +1186,16 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show,
      State('trade-amt', 'value'), State("host", "value"),
      State("port", "value"), State("clientid", "value")],
     # DON'T start executing trades just because n_clicks was initialized to 0!!!
-    prevent_initial_call=True
+    prevent_initial_call=True,
+    background=True,
+    interval=250,
+    progress=Output('trade-progress', 'children'),
+    progress_default='',
+    # One order per click: no second click while this one is in flight.
+    running=[(Output('trade-button', 'disabled'), True, False)]
 )
-def trade(n_clicks, sec_type, contract_symbol, currency, exchange, primary_exchange,
+@timed(callback_seconds, callback='trade')
+def trade(set_progress, n_clicks, sec_type, contract_symbol, currency, exchange, primary_exchange,
           mkt_or_lmt, action, limit_price, trade_amt, host, port, clientid):
     # Still don't use n_clicks, but we need the dependency
 
@@ -591,17 +1219,22 @@ def trade(n_clicks, sec_type, contract_symbol, currency, exchange, primary_excha
             return "Invalid Limit price"
         order.lmtPrice = limit_price
 
-    fetch_contract_details(contract)
+    set_progress("Looking up contract...")
+    contract_details = broker.fetch_contract_details_cached(contract, hostname=host, port=port, client_id=clientid)
+    if contract_details is not None:
+        contract.conId = int(contract_details.con_id[0])
 
-    allInfo = place_order(contract, order)
-    # order_id = allInfo['order_id'][0]
-    time = fetch_current_time(host, port, clientid)    # fetch_current_time()
-    # client_id = allInfo['client_id'][0]
-    perm_id = allInfo['perm_id'][0]
+    set_progress("Placing order...")
+    allInfo = broker.place_order(contract, order, hostname=host, port=port,
+                          client_id=clientid)
+    order_id = int(allInfo['order_id'])
+    time = broker.fetch_current_time(host, port, clientid)    # fetch_current_time()
+    # client_id = allInfo['client_id']
+    perm_id = allInfo['perm_id']
 
     trade_data = {
         'timestamp': time,
-        'order_id': order.orderId,
+        'order_id': order_id,
         'client_id': clientid,
         'perm_id': perm_id,
         'con_id': contract.conId,
@@ -612,12 +1245,8 @@ def trade(n_clicks, sec_type, contract_symbol, currency, exchange, primary_excha
         'lmt_price': limit_price
     }
 
-    file_path = 'submitted_orders.csv'
-    df_file = pd.read_csv(file_path, index_col=0)
-    index = ['timestamp', 'order_id', 'client_id', 'perm_id',
-             'con_id', 'symbol', 'action', 'size', 'order_type', 'lmt_price']
-    df_file = pd.concat([df_file, pd.DataFrame(trade_data, index=[0])], ignore_index=True).set_index(index)
-    df_file.to_csv(file_path)
+    # One INSERT into the order journal, however many orders came before.
+    default_order_journal().append(trade_data)
 
     print("Successful!")
     msg = "Successful order! " + msg
@@ -625,6 +1254,16 @@ def trade(n_clicks, sec_type, contract_symbol, currency, exchange, primary_excha
     # Return the message, which goes to the trade-output div's children
     return msg
 
+def warm_up():
+    # Does the work Dash and the order journal otherwise leave for the first
+    # visitor: setting up the callbacks, serializing the layout, rendering
+    # the index page and opening (or importing) the journal. server.py calls
+    # this before letting requests through.
+    client = server.test_client()
+    for path in ['/', '/_dash-layout', '/_dash-dependencies']:
+        client.get(path)
+    default_order_journal()
+
 # Run it!
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,160 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dash.background_callback.managers import BaseBackgroundCallbackManager
+from dash.background_callback.managers.diskcache_manager import _make_job_fn
+
+# Runs Dash background callbacks on a small pool of worker threads in this
+# process, so that an IB round-trip doesn't hold a waitress thread for
+# seconds: the browser gets a job handle straight away and polls for
+# progress and the result, and each poll is answered at once.
+#
+# Jobs run in-process rather than in a subprocess (DiskcacheManager) because
+# they share the warm IB connections, the caches, the historical scheduler
+# and the live bar streams. A forked job would inherit the pool's sockets
+# without their API threads, and a new connection per job would need its
+# own client id.
+#
+# Threads can't be killed, so cancelling is cooperative: the job is
+# forgotten, anything it stores afterwards is dropped, and job_cancelled()
+# turns True inside it so that long-running work can stop early.
+
+default_max_workers = 8
+# Results nobody comes back for (a closed tab) are dropped after this long.
+default_expire_sec = 600
+
+_current = threading.local()
+
+
+def job_cancelled():
+    # True inside a background job that has been cancelled.
+    job = getattr(_current, 'job', None)
+    return job is not None and job.cancelled.is_set()
+
+
+class background_job:
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        self.cancelled = threading.Event()
+        self.done = False
+        self.finished_at = None
+
+
+class _result_store:
+    # What _make_job_fn writes results, progress and set_props into.
+    def __init__(self, expire_sec):
+        self.expire_sec = expire_sec
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, key, value):
+        if job_cancelled():
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.values[key] = (now, value)
+            self.values = {k: v for k, v in self.values.items()
+                           if now - v[0] < self.expire_sec}
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.values.get(key)
+        return default if entry is None else entry[1]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.values.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def delete(self, key):
+        self.pop(key)
+
+
+class thread_job_manager(BaseBackgroundCallbackManager):
+    def __init__(self, max_workers=default_max_workers,
+                 expire_sec=default_expire_sec):
+        self.store = _result_store(expire_sec)
+        self.expire_sec = expire_sec
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='dash_job'
+        )
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.secret = None
+        super().__init__(None)
+
+    def make_job_fn(self, fn, progress, key=None):
+        return _make_job_fn(fn, self.store, progress)
+
+    def call_job_fn(self, key, job_fn, args, context):
+        job = background_job(next(self.ids), key)
+        now = time.monotonic()
+        with self.lock:
+            self.jobs = {
+                job_id: old for job_id, old in self.jobs.items()
+                if not old.done or now - old.finished_at < self.expire_sec
+            }
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, job_fn, args, context)
+        return job.id
+
+    def _run(self, job, job_fn, args, context):
+        _current.job = job
+        try:
+            if not job.cancelled.is_set():
+                job_fn(job.key, self._make_progress_key(job.key), args,
+                       context)
+        finally:
+            _current.job = None
+            job.finished_at = time.monotonic()
+            job.done = True
+
+    def _job(self, job_id):
+        with self.lock:
+            return self.jobs.get(int(job_id))
+
+    def job_running(self, job):
+        job = self._job(job) if job is not None else None
+        return job is not None and not job.done and \
+            not job.cancelled.is_set()
+
+    def terminate_job(self, job):
+        if job is None:
+            return
+        with self.lock:
+            job = self.jobs.pop(int(job), None)
+        if job is not None:
+            job.cancelled.set()
+
+    def terminate_unhealthy_job(self, job):
+        return False
+
+    def get_progress(self, key):
+        return self.store.pop(self._make_progress_key(key))
+
+    def result_ready(self, key):
+        return self.store.get(key) is not None
+
+    def get_result(self, key, job):
+        result = self.store.pop(key, self.UNDEFINED)
+        if result is self.UNDEFINED:
+            return self.UNDEFINED
+        self.store.delete(self._make_progress_key(key))
+        self.terminate_job(job)
+        return result
+
+    def get_updated_props(self, key):
+        return self.store.pop(self._make_set_props_key(key), {})
+
+    def clear_cache_entry(self, key):
+        self.store.delete(key)
+
+    def get_or_create_signing_secret(self, generate):
+        with self.lock:
+            if self.secret is None:
+                self.secret = generate()
+            return self.secret
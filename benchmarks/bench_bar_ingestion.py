@@ -0,0 +1,101 @@
+# Bar ingestion throughput for ibkr_app.historicalData, in bars/sec, and the
+# peak memory it takes to hold the bars.
+#
+# "before" replays the old implementation, which pd.concat'ed a one-row
+# DataFrame onto the accumulated frame for every bar (quadratic in the number
+# of bars). "after" feeds the same bars through the current ibkr_app, which
+# appends to the request's bar_buffer and builds the DataFrame once in
+# historicalDataEnd.
+#
+# Run from the repo root:
+#     python -m benchmarks.bench_bar_ingestion
+
+import time
+import pandas as pd
+from ibapi.common import BarData
+from fintech_ibkr.ibkr_app import ibkr_app
+from benchmarks.common import peak_memory_mb, print_rows
+
+# Bars are built once and reused, so a million-bar run measures the buffer
+# rather than a million BarData objects.
+distinct_bars = 10000
+
+
+def make_bars(n):
+    bars = []
+    for i in range(min(n, distinct_bars)):
+        bar = BarData()
+        bar.date = '20220329  %02d:%02d:%02d' % (
+            (i // 3600) % 24, (i // 60) % 60, i % 60)
+        bar.open = 1.1 + i * 1e-6
+        bar.high = bar.open + 0.001
+        bar.low = bar.open - 0.001
+        bar.close = bar.open + 0.0005
+        bar.volume = 100 + i % 7
+        bar.barCount = 10 + i % 3
+        bar.average = bar.open + 0.0002
+        bars.append(bar)
+    return (bars * (n // len(bars) + 1))[:n]
+
+
+def ingest_before(bars):
+    historical_data = pd.DataFrame(
+        columns=['date', 'open', 'high', 'low', 'close', 'volume',
+                 'bar_count', 'average']
+    )
+    for bar in bars:
+        historical_data = pd.concat(
+            [
+                historical_data,
+                pd.DataFrame({
+                    'date': [bar.date],
+                    'open': [bar.open],
+                    'high': [bar.high],
+                    'low': [bar.low],
+                    'close': [bar.close],
+                })
+            ],
+            ignore_index=True
+        )
+    return historical_data
+
+
+def ingest_after(bars):
+    app = ibkr_app()
+    request = app.router.register(1, 'historical')
+    for bar in bars:
+        app.historicalData(1, bar)
+    app.historicalDataEnd(1, '', '')
+    return request.result
+
+
+def bars_per_sec(ingest, bars, repeat=1):
+    # Best of `repeat` runs.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ingest(bars)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(bars) / best
+
+
+def run(sizes=(1000, 100000, 1000000), before_max=10000, repeat=3):
+    results = []
+    for n in sizes:
+        bars = make_bars(n)
+        before = bars_per_sec(ingest_before, bars) if n <= before_max \
+            else None
+        after = bars_per_sec(ingest_after, bars, repeat)
+        peak = peak_memory_mb(lambda: ingest_after(bars))
+        results.append({'bars': n, 'before_bars_per_sec': before,
+                        'after_bars_per_sec': after, 'peak_mb': peak})
+    return results
+
+
+def run_quick():
+    return run(sizes=(1000, 100000))
+
+
+if __name__ == '__main__':
+    print_rows(run())
@@ -0,0 +1,81 @@
+# Time to turn a bar frame into the candlestick figure that
+# update_candlestick_graph sends to the browser: downsampling to the
+# graph's width, building the go.Figure and serializing it to JSON, with
+# the size of that JSON and the peak memory of the whole thing.
+#
+# Run from the repo root:
+#     python -m benchmarks.bench_figure_build
+
+import time
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+from fintech_ibkr.bar_buffer import historical_data_columns
+from fintech_ibkr.downsampling import downsample_ohlc, bucket_seconds
+from benchmarks.common import peak_memory_mb, print_rows
+from app import candlestick_figure, max_candles
+
+graph_width = 1200
+
+
+def make_frame(n, bar_seconds=60):
+    # A random walk of n one-minute bars, as fetch_historical_data returns.
+    rng = np.random.default_rng(0)
+    close = 1.1 + np.cumsum(rng.normal(0, 1e-4, n))
+    open_ = np.append(1.1, close[:-1])
+    spread = np.abs(rng.normal(0, 5e-5, n))
+    start = pd.Timestamp('2022-01-03').value // 10 ** 9
+    dates = pd.to_datetime(start + np.arange(n) * bar_seconds, unit='s')
+    return pd.DataFrame({
+        'date': np.asarray(dates.strftime('%Y%m%d  %H:%M:%S')),
+        'open': open_,
+        'high': np.maximum(open_, close) + spread,
+        'low': np.minimum(open_, close) - spread,
+        'close': close,
+        'volume': np.full(n, -1.0),
+        'bar_count': np.full(n, -1),
+        'average': (open_ + close) / 2
+    }, columns=historical_data_columns)
+
+
+def build(frame):
+    start = time.perf_counter()
+    candles = downsample_ohlc(
+        frame, bucket_seconds(frame, max_candles(graph_width))
+    )
+    downsampled = time.perf_counter()
+    fig = candlestick_figure(candles, 'Exchange Rate: EUR.USD: MIDPOINT')
+    built = time.perf_counter()
+    text = pio.to_json(fig, validate=False)
+    serialized = time.perf_counter()
+    return {
+        'candles': len(candles),
+        'downsample_ms': (downsampled - start) * 1000,
+        'figure_ms': (built - downsampled) * 1000,
+        'json_ms': (serialized - built) * 1000,
+        'total_ms': (serialized - start) * 1000,
+        'json_kb': len(text) / 1024.0
+    }
+
+
+def run(sizes=(1000, 100000, 1000000), repeat=3):
+    # Plotly loads its validators on first use.
+    build(make_frame(100))
+    results = []
+    for n in sizes:
+        frame = make_frame(n)
+        runs = [build(frame) for _ in range(repeat)]
+        row = {'bars': n}
+        # Best of `repeat`, which is the least disturbed by everything else.
+        row.update(min(runs, key=lambda r: r['total_ms']))
+        row['peak_mb'] = peak_memory_mb(lambda: build(frame))
+        results.append(row)
+    return results
+
+
+def run_quick():
+    return run(sizes=(1000, 100000), repeat=1)
+
+
+if __name__ == '__main__':
+    print_rows(run())
@@ -0,0 +1,59 @@
+# Time to compute every indicator over a bar frame in one vectorized pass,
+# and what each new live bar costs after that with incremental_indicators:
+# a push for a new bar and a revise for the forming one. The per-bar cost
+# should stay flat however many bars came before.
+#
+# Run from the repo root:
+#     python -m benchmarks.bench_indicators
+
+import time
+from fintech_ibkr.indicators import compute_indicators
+from fintech_ibkr.indicators import incremental_indicators
+from benchmarks.common import peak_memory_mb, print_rows
+from benchmarks.bench_figure_build import make_frame
+
+updates = 10000
+
+
+def measure(frame):
+    start = time.perf_counter()
+    compute_indicators(frame)
+    computed = time.perf_counter()
+    state = incremental_indicators.from_frame(frame)
+    seeded = time.perf_counter()
+    last = frame.iloc[-1]
+    high, low, close = float(last['high']), float(last['low']), \
+        float(last['close'])
+    for i in range(updates):
+        state.push(high, low, close)
+    pushed = time.perf_counter()
+    for i in range(updates):
+        state.revise(high, low, close)
+    revised = time.perf_counter()
+    return {
+        'compute_ms': (computed - start) * 1000,
+        'seed_ms': (seeded - computed) * 1000,
+        'push_us': (pushed - seeded) * 1e6 / updates,
+        'revise_us': (revised - pushed) * 1e6 / updates
+    }
+
+
+def run(sizes=(1000, 100000, 1000000), repeat=3):
+    results = []
+    for n in sizes:
+        frame = make_frame(n)
+        runs = [measure(frame) for _ in range(repeat)]
+        row = {'bars': n}
+        # Best of `repeat`, which is the least disturbed by everything else.
+        row.update(min(runs, key=lambda r: r['compute_ms']))
+        row['peak_mb'] = peak_memory_mb(lambda: compute_indicators(frame))
+        results.append(row)
+    return results
+
+
+def run_quick():
+    return run(sizes=(1000, 100000), repeat=1)
+
+
+if __name__ == '__main__':
+    print_rows(run())
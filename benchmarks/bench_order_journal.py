@@ -0,0 +1,57 @@
+# Latency of the one order-journal append that trade() makes per order,
+# with an empty journal and with a long history already in it: an append
+# should cost the same either way.
+#
+# Run from the repo root:
+#     python -m benchmarks.bench_order_journal
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from fintech_ibkr.order_journal import order_journal
+from benchmarks.common import time_calls, latency_stats, print_rows
+
+
+def make_order(i, start=datetime(2022, 1, 3)):
+    return {
+        'timestamp': start + timedelta(seconds=i),
+        'order_id': i,
+        'client_id': 10645,
+        'perm_id': 1000000 + i,
+        'con_id': 12087792,
+        'symbol': 'EUR',
+        'action': 'BUY' if i % 2 else 'SELL',
+        'size': 100000,
+        'order_type': 'MKT',
+        'lmt_price': None
+    }
+
+
+def run(history_sizes=(0, 10000, 100000), appends=200):
+    directory = tempfile.mkdtemp(prefix='bench_order_journal')
+    results = []
+    try:
+        for size in history_sizes:
+            journal = order_journal(
+                os.path.join(directory, 'journal_%d.sqlite' % size)
+            )
+            journal.append_many([make_order(i) for i in range(size)])
+            counter = iter(range(size, size + appends))
+            row = {'history_rows': size}
+            row.update(latency_stats(time_calls(
+                lambda: journal.append(make_order(next(counter))), appends
+            )))
+            results.append(row)
+            journal.connection().close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def run_quick():
+    return run(history_sizes=(0, 10000), appends=50)
+
+
+if __name__ == '__main__':
+    print_rows(run())
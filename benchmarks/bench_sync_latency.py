@@ -0,0 +1,80 @@
+# End-to-end latency of every synchronous_functions call against the local
+# fake TWS: the client's own overhead (pool checkout, request routing,
+# decoding, building the frame) plus the loopback round trip.
+#
+# Run from the repo root:
+#     python -m benchmarks.bench_sync_latency
+
+from ibapi.contract import Contract
+from ibapi.order import Order
+from fintech_ibkr.fake_tws import start_fake_tws, fake_tws_config
+from fintech_ibkr.connection_pool import default_pool
+from fintech_ibkr.synchronous_functions import fetch_managed_accounts
+from fintech_ibkr.synchronous_functions import fetch_current_time
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+from fintech_ibkr.synchronous_functions import fetch_contract_details
+from fintech_ibkr.synchronous_functions import fetch_matching_symbols
+from fintech_ibkr.synchronous_functions import place_order
+from fintech_ibkr.synchronous_functions import default_client_id
+from benchmarks.common import time_calls, latency_stats, print_rows
+
+
+def eur_usd():
+    contract = Contract()
+    contract.symbol = 'EUR'
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = 'USD'
+    return contract
+
+
+def market_order():
+    order = Order()
+    order.action = 'BUY'
+    order.orderType = 'MKT'
+    order.totalQuantity = 100
+    return order
+
+
+def run(calls=200, latency_ms=0):
+    server = start_fake_tws(port=0, config=fake_tws_config(
+        latency_ms=latency_ms, fill_orders=False
+    ))
+    connection = dict(hostname='127.0.0.1', port=server.port,
+                      client_id=default_client_id)
+    contract = eur_usd()
+    functions = [
+        ('fetch_managed_accounts',
+         lambda: fetch_managed_accounts(**connection)),
+        ('fetch_current_time', lambda: fetch_current_time(**connection)),
+        ('fetch_historical_data 1 D x 1 min',
+         lambda: fetch_historical_data(contract, durationStr='1 D',
+                                       barSizeSetting='1 min',
+                                       **connection)),
+        ('fetch_contract_details',
+         lambda: fetch_contract_details(contract, **connection)),
+        ('fetch_matching_symbols',
+         lambda: fetch_matching_symbols('EUR', **connection)),
+        ('place_order',
+         lambda: place_order(contract, market_order(), **connection)),
+    ]
+    try:
+        # The first call connects; that's not what we're measuring.
+        fetch_managed_accounts(**connection)
+        results = []
+        for name, call in functions:
+            row = {'function': name}
+            row.update(latency_stats(time_calls(call, calls)))
+            results.append(row)
+    finally:
+        default_pool.close('127.0.0.1', server.port, default_client_id)
+        server.shutdown()
+    return results
+
+
+def run_quick():
+    return run(calls=50)
+
+
+if __name__ == '__main__':
+    print_rows(run())
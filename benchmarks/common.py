@@ -0,0 +1,50 @@
+# Helpers shared by the benchmarks: timing, latency percentiles and peak
+# memory.
+
+import time
+import tracemalloc
+import numpy as np
+
+
+def time_calls(call, n):
+    # Seconds taken by each of n calls.
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def latency_stats(samples):
+    ms = np.array(samples, dtype=float) * 1000
+    return {
+        'calls': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'max_ms': float(ms.max())
+    }
+
+
+def peak_memory_mb(call):
+    # Peak Python (and numpy) memory allocated while call() runs, in MB.
+    # Run it separately from the timing: tracing slows allocations down.
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1] / 2.0 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def print_rows(rows):
+    if not rows:
+        return
+    columns = list(rows[0])
+    print('  '.join('%14s' % column for column in columns))
+    for row in rows:
+        print('  '.join(
+            '%14.3f' % row[c] if isinstance(row[c], float)
+            else '%14s' % row[c] for c in columns
+        ))
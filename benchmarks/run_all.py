@@ -0,0 +1,138 @@
+# Runs every benchmark and writes the results to one JSON file, named after
+# the commit by default, so that two commits can be compared:
+#
+#     python -m benchmarks.run_all                  # full run
+#     python -m benchmarks.run_all --quick          # smaller sizes
+#     python -m benchmarks.run_all --only sync_latency --only order_journal
+#     python -m benchmarks.run_all --compare benchmarks/results/abc1234.json
+#
+# --compare prints every metric next to the old value and exits with status
+# 1 if any got worse by more than --threshold (a fraction: 0.2 = 20%).
+# Metrics ending in _per_sec are better higher, everything else lower.
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+benchmarks = ['sync_latency', 'bar_ingestion', 'figure_build',
+              'order_journal', 'indicators']
+# Columns that say how much was measured rather than how fast.
+count_columns = {'calls', 'candles'}
+results_dir = os.path.join('benchmarks', 'results')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True,
+            stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # resource doesn't exist on Windows.
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux.
+    return rss / 2.0 ** 20 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run(names=benchmarks, quick=False):
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick
+        },
+        'benchmarks': {}
+    }
+    for name in names:
+        module = importlib.import_module('benchmarks.bench_' + name)
+        print("running %s..." % name, file=sys.stderr)
+        start = time.perf_counter()
+        rows = module.run_quick() if quick else module.run()
+        results['benchmarks'][name] = {
+            'rows': rows, 'seconds': time.perf_counter() - start
+        }
+    results['meta']['max_rss_mb'] = max_rss_mb()
+    return results
+
+
+def metrics(results):
+    # {'bench / key=value / metric': number} for every numeric cell; the
+    # first column of each row says which row it is.
+    flat = {}
+    for name, benchmark in results['benchmarks'].items():
+        for row in benchmark['rows']:
+            key_column = next(iter(row))
+            label = '%s / %s=%s' % (name, key_column, row[key_column])
+            for column, value in row.items():
+                if column == key_column or column in count_columns:
+                    continue
+                if isinstance(value, (int, float)) and \
+                        not isinstance(value, bool):
+                    flat['%s / %s' % (label, column)] = value
+    return flat
+
+
+def compare(old, new, threshold=0.2):
+    # Prints old vs new for every metric in both; returns the regressions.
+    old_metrics, new_metrics = metrics(old), metrics(new)
+    regressions = []
+    for key in sorted(set(old_metrics) & set(new_metrics)):
+        before, after = old_metrics[key], new_metrics[key]
+        if not before:
+            continue
+        change = (after - before) / float(before)
+        worse = -change if key.endswith('_per_sec') else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('%-70s %14.3f %14.3f %+8.1f%%%s' % (
+            key, before, after, change * 100, flag
+        ))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="fintech_ibkr benchmarks")
+    parser.add_argument('--only', action='append', choices=benchmarks,
+                        help="run just this benchmark (repeatable)")
+    parser.add_argument('--quick', action='store_true',
+                        help="smaller sizes and fewer calls")
+    parser.add_argument('--output', default=None,
+                        help="results file (default: benchmarks/results/"
+                             "<commit>.json)")
+    parser.add_argument('--compare', default=None, metavar='OLD_JSON',
+                        help="compare with an earlier results file")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args.only or benchmarks, args.quick)
+    output = args.output or os.path.join(
+        results_dir, '%s.json' % (results['meta']['commit'] or 'results')
+    )
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("results written to %s" % output, file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        sys.exit(1 if regressions else 0)
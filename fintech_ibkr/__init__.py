@@ -4,4 +4,72 @@ from fintech_ibkr.synchronous_functions import fetch_contract_details
 from fintech_ibkr.synchronous_functions import fetch_current_time
 from fintech_ibkr.synchronous_functions import fetch_matching_symbols
 from fintech_ibkr.synchronous_functions import place_order
+from fintech_ibkr.synchronous_functions import wait_for_order
 from fintech_ibkr.ibkr_app import ibkr_app
+from fintech_ibkr.connection_pool import ibkr_connection_pool
+from fintech_ibkr.connection_pool import default_pool
+from fintech_ibkr.async_functions import fetch_managed_accounts_async
+from fintech_ibkr.async_functions import fetch_current_time_async
+from fintech_ibkr.async_functions import fetch_historical_data_async
+from fintech_ibkr.async_functions import fetch_contract_details_async
+from fintech_ibkr.async_functions import fetch_matching_symbols_async
+from fintech_ibkr.async_functions import place_order_async
+from fintech_ibkr.async_functions import ibkr_async_client
+from fintech_ibkr.bar_cache import fetch_historical_data_cached
+from fintech_ibkr.bar_cache import bar_cache
+from fintech_ibkr.contract_cache import fetch_contract_details_cached
+from fintech_ibkr.contract_cache import contract_details_cache
+from fintech_ibkr.historical_scheduler import fetch_historical_data_scheduled
+from fintech_ibkr.historical_scheduler import historical_scheduler
+from fintech_ibkr.historical_scheduler import default_scheduler
+from fintech_ibkr.historical_scheduler import interactive_priority
+from fintech_ibkr.history_downloader import fetch_long_historical_data
+from fintech_ibkr.live_bars import live_bar_stream_for
+from fintech_ibkr.live_bars import get_live_bar_stream
+from fintech_ibkr.live_bars import live_bar_stream
+from fintech_ibkr.downsampling import downsample_ohlc
+from fintech_ibkr.downsampling import bucket_seconds
+from fintech_ibkr.downsampling import bucket_index
+from fintech_ibkr.downsampling import visible_bars
+from fintech_ibkr.downsampling import default_max_buckets
+from fintech_ibkr.resampling import fetch_historical_data_resampled
+from fintech_ibkr.resampling import resample_bars
+from fintech_ibkr.order_journal import order_journal
+from fintech_ibkr.order_journal import default_order_journal
+from fintech_ibkr.order_journal import order_journal_columns
+from fintech_ibkr.order_tracker import order_tracker
+from fintech_ibkr.live_bars import live_bars_snapshot
+from fintech_ibkr.live_bars import live_bars_since
+from fintech_ibkr.gateway import ibkr_gateway
+from fintech_ibkr.gateway import gateway_client
+from fintech_ibkr.gateway import start_gateway
+from fintech_ibkr.gateway import broker_functions
+from fintech_ibkr.gateway import fetch_chart_bars
+from fintech_ibkr.gateway import fetch_watchlist
+from fintech_ibkr.error_channel import error_channel
+from fintech_ibkr.error_channel import ibkr_error
+from fintech_ibkr.error_channel import pacing_violation_error
+from fintech_ibkr.error_channel import no_data_error
+from fintech_ibkr.error_channel import contract_not_found_error
+from fintech_ibkr.error_channel import order_rejected_error
+from fintech_ibkr.error_channel import market_data_error
+from fintech_ibkr.fake_tws import start_fake_tws
+from fintech_ibkr.fake_tws import fake_tws_config
+from fintech_ibkr.metrics import metrics_registry
+from fintech_ibkr.metrics import default_registry
+from fintech_ibkr.metrics import callback_seconds
+from fintech_ibkr.metrics import ibkr_metrics_text
+from fintech_ibkr.metrics import timed
+from fintech_ibkr.market_data import market_data_manager
+from fintech_ibkr.market_data import default_market_data
+from fintech_ibkr.market_data import conflated_queue
+from fintech_ibkr.market_data import quote_subscribe
+from fintech_ibkr.market_data import quote_poll
+from fintech_ibkr.market_data import quote_unsubscribe
+from fintech_ibkr.downsampling import downsample_last
+from fintech_ibkr.indicators import compute_indicators
+from fintech_ibkr.indicators import incremental_indicators
+from fintech_ibkr.indicators import indicator_columns
+from fintech_ibkr.indicators import all_indicators
+from fintech_ibkr.indicators import price_indicators
+from fintech_ibkr.indicators import default_windows
@@ -0,0 +1,368 @@
+from fintech_ibkr.ibkr_app import ibkr_app
+from ibapi import comm
+from ibapi.ticktype import TickTypeEnum
+from fintech_ibkr.metrics import observe_request, observe_order
+from fintech_ibkr.metrics import connect_seconds, handshake_seconds
+import asyncio
+import threading
+import time
+import weakref
+
+# asyncio counterparts of the functions in synchronous_functions.py.
+#
+# Everything runs over one long-lived connection per (hostname, port,
+# client_id) and event loop. ibapi's EReader thread still reads the socket,
+# but instead of queueing messages for an EClient.run() thread it hands each
+# one straight to the event loop, so every EWrapper callback runs on the
+# loop and resolves an asyncio future. Any number of requests can be in
+# flight at once without a thread or socket per call.
+#
+# Timeouts and cancellations are passed on to IB: a historical data request
+# that times out or whose task is cancelled is followed by
+# cancelHistoricalData, and leaving stream_market_data cancels the
+# subscription with cancelMktData. An IB error for a request raises the
+# matching error_channel exception at once.
+#
+#     contract = ...
+#     bars = await fetch_historical_data_async(contract, durationStr='1 D')
+#
+#     frames = await asyncio.gather(*[
+#         fetch_historical_data_async(c) for c in contracts
+#     ])
+
+default_hostname = '127.0.0.1'
+default_port = 7497
+# TWS allows one connection per client ID. The synchronous functions use
+# 10645, so the async connection defaults to the next one up.
+default_client_id = 10646
+timeout_sec = 5
+
+
+class _loop_queue:
+    # Stands in for EClient.msg_queue. EReader calls put() from its thread
+    # for every message it reads; we forward the message to the event loop.
+    def __init__(self, app):
+        self.app = app
+
+    def put(self, msg):
+        if not self.app.loop.is_closed():
+            self.app.loop.call_soon_threadsafe(self.app.handle_message, msg)
+
+
+class ibkr_async_app(ibkr_app):
+    # An ibkr_app whose callbacks run on an asyncio event loop. Answers are
+    # routed by reqId / orderId through the app's request_router exactly as
+    # for the synchronous functions; the client below turns each
+    # pending_request into an asyncio future.
+    def __init__(self, loop):
+        ibkr_app.__init__(self)
+        self.loop = loop
+        self.msg_queue = _loop_queue(self)
+        self.tick_queues = {}
+        self.next_valid_id_future = loop.create_future()
+
+    def handle_message(self, msg):
+        self.router.message_size = len(msg)
+        self.decoder.interpret(comm.read_fields(msg))
+
+    def nextValidId(self, orderId: int):
+        ibkr_app.nextValidId(self, orderId)
+        if not self.next_valid_id_future.done():
+            self.next_valid_id_future.set_result(orderId)
+
+    def fail_stream(self, reqId, exception):
+        ibkr_app.fail_stream(self, reqId, exception)
+        queue = self.tick_queues.get(reqId)
+        if queue is not None:
+            queue.put_nowait(exception)
+
+    def fail_pending(self, exception):
+        # Streams aren't in the router; end every open one too.
+        ibkr_app.fail_pending(self, exception)
+        for queue in list(self.tick_queues.values()):
+            queue.put_nowait(exception)
+
+    def tickPrice(self, reqId, tickType, price:float, attrib):
+        queue = self.tick_queues.get(reqId)
+        if queue is not None:
+            queue.put_nowait((TickTypeEnum.to_str(tickType), price))
+
+    def tickSize(self, reqId, tickType, size):
+        queue = self.tick_queues.get(reqId)
+        if queue is not None:
+            queue.put_nowait((TickTypeEnum.to_str(tickType), size))
+
+
+class ibkr_async_client:
+    def __init__(self, hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+        self.hostname = hostname
+        self.port = int(port)
+        self.client_id = int(client_id)
+        self.app = None
+        self.connect_lock = asyncio.Lock()
+
+    def is_connected(self):
+        return self.app is not None and self.app.isConnected()
+
+    async def connect(self, caller="connect"):
+        async with self.connect_lock:
+            if self.is_connected():
+                return self.app
+            loop = asyncio.get_running_loop()
+            app = ibkr_async_app(loop)
+            # EClient.connect blocks for the TCP connect and the handshake,
+            # so keep it off the event loop.
+            start = time.perf_counter()
+            await loop.run_in_executor(
+                None, app.connect, self.hostname, self.port, self.client_id
+            )
+            connected = time.perf_counter()
+            connect_seconds.observe(connected - start,
+                                    client_id=self.client_id)
+            if not app.isConnected():
+                raise Exception(caller, "timeout", "couldn't connect to IBKR")
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(app.next_valid_id_future), timeout_sec
+                )
+            except asyncio.TimeoutError:
+                app.disconnect()
+                raise Exception(caller, "timeout",
+                                "next_valid_id not received")
+            handshake_seconds.observe(time.perf_counter() - connected,
+                                      client_id=self.client_id)
+
+            # Fail whatever is still pending once the reader thread stops.
+            reader = app.reader
+
+            def watch_reader():
+                reader.join()
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(app.connectionClosed)
+            threading.Thread(target=watch_reader, daemon=True).start()
+
+            self.app = app
+            return app
+
+    def disconnect(self):
+        if self.app is not None:
+            self.app.disconnect()
+            self.app = None
+
+    async def _wait(self, app, request, timeout):
+        future = app.loop.create_future()
+
+        def settle(request):
+            if future.done():
+                return
+            if request.exception is not None:
+                future.set_exception(request.exception)
+            else:
+                future.set_result(request.result)
+        # Requests can be finished from other threads (e.g. fail_pending),
+        # so always settle the future on the loop.
+        request.add_done_callback(
+            lambda request: app.loop.call_soon_threadsafe(settle, request)
+        )
+        return await asyncio.wait_for(future, timeout)
+
+    async def _request(self, app, req_id, kind, send, cancel, caller,
+                       message, timeout, contract=None):
+        request = app.router.register(req_id, kind)
+        outcome = 'error'
+        try:
+            request.sent_at = time.perf_counter()
+            send()
+            result = await self._wait(app, request, timeout)
+            outcome = 'ok'
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            if cancel is not None:
+                cancel()
+            raise Exception(caller, "timeout", message)
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            if cancel is not None:
+                cancel()
+            raise
+        finally:
+            app.router.discard(req_id)
+            observe_request(request, caller, contract, outcome)
+
+    async def fetch_managed_accounts(self):
+        app = await self.connect("fetch_managed_accounts")
+        return app.managed_accounts
+
+    async def fetch_current_time(self, timeout=timeout_sec):
+        app = await self.connect("fetch_current_time")
+        waiter = app.current_time_request()
+        app.reqCurrentTime()
+        try:
+            return await self._wait(app, waiter, timeout)
+        except asyncio.TimeoutError:
+            raise Exception("fetch_current_time", "timeout",
+                            "current_time not received")
+
+    async def fetch_historical_data(self, contract, endDateTime='',
+                                    durationStr='30 D',
+                                    barSizeSetting='1 hour',
+                                    whatToShow='MIDPOINT', useRTH=True,
+                                    timeout=timeout_sec):
+        app = await self.connect("fetch_historical_data")
+        req_id = app.next_request_id()
+        return await self._request(
+            app, req_id, 'historical',
+            lambda: app.reqHistoricalData(
+                req_id, contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, formatDate=1, keepUpToDate=False,
+                chartOptions=[]),
+            lambda: app.cancelHistoricalData(req_id),
+            "fetch_historical_data", "historical_data not received", timeout,
+            contract
+        )
+
+    async def fetch_contract_details(self, contract, timeout=timeout_sec):
+        app = await self.connect("fetch_contract_details")
+        req_id = app.next_request_id()
+        return await self._request(
+            app, req_id, 'contract',
+            lambda: app.reqContractDetails(req_id, contract),
+            None, "fetch_contract_details", "contract_details not received",
+            timeout, contract
+        )
+
+    async def fetch_matching_symbols(self, pattern, timeout=timeout_sec):
+        app = await self.connect("fetch_matching_symbols")
+        req_id = app.next_request_id()
+        return await self._request(
+            app, req_id, 'symbols',
+            lambda: app.reqMatchingSymbols(req_id, pattern),
+            None, "fetch_matching_symbols", "matching_symbols not received",
+            timeout
+        )
+
+    async def place_order(self, contract, order, timeout=timeout_sec):
+        app = await self.connect("place_order")
+        # order_tracker.wait_for blocks, so it waits on an executor thread.
+        order_id = app.next_request_id()
+        app.orders.expect(order_id)
+        outcome = 'error'
+        sent_at = time.perf_counter()
+        try:
+            app.placeOrder(order_id, contract, order)
+            record = await asyncio.get_running_loop().run_in_executor(
+                None, app.orders.wait_for, order_id, ('Submitted', 'Filled'),
+                timeout, "place_order"
+            )
+            outcome = 'ok'
+            return record
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            if e.args[:2] == ("place_order", "timeout"):
+                outcome = 'timeout'
+            raise
+        finally:
+            observe_order("place_order", contract, sent_at, outcome)
+
+    async def stream_market_data(self, contract, genericTickList=''):
+        # Yields (tick_type, value) tuples, e.g. ('BID', 1.0842), for as long
+        # as the caller keeps iterating. Breaking out of the loop, closing the
+        # generator or cancelling the task sends cancelMktData.
+        app = await self.connect("stream_market_data")
+        req_id = app.next_request_id()
+        queue = asyncio.Queue()
+        app.tick_queues[req_id] = queue
+        app.reqMktData(req_id, contract, genericTickList, False, False, [])
+        try:
+            while True:
+                tick = await queue.get()
+                if isinstance(tick, Exception):
+                    raise tick
+                yield tick
+        finally:
+            app.tick_queues.pop(req_id, None)
+            app.cancelMktData(req_id)
+
+
+# One shared client per (hostname, port, client_id) and event loop.
+_clients = weakref.WeakKeyDictionary()
+_all_clients = weakref.WeakSet()
+
+
+def _close_on_exit():
+    # Same as in connection_pool: ibapi's EReader thread isn't a daemon, so
+    # disconnect once the main thread is done or the interpreter never exits.
+    threading.main_thread().join()
+    for client in list(_all_clients):
+        client.disconnect()
+
+
+threading.Thread(target=_close_on_exit, daemon=True).start()
+
+
+def get_async_client(hostname=default_hostname, port=default_port,
+                     client_id=default_client_id):
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (str(hostname), int(port), int(client_id))
+    client = clients.get(key)
+    if client is None:
+        client = ibkr_async_client(*key)
+        clients[key] = client
+        _all_clients.add(client)
+    return client
+
+
+async def fetch_managed_accounts_async(hostname=default_hostname,
+                                       port=default_port,
+                                       client_id=default_client_id):
+    client = get_async_client(hostname, port, client_id)
+    return await client.fetch_managed_accounts()
+
+
+async def fetch_current_time_async(hostname=default_hostname,
+                                   port=default_port,
+                                   client_id=default_client_id):
+    client = get_async_client(hostname, port, client_id)
+    return await client.fetch_current_time()
+
+
+async def fetch_historical_data_async(contract, endDateTime='',
+                                      durationStr='30 D',
+                                      barSizeSetting='1 hour',
+                                      whatToShow='MIDPOINT', useRTH=True,
+                                      hostname=default_hostname,
+                                      port=default_port,
+                                      client_id=default_client_id,
+                                      timeout=timeout_sec):
+    client = get_async_client(hostname, port, client_id)
+    return await client.fetch_historical_data(
+        contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+        useRTH, timeout
+    )
+
+
+async def fetch_contract_details_async(contract, hostname=default_hostname,
+                                       port=default_port,
+                                       client_id=default_client_id,
+                                       timeout=timeout_sec):
+    client = get_async_client(hostname, port, client_id)
+    return await client.fetch_contract_details(contract, timeout)
+
+
+async def fetch_matching_symbols_async(pattern, hostname=default_hostname,
+                                       port=default_port,
+                                       client_id=default_client_id,
+                                       timeout=timeout_sec):
+    client = get_async_client(hostname, port, client_id)
+    return await client.fetch_matching_symbols(pattern, timeout)
+
+
+async def place_order_async(contract, order, hostname=default_hostname,
+                            port=default_port, client_id=default_client_id,
+                            timeout=timeout_sec):
+    client = get_async_client(hostname, port, client_id)
+    return await client.place_order(contract, order, timeout)
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Column names for historical bar frames. These are what the candlestick
+# figure in app.py expects.
+historical_data_columns = ['date', 'open', 'high', 'low', 'close', 'volume',
+                           'bar_count', 'average']
+
+historical_data_dtypes = {
+    'date': object,
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    # float, because newer ibapi versions hand out Decimal volumes and
+    # crypto/FX volumes can be fractional (or -1 for MIDPOINT).
+    'volume': np.float64,
+    'bar_count': np.int64,
+    'average': np.float64
+}
+
+
+# EWrapper.historicalData delivers one bar per call. Rather than growing a
+# DataFrame bar by bar (a full copy each time), keep one Python list per
+# field -- appends are O(1) -- and build a properly typed DataFrame once, in
+# historicalDataEnd.
+class bar_buffer:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.date = []
+        self.open = []
+        self.high = []
+        self.low = []
+        self.close = []
+        self.volume = []
+        self.bar_count = []
+        self.average = []
+
+    def __len__(self):
+        return len(self.date)
+
+    def append(self, bar):
+        self.date.append(bar.date)
+        self.open.append(bar.open)
+        self.high.append(bar.high)
+        self.low.append(bar.low)
+        self.close.append(bar.close)
+        self.volume.append(bar.volume)
+        self.bar_count.append(bar.barCount)
+        self.average.append(bar.average)
+
+    def update(self, bar):
+        # historicalDataUpdate (keepUpToDate) sends the forming bar again and
+        # again, then the next one once it starts. Returns the bar's index.
+        if self.date and self.date[-1] == bar.date:
+            index = len(self.date) - 1
+            self.open[index] = bar.open
+            self.high[index] = bar.high
+            self.low[index] = bar.low
+            self.close[index] = bar.close
+            self.volume[index] = bar.volume
+            self.bar_count[index] = bar.barCount
+            self.average[index] = bar.average
+            return index
+        self.append(bar)
+        return len(self.date) - 1
+
+    def row(self, index):
+        return [getattr(self, column)[index]
+                for column in historical_data_columns]
+
+    def to_frame(self):
+        return pd.DataFrame({
+            column: np.array(getattr(self, column),
+                             dtype=historical_data_dtypes[column])
+            for column in historical_data_columns
+        })
+
+
+def empty_bar_frame():
+    return bar_buffer().to_frame()
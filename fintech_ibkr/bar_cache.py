@@ -0,0 +1,214 @@
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.bar_buffer import historical_data_columns
+from fintech_ibkr.bar_buffer import historical_data_dtypes
+from fintech_ibkr.durations import bar_size_seconds, duration_seconds
+from fintech_ibkr.durations import duration_string, parse_end_date_time
+from fintech_ibkr.durations import format_end_date_time, bar_epochs
+from fintech_ibkr.durations import to_epoch, from_epoch
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+
+# A local SQLite store of historical bars, so that asking for the same pair
+# and bar size again doesn't re-download the whole window from IB.
+#
+# Bars are stored per series, keyed by (contract, whatToShow, barSizeSetting,
+# useRTH). Next to the bars the store records which time ranges have been
+# fetched completely. A request is answered from disk where it is covered;
+# only the missing head/tail (or any hole in between) is requested from IB,
+# then merged in (bars are upserted on their start time, so overlaps are
+# deduplicated).
+#
+# The last bar of a request that ends "now" is still forming, so coverage
+# stops at its start time and it is fetched again next time.
+
+default_cache_path = 'historical_bars.sqlite'
+
+
+def series_key(contract, whatToShow, barSizeSetting, useRTH):
+    if contract.conId:
+        contract_key = str(contract.conId)
+    else:
+        contract_key = '|'.join([
+            contract.symbol, contract.secType, contract.exchange,
+            contract.primaryExchange, contract.currency
+        ])
+    return '|'.join([contract_key, whatToShow, barSizeSetting,
+                     str(int(bool(useRTH)))])
+
+
+class bar_cache:
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS bars (
+                    series TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    date TEXT NOT NULL,
+                    open REAL, high REAL, low REAL, close REAL,
+                    volume REAL, bar_count INTEGER, average REAL,
+                    PRIMARY KEY (series, ts)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    series TEXT NOT NULL,
+                    start_ts INTEGER NOT NULL,
+                    end_ts INTEGER NOT NULL,
+                    PRIMARY KEY (series, start_ts)
+                ) WITHOUT ROWID
+            """)
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, and the Dash
+        # callbacks run on several waitress threads: one connection each.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def coverage(self, series):
+        return self.connection().execute(
+            "SELECT start_ts, end_ts FROM coverage WHERE series = ? "
+            "ORDER BY start_ts", (series,)
+        ).fetchall()
+
+    def missing(self, series, start_ts, end_ts):
+        # The parts of [start_ts, end_ts] not covered yet, in time order.
+        gaps = []
+        cursor = start_ts
+        for covered_start, covered_end in self.coverage(series):
+            if covered_end < cursor:
+                continue
+            if covered_start > end_ts:
+                break
+            if covered_start > cursor:
+                gaps.append((cursor, covered_start))
+            cursor = max(cursor, covered_end)
+        if cursor < end_ts:
+            gaps.append((cursor, end_ts))
+        return gaps
+
+    def add_coverage(self, series, start_ts, end_ts):
+        if end_ts <= start_ts:
+            return
+        conn = self.connection()
+        with self.lock, conn:
+            # Merge with every range that overlaps or touches the new one.
+            rows = conn.execute(
+                "SELECT start_ts, end_ts FROM coverage WHERE series = ? "
+                "AND start_ts <= ? AND end_ts >= ?",
+                (series, end_ts, start_ts)
+            ).fetchall()
+            for row_start, row_end in rows:
+                start_ts = min(start_ts, row_start)
+                end_ts = max(end_ts, row_end)
+            conn.execute(
+                "DELETE FROM coverage WHERE series = ? AND start_ts <= ? "
+                "AND end_ts >= ?", (series, end_ts, start_ts)
+            )
+            conn.execute(
+                "INSERT INTO coverage (series, start_ts, end_ts) "
+                "VALUES (?, ?, ?)", (series, start_ts, end_ts)
+            )
+
+    def store(self, series, frame):
+        if frame is None or len(frame) == 0:
+            return
+        ts = bar_epochs(frame['date'])
+        rows = zip(
+            [series] * len(frame), ts.tolist(), frame['date'].tolist(),
+            frame['open'].tolist(), frame['high'].tolist(),
+            frame['low'].tolist(), frame['close'].tolist(),
+            frame['volume'].tolist(), frame['bar_count'].tolist(),
+            frame['average'].tolist()
+        )
+        conn = self.connection()
+        with self.lock, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO bars (series, ts, date, open, high, "
+                "low, close, volume, bar_count, average) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def load(self, series, start_ts, end_ts):
+        rows = self.connection().execute(
+            "SELECT date, open, high, low, close, volume, bar_count, average "
+            "FROM bars WHERE series = ? AND ts >= ? AND ts <= ? ORDER BY ts",
+            (series, start_ts, end_ts)
+        ).fetchall()
+        columns = list(zip(*rows)) if rows else [[]] * 8
+        return pd.DataFrame({
+            column: np.array(values, dtype=historical_data_dtypes[column])
+            for column, values in zip(historical_data_columns, columns)
+        })
+
+    def clear(self, series=None):
+        conn = self.connection()
+        with self.lock, conn:
+            if series is None:
+                conn.execute("DELETE FROM bars")
+                conn.execute("DELETE FROM coverage")
+            else:
+                conn.execute("DELETE FROM bars WHERE series = ?", (series,))
+                conn.execute("DELETE FROM coverage WHERE series = ?",
+                             (series,))
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_bar_cache():
+    # Created on first use, so that importing fintech_ibkr doesn't create
+    # a database file.
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = bar_cache()
+        return _default_cache
+
+
+def fetch_historical_data_cached(contract, endDateTime='', durationStr='30 D',
+                                 barSizeSetting='1 hour',
+                                 whatToShow='MIDPOINT', useRTH=True,
+                                 hostname=default_hostname,
+                                 port=default_port,
+                                 client_id=default_client_id, cache=None,
+                                 fetch=fetch_historical_data):
+    # Same arguments and return value as fetch_historical_data.
+    cache = cache or default_bar_cache()
+    series = series_key(contract, whatToShow, barSizeSetting, useRTH)
+    bar_seconds = bar_size_seconds[barSizeSetting]
+    end_ts = to_epoch(parse_end_date_time(endDateTime))
+    start_ts = end_ts - duration_seconds(durationStr)
+
+    for gap_start, gap_end in cache.missing(series, start_ts, end_ts):
+        live_tail = endDateTime == '' and gap_end == end_ts
+        frame = fetch(
+            contract,
+            endDateTime='' if live_tail else
+            format_end_date_time(from_epoch(gap_end)),
+            durationStr=duration_string(gap_end - gap_start, bar_seconds),
+            barSizeSetting=barSizeSetting, whatToShow=whatToShow,
+            useRTH=useRTH, hostname=hostname, port=port, client_id=client_id
+        )
+        cache.store(series, frame)
+        covered_end = gap_end
+        if live_tail and len(frame) > 0:
+            covered_end = min(gap_end, int(bar_epochs(frame['date'])[-1]))
+        cache.add_coverage(series, gap_start, covered_end)
+
+    # Include the bar that was already open at start_ts.
+    return cache.load(series, start_ts - bar_seconds + 1, end_ts)
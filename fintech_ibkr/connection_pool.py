@@ -0,0 +1,164 @@
+from fintech_ibkr.ibkr_app import ibkr_app
+from fintech_ibkr.metrics import connect_seconds, handshake_seconds
+from contextlib import contextmanager
+import threading
+import time
+
+# Keeps warm ibkr_app connections around so that the synchronous functions
+# don't have to pay for a TCP connect + API handshake + nextValidId wait on
+# every single call.
+#
+# IB only allows one connection per client ID, so the pool holds exactly one
+# session per (hostname, port, client_id). Callers check the session out and
+# use its app; the session is health-checked on checkout and reconnected
+# lazily if the socket died or the API thread stopped. Since ibkr_app routes
+# every answer by reqId, any number of callers can use the same app at once.
+
+default_connect_timeout_sec = 5
+# If a session sat idle for longer than this, ping TWS before handing it out.
+default_health_check_sec = 30
+
+
+class ibkr_session:
+    def __init__(self, hostname, port, client_id,
+                 connect_timeout_sec=default_connect_timeout_sec,
+                 health_check_sec=default_health_check_sec):
+        self.hostname = hostname
+        self.port = int(port)
+        self.client_id = int(client_id)
+        self.connect_timeout_sec = connect_timeout_sec
+        self.health_check_sec = health_check_sec
+        self.app = None
+        self.api_thread = None
+        self.last_used = None
+        self.connect_count = 0
+        self.lock = threading.RLock()
+
+    def _wait_for(self, app, waiter, caller, message):
+        if not waiter.wait(self.connect_timeout_sec):
+            app.disconnect()
+            raise Exception(caller, "timeout", message)
+
+    def is_healthy(self):
+        return (
+            self.app is not None
+            and self.app.isConnected()
+            and self.api_thread is not None
+            and self.api_thread.is_alive()
+            and self.app.next_valid_id is not None
+        )
+
+    def connect(self, caller="connect"):
+        self.close()
+        app = ibkr_app()
+        # EClient.connect does the whole handshake before it returns, so
+        # there is nothing to wait for here: either we're connected or not.
+        start = time.perf_counter()
+        app.connect(self.hostname, self.port, self.client_id)
+        connected = time.perf_counter()
+        connect_seconds.observe(connected - start, client_id=self.client_id)
+        if not app.isConnected():
+            app.disconnect()
+            raise Exception(caller, "timeout", "couldn't connect to IBKR")
+
+        api_thread = threading.Thread(target=app.run, daemon=True)
+        api_thread.start()
+        self._wait_for(app, app.next_valid_id_event, caller,
+                       "next_valid_id not received")
+        handshake_seconds.observe(time.perf_counter() - connected,
+                                  client_id=self.client_id)
+
+        self.app = app
+        self.api_thread = api_thread
+        self.last_used = time.monotonic()
+        self.connect_count += 1
+        return app
+
+    def ping(self, caller="ping"):
+        # A cheap round trip that proves TWS is still answering on this socket.
+        app = self.app
+        waiter = app.current_time_request()
+        app.reqCurrentTime()
+        self._wait_for(app, waiter, caller, "current_time not received")
+
+    def close(self):
+        app, api_thread = self.app, self.api_thread
+        self.app = None
+        self.api_thread = None
+        if app is not None:
+            app.disconnect()
+        if api_thread is not None and \
+                api_thread is not threading.current_thread():
+            api_thread.join(timeout=1)
+
+    @contextmanager
+    def checkout(self, caller="checkout"):
+        # Only the health check and (re)connect are serialized; the request
+        # itself runs without holding the session lock.
+        with self.lock:
+            if not self.is_healthy():
+                self.connect(caller)
+            elif time.monotonic() - self.last_used > self.health_check_sec:
+                try:
+                    self.ping(caller)
+                except Exception:
+                    self.connect(caller)
+            app = self.app
+        try:
+            yield app
+        finally:
+            self.last_used = time.monotonic()
+
+
+class ibkr_connection_pool:
+    def __init__(self, connect_timeout_sec=default_connect_timeout_sec,
+                 health_check_sec=default_health_check_sec):
+        self.connect_timeout_sec = connect_timeout_sec
+        self.health_check_sec = health_check_sec
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, hostname, port, client_id):
+        key = (str(hostname), int(port), int(client_id))
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = ibkr_session(
+                    *key,
+                    connect_timeout_sec=self.connect_timeout_sec,
+                    health_check_sec=self.health_check_sec
+                )
+                self.sessions[key] = session
+        return session
+
+    def checkout(self, hostname, port, client_id, caller="checkout"):
+        return self.session(hostname, port, client_id).checkout(caller)
+
+    def close(self, hostname, port, client_id):
+        key = (str(hostname), int(port), int(client_id))
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session is not None:
+            with session.lock:
+                session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+
+def _close_on_exit(pool):
+    # ibapi's EReader thread is not a daemon, so the interpreter would wait
+    # on it forever at exit (before atexit handlers get a chance to run).
+    # Disconnect everything as soon as the main thread is done instead.
+    threading.main_thread().join()
+    pool.close_all()
+
+
+default_pool = ibkr_connection_pool()
+threading.Thread(target=_close_on_exit, args=(default_pool,),
+                 daemon=True).start()
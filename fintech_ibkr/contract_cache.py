@@ -0,0 +1,144 @@
+from fintech_ibkr.synchronous_functions import fetch_contract_details
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from collections import OrderedDict
+import io
+import json
+import os
+import threading
+import time
+import pandas as pd
+
+# Contract details practically never change intraday, so there's no need to
+# ask IB again on every candlestick submit and every trade. This keeps them
+# in memory, keyed by the normalized contract fields, with a TTL and a
+# bounded LRU size. Give it a path and it is also written to disk, so that
+# it's still warm after the service restarts on deploy.
+
+default_ttl_sec = 6 * 60 * 60
+default_max_size = 1024
+default_cache_path = 'contract_details_cache.json'
+
+
+def contract_key(contract):
+    return '|'.join([
+        (contract.symbol or '').upper(),
+        (contract.secType or '').upper(),
+        (contract.exchange or '').upper(),
+        (contract.currency or '').upper(),
+        (contract.primaryExchange or '').upper()
+    ])
+
+
+class contract_details_cache:
+    def __init__(self, ttl_sec=default_ttl_sec, max_size=default_max_size,
+                 path=None):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.path = path
+        self.lock = threading.Lock()
+        # One save at a time: concurrent fetches (fetch_watchlist) would
+        # otherwise write the same temp file.
+        self.save_lock = threading.Lock()
+        # key -> (stored_at, details DataFrame), least recently used first.
+        # stored_at is wall-clock time so that it survives a restart.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, contract):
+        key = contract_key(contract)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_sec:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1].copy()
+
+    def put(self, contract, details):
+        if details is None:
+            return
+        with self.lock:
+            key = contract_key(contract)
+            self.entries[key] = (time.time(), details.copy())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if self.path is not None:
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.path is not None:
+            self.save()
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = [
+                    {'key': key, 'stored_at': stored_at,
+                     'details': details.to_json(orient='split')}
+                    for key, (stored_at, details) in self.entries.items()
+                ]
+            # Write to a temp file and swap it in, so a crash mid-write never
+            # leaves a truncated cache behind.
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for item in data:
+                if now - item['stored_at'] > self.ttl_sec:
+                    continue
+                self.entries[item['key']] = (
+                    item['stored_at'],
+                    pd.read_json(io.StringIO(item['details']), orient='split',
+                                 dtype=False, convert_dates=False)
+                )
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_contract_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = contract_details_cache(path=default_cache_path)
+        return _default_cache
+
+
+def fetch_contract_details_cached(contract, hostname=default_hostname,
+                                  port=default_port,
+                                  client_id=default_client_id, cache=None):
+    # Same arguments and return value as fetch_contract_details.
+    if cache is None:
+        cache = default_contract_cache()
+    details = cache.get(contract)
+    if details is None:
+        details = fetch_contract_details(contract, hostname=hostname,
+                                         port=port, client_id=client_id)
+        cache.put(contract, details)
+    return details
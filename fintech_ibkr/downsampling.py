@@ -0,0 +1,109 @@
+from fintech_ibkr.bar_buffer import historical_data_columns
+from fintech_ibkr.durations import bar_epochs
+import math
+import numpy as np
+import pandas as pd
+
+# Shrinks a bar frame to at most about one candle per few pixels before it's
+# sent to the browser.
+#
+# Bars are grouped into fixed-width time buckets counted from an origin
+# (the first bar by default), and each bucket becomes one bar with the true
+# open (first), high (max), low (min) and close (last) of the bars in it, so
+# extremes are kept exactly. Volume and bar_count are summed and average is
+# the volume-weighted average. Buckets without bars are left out.
+#
+# Series drawn over the candles (indicators) take the value at each bucket's
+# last bar instead, with downsample_last.
+#
+# Because buckets are fixed-width from the origin, a bar that arrives later
+# (a live update) always falls in a bucket that can be computed on its own
+# with bucket_index.
+
+default_max_buckets = 1000
+
+
+def bucket_seconds(frame, max_buckets=default_max_buckets):
+    # The bucket width that fits the frame into max_buckets, or None if it
+    # already fits and needs no downsampling.
+    if len(frame) <= max_buckets:
+        return None
+    ts = bar_epochs(frame['date'])
+    span = int(ts[-1] - ts[0]) + 1
+    return max(1, int(math.ceil(span / float(max_buckets))))
+
+
+def bucket_index(ts, origin, bucket_sec):
+    return (np.asarray(ts, dtype='int64') - origin) // bucket_sec
+
+
+def downsample_ohlc(frame, bucket_sec, origin=None):
+    # frame must be in time order. Returns a frame with the same columns.
+    if bucket_sec is None or len(frame) == 0:
+        return frame
+    starts, dates = bucket_starts(frame, bucket_sec, origin)
+    return aggregate_bars(frame, starts, dates)
+
+
+def bucket_starts(frame, bucket_sec, origin=None):
+    # The index of the first bar in each bucket, and each bucket's label.
+    ts = bar_epochs(frame['date'])
+    if origin is None:
+        origin = int(ts[0])
+    buckets = bucket_index(ts, origin, bucket_sec)
+    starts = np.flatnonzero(np.append(True, buckets[1:] != buckets[:-1]))
+    return starts, frame['date'].to_numpy()[starts]
+
+
+def downsample_last(frame, columns, bucket_sec, origin=None):
+    # 'date' and `columns` as of the last bar in each bucket, dated like the
+    # bucket's candle from downsample_ohlc.
+    if bucket_sec is None or len(frame) == 0:
+        return frame[['date'] + list(columns)]
+    starts, dates = bucket_starts(frame, bucket_sec, origin)
+    ends = np.append(starts[1:], len(frame)) - 1
+    last = frame[list(columns)].iloc[ends].reset_index(drop=True)
+    last.insert(0, 'date', dates)
+    return last
+
+
+def aggregate_bars(frame, starts, dates):
+    # One bar per run of rows starting at each index in `starts`, labelled
+    # with `dates`.
+    ends = np.append(starts[1:], len(frame)) - 1
+    volume = frame['volume'].to_numpy(dtype=np.float64)
+    average = frame['average'].to_numpy(dtype=np.float64)
+    # MIDPOINT bars come back with volume -1: fall back to a plain mean.
+    weights = np.where(volume > 0, volume, 0.0)
+    weight_sums = np.add.reduceat(weights, starts)
+    counts = np.diff(np.append(starts, len(frame)))
+    weighted = np.add.reduceat(average * weights, starts)
+    plain = np.add.reduceat(average, starts) / counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vwap = np.where(weight_sums > 0, weighted / weight_sums, plain)
+
+    return pd.DataFrame({
+        'date': dates,
+        'open': frame['open'].to_numpy()[starts],
+        'high': np.maximum.reduceat(frame['high'].to_numpy(), starts),
+        'low': np.minimum.reduceat(frame['low'].to_numpy(), starts),
+        'close': frame['close'].to_numpy()[ends],
+        'volume': np.where(np.maximum.reduceat(volume, starts) < 0, -1.0,
+                           weight_sums),
+        'bar_count': np.add.reduceat(frame['bar_count'].to_numpy(), starts),
+        'average': vwap
+    }, columns=historical_data_columns)
+
+
+def visible_bars(frame, start=None, end=None):
+    # The bars between two x-axis range values as Plotly reports them in
+    # relayoutData, e.g. '2022-03-01 05:12:33.5'.
+    if start is None and end is None:
+        return frame
+    ts = bar_epochs(frame['date'])
+    keep = np.ones(len(frame), dtype=bool)
+    if start is not None:
+        keep &= ts >= pd.Timestamp(start).value // 10 ** 9
+    if end is not None:
+        keep &= ts <= pd.Timestamp(end).value // 10 ** 9
+    return frame[keep].reset_index(drop=True)
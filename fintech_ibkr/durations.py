@@ -0,0 +1,115 @@
+import math
+import numpy as np
+from datetime import datetime, timedelta
+import pandas as pd
+
+# Helpers for the time-related strings that reqHistoricalData works with:
+# barSizeSetting ('1 hour'), durationStr ('30 D'), endDateTime
+# ('20220329 14:00:00', or '' for now) and the bar dates that come back
+# ('20220329  14:00:00', or '20220329' for daily bars).
+#
+# Times are naive and in TWS's local time zone, the same as IB uses for
+# endDateTime and formatDate=1 bar dates.
+
+bar_size_seconds = {
+    '1 secs': 1, '5 secs': 5, '10 secs': 10, '15 secs': 15, '30 secs': 30,
+    '1 min': 60, '2 mins': 120, '3 mins': 180, '5 mins': 300,
+    '10 mins': 600, '15 mins': 900, '20 mins': 1200, '30 mins': 1800,
+    '1 hour': 3600, '2 hours': 7200, '3 hours': 10800, '4 hours': 14400,
+    '8 hours': 28800, '1 day': 86400, '1 week': 604800, '1 month': 2592000
+}
+
+# The longest durationStr IB accepts in one request for each bar size, from
+# its table of valid duration / bar size combinations.
+max_request_duration = {
+    '1 secs': '1800 S', '5 secs': '3600 S', '10 secs': '14400 S',
+    '15 secs': '14400 S', '30 secs': '28800 S', '1 min': '1 D',
+    '2 mins': '2 D', '3 mins': '1 W', '5 mins': '1 W', '10 mins': '1 W',
+    '15 mins': '1 W', '20 mins': '1 W', '30 mins': '1 M', '1 hour': '1 M',
+    '2 hours': '1 M', '3 hours': '1 M', '4 hours': '1 M', '8 hours': '1 M',
+    '1 day': '1 Y', '1 week': '1 Y', '1 month': '1 Y'
+}
+
+# IB's calendar units, approximated to a fixed number of seconds.
+duration_unit_seconds = {
+    'S': 1, 'D': 86400, 'W': 604800, 'M': 2592000, 'Y': 31536000
+}
+
+
+def duration_seconds(durationStr):
+    amount, unit = durationStr.split()
+    return int(amount) * duration_unit_seconds[unit.upper()]
+
+
+def duration_string(seconds, bar_seconds=1):
+    # The shortest durationStr that covers `seconds`. IB only takes 'S'
+    # durations up to a day and wants whole days for daily+ bars.
+    seconds = max(int(math.ceil(seconds)), bar_seconds)
+    if seconds <= 86400 and bar_seconds < 86400:
+        return '%d S' % seconds
+    return '%d D' % int(math.ceil(seconds / 86400.0))
+
+
+def parse_end_date_time(endDateTime, now=None):
+    if not endDateTime:
+        return (now or datetime.now()).replace(microsecond=0)
+    # Ignore an explicit time zone suffix such as 'US/Eastern'.
+    parts = endDateTime.replace('-', ' ').split()
+    if len(parts) >= 2:
+        return datetime.strptime(parts[0] + ' ' + parts[1], '%Y%m%d %H:%M:%S')
+    return datetime.strptime(parts[0], '%Y%m%d')
+
+
+def format_end_date_time(dt):
+    return dt.strftime('%Y%m%d %H:%M:%S')
+
+
+def parse_bar_dates(dates):
+    # Vectorized parse of the 'date' column of a historical data frame into
+    # datetime64. Handles intraday ('20220329  14:00:00', optionally with a
+    # time zone suffix), daily ('20220329') and epoch (formatDate=2) dates.
+    dates = pd.Series(dates, dtype=str)
+    if len(dates) == 0:
+        return pd.to_datetime(dates)
+    first = dates.iloc[0].strip()
+    if first.isdigit() and len(first) > 8:
+        return pd.to_datetime(dates.astype('int64'), unit='s')
+    if len(first) == 8:
+        return pd.to_datetime(dates, format='%Y%m%d')
+    if first[8:10] == '  ' and first[12] == ':' and first[15] == ':':
+        return _parse_fixed_width_dates(dates)
+    return pd.to_datetime(
+        dates.str.split().str[:2].str.join(' '), format='%Y%m%d %H:%M:%S'
+    )
+
+
+def _parse_fixed_width_dates(dates):
+    # IB's own 'YYYYMMDD  HH:MM:SS' layout, read straight from the bytes:
+    # strptime-style parsing costs seconds for a few million 1 sec bars.
+    # Only the distinct days go through pandas.
+    raw = dates.to_numpy().astype('S18')
+    digits = np.frombuffer(raw.tobytes(), dtype=np.uint8) \
+        .reshape(-1, 18).astype(np.int64) - 48
+    day = digits[:, :8] @ (10 ** np.arange(7, -1, -1))
+    seconds = (digits[:, 10] * 10 + digits[:, 11]) * 3600 + \
+        (digits[:, 13] * 10 + digits[:, 14]) * 60 + \
+        digits[:, 16] * 10 + digits[:, 17]
+    days, inverse = np.unique(day, return_inverse=True)
+    day_starts = pd.to_datetime(days.astype(str), format='%Y%m%d') \
+        .to_numpy(dtype='datetime64[s]')
+    return pd.Series(day_starts[inverse] + seconds.astype('timedelta64[s]'))
+
+
+def bar_epochs(dates):
+    # Bar start times as int64 seconds, treating the naive times as UTC
+    # so that the numbers are stable whatever the local time zone.
+    return parse_bar_dates(dates).to_numpy(dtype='datetime64[s]') \
+        .astype('int64')
+
+
+def to_epoch(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def from_epoch(seconds):
+    return datetime(1970, 1, 1) + timedelta(seconds=int(seconds))
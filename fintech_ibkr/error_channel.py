@@ -0,0 +1,121 @@
+from collections import Counter, deque
+import threading
+import time
+import pandas as pd
+
+# What ibkr_app does with the error() callback.
+#
+# An error for a reqId (or orderId) that's waiting for an answer finishes
+# that request straight away with an ibkr_error, instead of leaving the
+# caller to find out when its timeout runs out. Informational messages
+# (market data farm connected, order outside RTH, ...) are only counted.
+# Everything else goes into a ring buffer of the last max_errors errors,
+# which can be read back per reqId.
+
+default_max_errors = 1000
+
+# Messages that don't mean a request failed.
+informational_codes = frozenset(range(2100, 2200)) | {399, 10167}
+
+
+class ibkr_error(Exception):
+    kind = 'ibkr_error'
+
+    def __init__(self, req_id, code, message):
+        # Same (caller, kind, message) args as every other exception here.
+        Exception.__init__(self, "ibkr_app", self.kind,
+                           "%s: %s" % (code, message))
+        self.req_id = req_id
+        self.code = code
+        self.message = message
+
+    def __reduce__(self):
+        # Rebuilt from our own arguments when pickled (see gateway.py).
+        return self.__class__, (self.req_id, self.code, self.message)
+
+
+class pacing_violation_error(ibkr_error):
+    kind = 'pacing_violation'
+
+
+class no_data_error(ibkr_error):
+    kind = 'no_data'
+
+
+class contract_not_found_error(ibkr_error):
+    kind = 'contract_not_found'
+
+
+class order_rejected_error(ibkr_error):
+    kind = 'order_rejected'
+
+
+class market_data_error(ibkr_error):
+    kind = 'market_data'
+
+
+error_types = {
+    200: contract_not_found_error,
+    201: order_rejected_error,
+    202: order_rejected_error,
+    354: market_data_error,
+    10089: market_data_error,
+    10168: market_data_error,
+}
+
+
+def error_exception(req_id, code, message):
+    if code == 162:
+        # 162 covers every historical data failure; tell them apart by text.
+        if 'pacing violation' in message.lower():
+            return pacing_violation_error(req_id, code, message)
+        return no_data_error(req_id, code, message)
+    return error_types.get(code, ibkr_error)(req_id, code, message)
+
+
+class error_channel:
+    def __init__(self, max_errors=default_max_errors):
+        self.lock = threading.Lock()
+        # (time, reqId, errorCode, errorString), oldest first.
+        self.errors = deque()
+        self.max_errors = max_errors
+        # reqId -> the same tuples, for the errors still in the ring.
+        self.by_req_id = {}
+        self.counts = Counter()
+        self.informational = Counter()
+
+    def record(self, reqId, errorCode, errorString):
+        # Returns True if the message is informational.
+        if errorCode in informational_codes:
+            with self.lock:
+                self.informational[errorCode] += 1
+            return True
+        entry = (time.time(), reqId, errorCode, errorString)
+        with self.lock:
+            self.counts[errorCode] += 1
+            if len(self.errors) >= self.max_errors:
+                old = self.errors.popleft()
+                index = self.by_req_id[old[1]]
+                index.popleft()
+                if not index:
+                    del self.by_req_id[old[1]]
+            self.errors.append(entry)
+            self.by_req_id.setdefault(reqId, deque()).append(entry)
+        return False
+
+    def for_request(self, req_id):
+        with self.lock:
+            return list(self.by_req_id.get(req_id, ()))
+
+    def stats(self):
+        with self.lock:
+            return {'errors': dict(self.counts),
+                    'informational': dict(self.informational),
+                    'buffered': len(self.errors)}
+
+    def frame(self):
+        with self.lock:
+            rows = list(self.errors)
+        return pd.DataFrame(
+            rows, columns=['time', 'reqId', 'errorCode', 'errorString']
+        )
@@ -0,0 +1,521 @@
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta
+from fintech_ibkr.durations import bar_size_seconds, duration_seconds
+from fintech_ibkr.durations import parse_end_date_time
+
+# A local stand-in for TWS / IB Gateway that speaks just enough of the IB API
+# wire protocol for ibkr_app: the v100+ handshake, startApi (answered with
+# managedAccounts + nextValidId), reqIds, reqCurrentTime, reqHistoricalData
+# (including keepUpToDate), cancelHistoricalData, reqContractDetails,
+# reqMatchingSymbols, placeOrder, reqMktData and cancelMktData.
+#
+# Bars and ticks are synthetic (a seeded random walk per symbol), so runs are
+# deterministic. Latency, error injection and pacing behaviour are all set on
+# the fake_tws_config object, which can be changed while the server runs.
+#
+# Run it from the command line:
+#     python -m fintech_ibkr.fake_tws --port 7497 --latency-ms 20
+# or in-process:
+#     server = start_fake_tws(port=0)
+#     ... fetch_historical_data(contract, port=server.port) ...
+#     server.stop()
+
+server_version = 157
+
+# Outgoing (server -> client) message ids, see ibapi.message.IN
+TICK_PRICE = 1
+TICK_SIZE = 2
+ORDER_STATUS = 3
+ERR_MSG = 4
+NEXT_VALID_ID = 9
+CONTRACT_DATA = 10
+MANAGED_ACCTS = 15
+HISTORICAL_DATA = 17
+CURRENT_TIME = 49
+CONTRACT_DATA_END = 52
+SYMBOL_SAMPLES = 79
+HISTORICAL_DATA_UPDATE = 90
+
+# Incoming (client -> server) message ids, see ibapi.message.OUT
+REQ_MKT_DATA = 1
+CANCEL_MKT_DATA = 2
+PLACE_ORDER = 3
+REQ_IDS = 8
+REQ_CONTRACT_DATA = 9
+REQ_HISTORICAL_DATA = 20
+CANCEL_HISTORICAL_DATA = 25
+REQ_CURRENT_TIME = 49
+START_API = 71
+REQ_MATCHING_SYMBOLS = 81
+
+
+class fake_tws_config:
+    def __init__(self, latency_ms=0, max_bars=None, error_codes=None,
+                 pacing=False, update_interval_sec=1.0,
+                 tick_interval_sec=0.5, fill_orders=True, seed=0):
+        # Delay before answering every request.
+        self.latency_ms = latency_ms
+        # Cap on how many bars one historical request returns.
+        self.max_bars = max_bars
+        # Maps a request kind ('historical', 'contract', 'symbols', 'order',
+        # 'mkt_data', 'time') to an IB error code to answer with instead.
+        self.error_codes = dict(error_codes or {})
+        # Enforce IB's historical-data pacing rules and answer violations
+        # with error 162, the way TWS does.
+        self.pacing = pacing
+        self.update_interval_sec = update_interval_sec
+        self.tick_interval_sec = tick_interval_sec
+        # Walk orders through PreSubmitted -> Submitted -> Filled.
+        self.fill_orders = fill_orders
+        self.seed = seed
+
+
+error_text = {
+    162: "Historical Market Data Service error message:"
+         "Historical data request pacing violation",
+    200: "No security definition has been found for the request",
+    321: "Error validating request",
+    354: "Requested market data is not subscribed",
+    366: "No historical data query found for ticker id",
+    502: "Couldn't connect to TWS",
+}
+
+
+def _field(value):
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value) + '\0'
+
+
+def _message(*fields):
+    text = ''.join(_field(f) for f in fields).encode()
+    return struct.pack('!I', len(text)) + text
+
+
+def _format_bar_date(ts, bar_seconds):
+    if bar_seconds >= 86400:
+        return ts.strftime('%Y%m%d')
+    return ts.strftime('%Y%m%d  %H:%M:%S')
+
+
+def synthetic_bars(symbol, end, duration_sec, bar_seconds, seed=0,
+                   max_bars=None):
+    # A deterministic random walk: the same symbol and window always gives
+    # the same bars, and overlapping windows agree on overlapping bars.
+    n = max(1, duration_sec // bar_seconds)
+    if max_bars is not None:
+        n = min(n, max_bars)
+    end_epoch = int(end.timestamp()) // bar_seconds * bar_seconds
+    start_epoch = end_epoch - (n - 1) * bar_seconds
+    bars = []
+    for i in range(n):
+        epoch = start_epoch + i * bar_seconds
+        rng = random.Random(zlib.crc32(
+            ('%s:%d:%d' % (symbol, seed, epoch)).encode()))
+        base = 1.0 + (sum(map(ord, symbol)) % 100) / 100.0
+        drift = ((epoch // bar_seconds) % 997) / 997.0 * 0.05
+        open_ = round(base + drift + rng.uniform(-0.01, 0.01), 5)
+        close = round(open_ + rng.uniform(-0.005, 0.005), 5)
+        high = round(max(open_, close) + rng.uniform(0, 0.003), 5)
+        low = round(min(open_, close) - rng.uniform(0, 0.003), 5)
+        volume = rng.randint(0, 5000)
+        bar_count = rng.randint(1, 200)
+        average = round((open_ + close + high + low) / 4, 5)
+        bars.append((datetime.fromtimestamp(epoch), open_, high, low, close,
+                     volume, average, bar_count))
+    return bars
+
+
+class pacing_tracker:
+    # IB's documented historical-data pacing rules:
+    #   - no identical request within 15 seconds
+    #   - no more than 6 requests for the same contract within 2 seconds
+    #   - no more than 60 requests within any 10 minute period
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.all_requests = deque()
+        self.by_contract = {}
+        self.identical = {}
+
+    def allow(self, contract_key, request_key, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.all_requests and now - self.all_requests[0] > 600:
+                self.all_requests.popleft()
+            recent = self.by_contract.setdefault(contract_key, deque())
+            while recent and now - recent[0] > 2:
+                recent.popleft()
+            last = self.identical.get(request_key)
+            if last is not None and now - last < 15:
+                return False
+            if len(recent) >= 6 or len(self.all_requests) >= 60:
+                return False
+            self.all_requests.append(now)
+            recent.append(now)
+            self.identical[request_key] = now
+            return True
+
+
+class fake_tws_handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        # Answers often go out as several messages in a row (contract data
+        # + end, order statuses); don't let Nagle hold them back.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.streams = {}
+        self.next_perm_id = 1000000
+        with self.server.id_lock:
+            self.server.handlers.add(self)
+
+    def send(self, *fields):
+        try:
+            with self.send_lock:
+                self.request.sendall(_message(*fields))
+                self.server.count('messages_sent')
+        except OSError:
+            self.closed.set()
+
+    def recv_exact(self, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("client went away")
+            buf += chunk
+        return buf
+
+    def recv_message(self):
+        size = struct.unpack('!I', self.recv_exact(4))[0]
+        return self.recv_exact(size).decode().split('\0')[:-1]
+
+    def handle(self):
+        try:
+            prefix = self.recv_exact(4)
+            if prefix != b'API\0':
+                return
+            self.recv_message()  # "v100..157", we always answer 157
+            with self.send_lock:
+                self.request.sendall(_message(
+                    server_version,
+                    datetime.now().strftime('%Y%m%d %H:%M:%S EST')
+                ))
+            while not self.closed.is_set():
+                fields = self.recv_message()
+                self.server.count('requests')
+                self.dispatch(fields)
+        except (ConnectionError, OSError, struct.error):
+            pass
+        finally:
+            self.closed.set()
+            for stop in list(self.streams.values()):
+                stop.set()
+            with self.server.id_lock:
+                self.server.handlers.discard(self)
+
+    def drop(self):
+        # Close the connection from our side, the way TWS does on exit.
+        self.closed.set()
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def delay(self):
+        if self.config.latency_ms:
+            time.sleep(self.config.latency_ms / 1000.0)
+
+    def later(self, func, *args):
+        # Answer on a worker thread so a slow answer doesn't hold up
+        # the socket for other requests, just like TWS.
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+    def injected_error(self, kind, req_id):
+        code = self.config.error_codes.get(kind)
+        if code is None:
+            return False
+        self.send(ERR_MSG, 2, req_id, code, error_text.get(code, "error"))
+        return True
+
+    def dispatch(self, fields):
+        msg_id = int(fields[0])
+        if msg_id == START_API:
+            self.client_id = int(fields[2])
+            self.send(MANAGED_ACCTS, 1, 'DU1234567')
+            self.send(NEXT_VALID_ID, 1, self.server.next_order_id())
+            self.send(ERR_MSG, 2, -1, 2104,
+                      "Market data farm connection is OK:usfarm")
+            self.send(ERR_MSG, 2, -1, 2106,
+                      "HMDS data farm connection is OK:ushmds")
+            self.send(ERR_MSG, 2, -1, 2158,
+                      "Sec-def data farm connection is OK:secdefil")
+        elif msg_id == REQ_IDS:
+            self.send(NEXT_VALID_ID, 1, self.server.next_order_id())
+        elif msg_id == REQ_CURRENT_TIME:
+            self.later(self.answer_current_time)
+        elif msg_id == REQ_HISTORICAL_DATA:
+            self.later(self.answer_historical_data, fields)
+        elif msg_id == CANCEL_HISTORICAL_DATA:
+            stop = self.streams.pop(('hist', int(fields[2])), None)
+            if stop is not None:
+                stop.set()
+        elif msg_id == REQ_CONTRACT_DATA:
+            self.later(self.answer_contract_details, fields)
+        elif msg_id == REQ_MATCHING_SYMBOLS:
+            self.later(self.answer_matching_symbols, fields)
+        elif msg_id == PLACE_ORDER:
+            self.later(self.answer_place_order, fields)
+        elif msg_id == REQ_MKT_DATA:
+            self.later(self.answer_mkt_data, fields)
+        elif msg_id == CANCEL_MKT_DATA:
+            stop = self.streams.pop(('mkt', int(fields[2])), None)
+            if stop is not None:
+                stop.set()
+
+    def answer_current_time(self):
+        self.delay()
+        if self.injected_error('time', -1):
+            return
+        self.send(CURRENT_TIME, 1, int(time.time()))
+
+    def answer_historical_data(self, fields):
+        req_id = int(fields[1])
+        symbol, sec_type, exchange, currency = \
+            fields[3], fields[4], fields[9], fields[11]
+        end_date_time, bar_size, duration_str = \
+            fields[15], fields[16], fields[17]
+        what_to_show = fields[19]
+        keep_up_to_date = fields[-2] == '1'
+        self.delay()
+        if self.injected_error('historical', req_id):
+            return
+        if self.config.pacing:
+            contract_key = (symbol, sec_type, exchange, currency)
+            request_key = contract_key + (end_date_time, bar_size,
+                                          duration_str, what_to_show)
+            if not self.server.pacing.allow(contract_key, request_key):
+                self.server.count('pacing_violations')
+                self.send(ERR_MSG, 2, req_id, 162, error_text[162])
+                return
+        try:
+            bar_seconds = bar_size_seconds[bar_size]
+            duration_sec = duration_seconds(duration_str)
+            end = parse_end_date_time(end_date_time)
+        except (KeyError, ValueError):
+            self.send(ERR_MSG, 2, req_id, 321,
+                      error_text[321] + ": bad historical data request")
+            return
+        bars = synthetic_bars(symbol + currency, end, duration_sec,
+                              bar_seconds, self.config.seed,
+                              self.config.max_bars)
+        out = [HISTORICAL_DATA, req_id,
+               (end - timedelta(seconds=duration_sec)).strftime(
+                   '%Y%m%d  %H:%M:%S'),
+               end.strftime('%Y%m%d  %H:%M:%S'), len(bars)]
+        for ts, open_, high, low, close, volume, average, bar_count in bars:
+            out += [_format_bar_date(ts, bar_seconds), open_, high, low,
+                    close, volume, average, bar_count]
+        self.send(*out)
+        self.server.count('bars_sent', len(bars))
+        if keep_up_to_date:
+            stop = threading.Event()
+            self.streams[('hist', req_id)] = stop
+            self.stream_bar_updates(req_id, bars[-1], bar_seconds, stop)
+
+    def stream_bar_updates(self, req_id, last_bar, bar_seconds, stop):
+        ts, open_, high, low, close, volume, average, bar_count = last_bar
+        rng = random.Random(req_id)
+        while not stop.wait(self.config.update_interval_sec):
+            if self.closed.is_set():
+                return
+            now = datetime.now()
+            if (now - ts).total_seconds() >= bar_seconds:
+                ts = ts + timedelta(seconds=bar_seconds)
+                open_ = high = low = close
+                volume, bar_count = 0, 0
+            close = round(close + rng.uniform(-0.001, 0.001), 5)
+            high, low = max(high, close), min(low, close)
+            volume += rng.randint(0, 50)
+            bar_count += 1
+            average = round((open_ + high + low + close) / 4, 5)
+            self.send(HISTORICAL_DATA_UPDATE, req_id, bar_count,
+                      _format_bar_date(ts, bar_seconds), open_, close, high,
+                      low, average, volume)
+
+    def answer_contract_details(self, fields):
+        req_id = int(fields[2])
+        con_id, symbol, sec_type = fields[3], fields[4], fields[5]
+        exchange, primary_exchange, currency = fields[10], fields[11], \
+            fields[12]
+        self.delay()
+        if self.injected_error('contract', req_id) or not symbol:
+            if not symbol:
+                self.send(ERR_MSG, 2, req_id, 200, error_text[200])
+            return
+        con_id = int(con_id or 0) or \
+            (sum(ord(c) * 31 ** i for i, c in
+                 enumerate(symbol + currency)) % 10000000)
+        if sec_type == 'CASH':
+            local_symbol = symbol + '.' + currency
+            trading_hours = liquid_hours = \
+                datetime.now().strftime('%Y%m%d') + ':1715-' + \
+                (datetime.now() + timedelta(days=1)).strftime('%Y%m%d') + \
+                ':1700'
+            time_zone = 'US/Eastern'
+        else:
+            local_symbol = symbol
+            trading_hours = liquid_hours = \
+                datetime.now().strftime('%Y%m%d') + ':0930-' + \
+                datetime.now().strftime('%Y%m%d') + ':1600'
+            time_zone = 'US/Eastern'
+        self.send(
+            CONTRACT_DATA, 8, req_id, symbol, sec_type, '', 0.0, '',
+            exchange, currency, local_symbol, local_symbol, symbol, con_id,
+            0.00005, 1, '', 'LMT,MKT', exchange, 1, 0,
+            symbol + ' ' + currency, primary_exchange, '', '', '', '',
+            time_zone, trading_hours, liquid_hours, '', 0, 0, 1, '', '',
+            '26', '', 'COMMON' if sec_type == 'STK' else ''
+        )
+        self.send(CONTRACT_DATA_END, 1, req_id)
+
+    def answer_matching_symbols(self, fields):
+        req_id, pattern = int(fields[1]), fields[2]
+        self.delay()
+        if self.injected_error('symbols', req_id):
+            return
+        out = [SYMBOL_SAMPLES, req_id, 3]
+        for i, suffix in enumerate(['', 'A', 'B']):
+            out += [100000 + i, pattern.upper() + suffix, 'STK', 'NASDAQ',
+                    'USD', 0]
+        self.send(*out)
+
+    def answer_place_order(self, fields):
+        order_id = int(fields[1])
+        self.delay()
+        if self.injected_error('order', order_id):
+            return
+        perm_id = self.server.next_perm_id()
+        client_id = getattr(self, 'client_id', 0)
+        self.send(ORDER_STATUS, order_id, 'PreSubmitted', 0.0, 100.0, 0.0,
+                  perm_id, 0, 0.0, client_id, '', 0.0)
+        self.send(ORDER_STATUS, order_id, 'Submitted', 0.0, 100.0, 0.0,
+                  perm_id, 0, 0.0, client_id, '', 0.0)
+        if self.config.fill_orders:
+            self.delay()
+            self.send(ORDER_STATUS, order_id, 'Filled', 100.0, 0.0, 1.2345,
+                      perm_id, 0, 1.2345, client_id, '', 0.0)
+
+    def answer_mkt_data(self, fields):
+        req_id, symbol = int(fields[2]), fields[4]
+        self.delay()
+        if self.injected_error('mkt_data', req_id):
+            return
+        stop = threading.Event()
+        self.streams[('mkt', req_id)] = stop
+        rng = random.Random(zlib.crc32(symbol.encode()))
+        mid = 1.0 + (sum(map(ord, symbol)) % 100) / 100.0
+        while not self.closed.is_set():
+            mid = round(mid + rng.uniform(-0.0005, 0.0005), 5)
+            # bid, ask, last prices followed by their sizes.
+            self.send(TICK_PRICE, 6, req_id, 1, mid - 0.0001, 100, 0)
+            self.send(TICK_PRICE, 6, req_id, 2, mid + 0.0001, 100, 0)
+            self.send(TICK_PRICE, 6, req_id, 4, mid, 10, 0)
+            self.send(TICK_SIZE, 6, req_id, 8, rng.randint(1, 1000))
+            if stop.wait(self.config.tick_interval_sec):
+                return
+
+
+class fake_tws_server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hostname='127.0.0.1', port=7497, config=None):
+        self.config = config or fake_tws_config()
+        self.pacing = pacing_tracker()
+        self.id_lock = threading.Lock()
+        self.order_id = 1
+        self.perm_id = 1000000
+        # Updated from every connection's thread, so only under counts_lock.
+        self.counts_lock = threading.Lock()
+        self.counts = {'requests': 0, 'messages_sent': 0, 'bars_sent': 0,
+                       'pacing_violations': 0}
+        # Open client connections.
+        self.handlers = set()
+        socketserver.ThreadingTCPServer.__init__(
+            self, (hostname, port), fake_tws_handler)
+        self.hostname, self.port = self.server_address[:2]
+
+    def next_order_id(self):
+        with self.id_lock:
+            return self.order_id
+
+    def next_perm_id(self):
+        with self.id_lock:
+            self.perm_id += 1
+            return self.perm_id
+
+    def count(self, name, n=1):
+        with self.counts_lock:
+            self.counts[name] += n
+
+    def stats(self):
+        with self.counts_lock:
+            return dict(self.counts)
+
+    def stop(self):
+        # shutdown() only stops accepting; this also drops every client.
+        self.shutdown()
+        self.server_close()
+        with self.id_lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            handler.drop()
+
+
+def start_fake_tws(hostname='127.0.0.1', port=0, config=None):
+    # Start a fake TWS on a background thread. port=0 picks a free port,
+    # read it back from server.port.
+    server = fake_tws_server(hostname, port, config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Fake TWS / IB Gateway")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7497)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--max-bars', type=int, default=None)
+    parser.add_argument('--pacing', action='store_true',
+                        help="enforce IB historical data pacing limits")
+    parser.add_argument('--error', action='append', default=[],
+                        metavar='KIND=CODE',
+                        help="answer requests of KIND with IB error CODE, "
+                             "e.g. --error historical=162")
+    args = parser.parse_args()
+    error_codes = {}
+    for item in args.error:
+        kind, code = item.split('=')
+        error_codes[kind] = int(code)
+    server = fake_tws_server(args.host, args.port, fake_tws_config(
+        latency_ms=args.latency_ms, max_bars=args.max_bars,
+        error_codes=error_codes, pacing=args.pacing
+    ))
+    print("fake TWS listening on %s:%d" % (server.hostname, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
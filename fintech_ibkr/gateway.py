@@ -0,0 +1,454 @@
+from fintech_ibkr.synchronous_functions import fetch_managed_accounts
+from fintech_ibkr.synchronous_functions import fetch_current_time
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+from fintech_ibkr.synchronous_functions import fetch_contract_details
+from fintech_ibkr.synchronous_functions import fetch_matching_symbols
+from fintech_ibkr.synchronous_functions import place_order
+from fintech_ibkr.synchronous_functions import wait_for_order
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.contract_cache import fetch_contract_details_cached
+from fintech_ibkr.bar_cache import fetch_historical_data_cached
+from fintech_ibkr.historical_scheduler import interactive_priority
+from fintech_ibkr.history_downloader import fetch_long_historical_data
+from fintech_ibkr.resampling import fetch_historical_data_resampled
+from fintech_ibkr.live_bars import live_bars_snapshot, live_bars_since
+from fintech_ibkr.metrics import ibkr_metrics_text
+from fintech_ibkr.market_data import quote_subscribe, quote_poll
+from fintech_ibkr.market_data import quote_unsubscribe
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from multiprocessing.connection import Listener, Client
+from types import SimpleNamespace
+import itertools
+import os
+import pickle
+import queue
+import secrets
+import socket
+import threading
+import time
+
+# A broker gateway: one process that owns the IB connections and answers
+# the fetch_* / place_order calls of any number of web processes over a
+# local socket.
+#
+# IB allows one connection per client ID, so web processes that each
+# connected on their own would fight over it. With the gateway they all share
+# its connections, bar and contract caches, historical scheduler and live
+# bar streams. Identical calls that are in flight at the same time (say, the
+# same chart loaded from two browsers) are sent to IB once and every caller
+# gets the answer. place_order is never coalesced.
+#
+# Run it next to the web processes:
+#     python -m fintech_ibkr.gateway
+# and point the app at the address it prints with IBKR_GATEWAY=... . Calls are
+# pickled and can place orders, so connections are authenticated with a
+# secret: IBKR_GATEWAY_AUTHKEY if it's set, otherwise a random key made on
+# first use in ~/.fintech_ibkr/gateway.key, readable by this user only.
+# Where there are Unix sockets the gateway listens on one in that same
+# private directory by default (~/.fintech_ibkr/gateway.sock), so only
+# this user's processes can reach it at all; TCP is for Windows, or when
+# asked for with --address host:port.
+#
+# broker_functions(address) gives the same set of functions either way: the
+# local ones without an address, calls to the gateway with one.
+
+# Private to this user: the key file and the Unix socket live here.
+gateway_dir = os.path.join(os.path.expanduser('~'), '.fintech_ibkr')
+gateway_key_file = os.path.join(gateway_dir, 'gateway.key')
+if hasattr(socket, 'AF_UNIX'):
+    default_gateway_address = os.path.join(gateway_dir, 'gateway.sock')
+else:
+    default_gateway_address = ('127.0.0.1', 7600)
+
+
+def fetch_chart_bars(contract, endDateTime='', durationStr='30 D',
+                     barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                     useRTH=True, hostname=default_hostname,
+                     port=default_port, client_id=default_client_id,
+                     trading_hours=None, progress=None):
+    # fetch_historical_data_resampled, with anything that isn't cached
+    # downloaded in chunks ahead of background downloads.
+    # progress(chunks_done, chunks_total) as in fetch_long_historical_data.
+    return fetch_historical_data_resampled(
+        contract, endDateTime=endDateTime, durationStr=durationStr,
+        barSizeSetting=barSizeSetting, whatToShow=whatToShow, useRTH=useRTH,
+        hostname=hostname, port=port, client_id=client_id,
+        trading_hours=trading_hours,
+        fetch=partial(fetch_long_historical_data,
+                      priority=interactive_priority, progress=progress)
+    )
+
+
+def fetch_watchlist(contracts, endDateTime='', durationStr='30 D',
+                    barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                    useRTH=True, hostname=default_hostname,
+                    port=default_port, client_id=default_client_id,
+                    max_workers=8, progress=None):
+    # Contract details and fetch_chart_bars for every contract at once, on
+    # the one pooled connection, so the whole list takes about as long as
+    # its slowest contract. Returns [(bars, None) or (None, exception)] in
+    # the order of `contracts`. progress(contracts_done, contracts_total).
+    def fetch(contract):
+        details = fetch_contract_details_cached(
+            contract, hostname=hostname, port=port, client_id=client_id
+        )
+        return fetch_chart_bars(
+            contract, endDateTime=endDateTime, durationStr=durationStr,
+            barSizeSetting=barSizeSetting, whatToShow=whatToShow,
+            useRTH=useRTH, hostname=hostname, port=port, client_id=client_id,
+            trading_hours=details.liquid_hours[0] if useRTH
+            else details.trading_hours[0]
+        )
+
+    results = [None] * len(contracts)
+    executor = ThreadPoolExecutor(max(1, min(max_workers, len(contracts))),
+                                  thread_name_prefix='fetch_watchlist')
+    try:
+        futures = {executor.submit(fetch, contract): i
+                   for i, contract in enumerate(contracts)}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                results[futures[future]] = (future.result(), None)
+            except Exception as e:
+                results[futures[future]] = (None, e)
+            if progress is not None:
+                progress(done, len(contracts))
+    finally:
+        # Whatever hasn't started yet if progress() raised to cancel.
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+gateway_operations = {
+    function.__name__: function for function in [
+        fetch_managed_accounts, fetch_current_time, fetch_historical_data,
+        fetch_contract_details, fetch_matching_symbols, place_order,
+        wait_for_order, fetch_contract_details_cached,
+        fetch_historical_data_cached, fetch_historical_data_resampled,
+        fetch_long_historical_data, fetch_chart_bars, live_bars_snapshot,
+        live_bars_since, ibkr_metrics_text, quote_subscribe, quote_poll,
+        quote_unsubscribe, fetch_watchlist
+    ]
+}
+
+# Every call of these does something, so they're never shared.
+uncoalesced_operations = {'place_order', 'quote_subscribe',
+                          'quote_unsubscribe'}
+
+
+def parse_gateway_address(address):
+    # 'host:port' for TCP, anything else is a Unix socket path (or a
+    # \\.\pipe\name on Windows).
+    if not isinstance(address, str):
+        return address
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def gateway_authkey():
+    key = os.environ.get('IBKR_GATEWAY_AUTHKEY', '').encode()
+    if key:
+        return key
+    os.makedirs(gateway_dir, mode=0o700, exist_ok=True)
+    try:
+        # O_EXCL: of two processes starting together, one makes the key
+        # and the other reads it.
+        fd = os.open(gateway_key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    for attempt in range(50):
+        with open(gateway_key_file) as f:
+            key = f.read().strip().encode()
+        if key:
+            return key
+        # Still being written by the process that made it.
+        time.sleep(0.01)
+    raise Exception("gateway_authkey", "empty_key",
+                    "%s is empty; delete it to make a new key" %
+                    gateway_key_file)
+
+
+def listen(address, authkey):
+    # A Listener on `address`. A Unix socket left behind by a gateway that
+    # died is removed first, and the socket is made private to this user.
+    address = parse_gateway_address(address)
+    if isinstance(address, str) and hasattr(socket, 'AF_UNIX'):
+        os.makedirs(os.path.dirname(os.path.abspath(address)), mode=0o700,
+                    exist_ok=True)
+        if os.path.exists(address):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(address)
+            except OSError:
+                os.unlink(address)
+            else:
+                raise Exception("ibkr_gateway", "address_in_use",
+                                "a gateway is already listening on " +
+                                address)
+            finally:
+                probe.close()
+        listener = Listener(address, 'AF_UNIX', authkey=authkey)
+        os.chmod(address, 0o600)
+        return listener
+    return Listener(address, authkey=authkey)
+
+
+class _gateway_client_connection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, call_id, kind, payload):
+        try:
+            with self.lock:
+                self.conn.send((call_id, kind, payload))
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            with self.lock:
+                self.conn.send((call_id, 'error', Exception(
+                    "ibkr_gateway", "unpicklable", repr(e)
+                )))
+        except OSError:
+            # The web process went away; nobody is waiting for this.
+            pass
+
+
+class ibkr_gateway:
+    def __init__(self, address=default_gateway_address, authkey=None,
+                 max_workers=32, operations=None):
+        self.authkey = authkey or gateway_authkey()
+        self.listener = listen(address, self.authkey)
+        self.address = self.listener.address
+        self.operations = operations or gateway_operations
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='ibkr_gateway'
+        )
+        self.lock = threading.Lock()
+        # key -> [(client, call_id), ...] for every call being answered.
+        self.inflight = {}
+        self.counts = {'calls': 0, 'coalesced': 0, 'failed': 0}
+        self.closed = False
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                # A failed handshake, or the listener was closed.
+                if self.closed:
+                    break
+                continue
+            # Only checked once accept() has returned: shutdown() waits for
+            # its wake-up connection to be accepted.
+            if self.closed:
+                conn.close()
+                break
+            threading.Thread(target=self._serve_client, args=(conn,),
+                             daemon=True).start()
+
+    def _serve_client(self, conn):
+        client = _gateway_client_connection(conn)
+        try:
+            while True:
+                call_id, name, args, kwargs = conn.recv()
+                self._submit(client, call_id, name, args, kwargs)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _submit(self, client, call_id, name, args, kwargs):
+        function = self.operations.get(name)
+        if function is None:
+            client.send(call_id, 'error', Exception(
+                "ibkr_gateway", "unknown_operation", name
+            ))
+            return
+        key = ('call', id(client), call_id)
+        if name not in uncoalesced_operations:
+            try:
+                key = pickle.dumps((name, args, sorted(kwargs.items())))
+            except Exception:
+                pass
+        with self.lock:
+            self.counts['calls'] += 1
+            waiters = self.inflight.get(key)
+            if waiters is not None:
+                self.counts['coalesced'] += 1
+                waiters.append((client, call_id))
+                return
+            self.inflight[key] = [(client, call_id)]
+        self.executor.submit(self._run, key, function, args, kwargs)
+
+    def _send_all(self, key, kind, payload, finished=False):
+        with self.lock:
+            waiters = self.inflight.pop(key, []) if finished \
+                else list(self.inflight.get(key, []))
+        for client, call_id in waiters:
+            client.send(call_id, kind, payload)
+
+    def _run(self, key, function, args, kwargs):
+        if kwargs.get('progress'):
+            kwargs = dict(kwargs, progress=lambda *progress: self._send_all(
+                key, 'progress', progress
+            ))
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                self.counts['failed'] += 1
+            self._send_all(key, 'error', e, finished=True)
+        else:
+            self._send_all(key, 'result', result, finished=True)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['inflight'] = len(self.inflight)
+        return stats
+
+    def shutdown(self):
+        self.closed = True
+        try:
+            # Wake up accept().
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+        self.listener.close()
+        self.executor.shutdown(wait=False)
+
+
+def start_gateway(address=default_gateway_address, authkey=None):
+    # Start a gateway on a background thread; ('127.0.0.1', 0) picks a free
+    # port, read it back from gateway.address.
+    gateway = ibkr_gateway(address, authkey)
+    thread = threading.Thread(target=gateway.serve_forever, daemon=True)
+    thread.start()
+    return gateway
+
+
+class gateway_call:
+    def __init__(self, progress=None):
+        self.progress = progress
+        # ('progress', (done, total)), then ('result', value) or
+        # ('error', exception).
+        self.messages = queue.Queue()
+
+
+class gateway_client:
+    # One connection to the gateway, shared by every thread of a web
+    # process: calls are tagged with an id and answered in any order.
+    def __init__(self, address=default_gateway_address, authkey=None):
+        self.address = parse_gateway_address(address)
+        self.authkey = authkey or gateway_authkey()
+        self.lock = threading.Lock()
+        self.conn = None
+        self.ids = itertools.count(1)
+        self.calls = {}
+
+    def _connection(self):
+        # Call with self.lock held.
+        if self.conn is None:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+            except Exception as e:
+                raise Exception("gateway_client", "disconnected",
+                                "couldn't connect to the gateway: %s" % e)
+            self.conn = conn
+            threading.Thread(target=self._read, args=(conn,),
+                             daemon=True).start()
+        return self.conn
+
+    def _read(self, conn):
+        try:
+            while True:
+                call_id, kind, payload = conn.recv()
+                with self.lock:
+                    call = self.calls.get(call_id)
+                if call is not None:
+                    call.messages.put((kind, payload))
+        except (EOFError, OSError):
+            pass
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+            failed = list(self.calls.values())
+            self.calls.clear()
+        conn.close()
+        for call in failed:
+            call.messages.put(('error', Exception(
+                "gateway_client", "disconnected", "gateway connection lost"
+            )))
+
+    def call(self, name, *args, **kwargs):
+        progress = kwargs.pop('progress', None)
+        if progress is not None:
+            kwargs['progress'] = True
+        call = gateway_call(progress)
+        with self.lock:
+            call_id = next(self.ids)
+            conn = self._connection()
+            self.calls[call_id] = call
+            try:
+                conn.send((call_id, name, args, kwargs))
+            except OSError:
+                self.calls.pop(call_id, None)
+                self.conn = None
+                raise Exception("gateway_client", "disconnected",
+                                "gateway connection lost")
+        try:
+            while True:
+                kind, payload = call.messages.get()
+                if kind == 'progress':
+                    # Raising here (e.g. on cancel) stops waiting; the
+                    # gateway finishes the call for anyone else.
+                    progress(*payload)
+                elif kind == 'result':
+                    return payload
+                else:
+                    raise payload
+        finally:
+            with self.lock:
+                self.calls.pop(call_id, None)
+
+    def close(self):
+        with self.lock:
+            conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+    def __getattr__(self, name):
+        if name in gateway_operations:
+            return partial(self.call, name)
+        raise AttributeError(name)
+
+
+def broker_functions(address=None, authkey=None):
+    # fetch_managed_accounts, fetch_chart_bars, place_order, ... as
+    # attributes: run here without an address, by the gateway at `address`
+    # with one.
+    if not address:
+        return SimpleNamespace(**gateway_operations)
+    return gateway_client(address, authkey)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="IBKR broker gateway")
+    parser.add_argument('--address', default=default_gateway_address,
+                        help="host:port, or a Unix socket path")
+    args = parser.parse_args()
+    gateway = ibkr_gateway(args.address)
+    print("IBKR gateway listening on %s" % (gateway.address,))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        gateway.shutdown()
@@ -0,0 +1,308 @@
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.contract_cache import contract_key
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import threading
+import time
+import numpy as np
+
+# IB rejects historical data requests that break its pacing rules (error 162)
+# and the request then just times out. This scheduler queues historical
+# requests and only sends one when it's allowed:
+#   - no identical request within 15 seconds
+#   - no more than 6 requests for the same contract and whatToShow in 2 s
+#   - no more than 60 requests in any 10 minutes
+#
+# The queue is ordered by priority (higher first), then by arrival. A request
+# that has to wait for its contract doesn't hold up requests for other
+# contracts. Identical requests that are still queued or running share one
+# IB request, and an identical request made within 15 s of the last answer
+# gets that answer instead of waiting out the 15 s.
+#
+#     future = default_scheduler().submit(contract, durationStr='1 D')
+#     bars = future.result()
+
+interactive_priority = 10
+background_priority = 0
+
+
+class pacing_window:
+    # At most `count` requests within any `period_sec` seconds.
+    def __init__(self, count, period_sec):
+        self.count = count
+        self.period_sec = period_sec
+        self.sent = deque()
+
+    def next_free(self, now):
+        while self.sent and now - self.sent[0] >= self.period_sec:
+            self.sent.popleft()
+        if len(self.sent) < self.count:
+            return now
+        return self.sent[0] + self.period_sec
+
+    def record(self, now):
+        self.sent.append(now)
+
+
+class pacing_rules:
+    def __init__(self, identical_sec=15, contract_count=6, contract_sec=2,
+                 total_count=60, total_sec=600, margin_sec=0.5):
+        # A request is counted when it's handed to a worker, which is a bit
+        # before TWS sees it; margin_sec keeps us clear of the limits anyway.
+        self.identical_sec = identical_sec + margin_sec
+        self.contract_count = contract_count
+        self.contract_sec = contract_sec + margin_sec
+        self.total = pacing_window(total_count, total_sec + margin_sec)
+        self.by_contract = {}
+        self.last_sent = {}
+
+    def next_free(self, job, now):
+        # The earliest time `job` may be sent.
+        free_at = self.total.next_free(now)
+        window = self.by_contract.get(job.contract_key)
+        if window is not None:
+            free_at = max(free_at, window.next_free(now))
+        last = self.last_sent.get(job.key)
+        if last is not None:
+            free_at = max(free_at, last + self.identical_sec)
+        return free_at
+
+    def record(self, job, now):
+        self.total.record(now)
+        window = self.by_contract.get(job.contract_key)
+        if window is None:
+            window = pacing_window(self.contract_count, self.contract_sec)
+            self.by_contract[job.contract_key] = window
+        window.record(now)
+        self.last_sent[job.key] = now
+        # Forget what can no longer hold anything up.
+        self.last_sent = {
+            key: sent for key, sent in self.last_sent.items()
+            if now - sent < self.identical_sec
+        }
+        for key in list(self.by_contract):
+            self.by_contract[key].next_free(now)
+            if not self.by_contract[key].sent:
+                del self.by_contract[key]
+
+
+class historical_job:
+    def __init__(self, seq, key, contract_key, priority, kwargs):
+        self.seq = seq
+        self.key = key
+        self.contract_key = contract_key
+        self.priority = priority
+        self.kwargs = kwargs
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+
+
+def request_key(contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, hostname, port, client_id):
+    return (contract_key(contract), contract.conId, endDateTime, durationStr,
+            barSizeSetting, whatToShow, bool(useRTH), str(hostname),
+            int(port), int(client_id))
+
+
+# Enough for a watchlist (gateway.fetch_watchlist) to go out in one wave;
+# the pacing rules above still apply.
+default_max_concurrent = 8
+
+
+class historical_scheduler:
+    def __init__(self, max_concurrent=default_max_concurrent, rules=None,
+                 fetch=fetch_historical_data, stats_window=1000):
+        self.max_concurrent = max_concurrent
+        self.rules = rules or pacing_rules()
+        self.fetch = fetch
+        self.condition = threading.Condition()
+        self.seq = itertools.count()
+        self.queue = []
+        # key -> job, for every job that's queued or running.
+        self.pending = {}
+        # key -> (finished_at, result) for answers younger than identical_sec.
+        self.recent = {}
+        self.running = 0
+        self.closed = False
+        self.executor = ThreadPoolExecutor(
+            max_concurrent, thread_name_prefix='historical_scheduler'
+        )
+        self.dispatcher = None
+        self.wait_times = deque(maxlen=stats_window)
+        self.counts = {'submitted': 0, 'coalesced': 0, 'sent': 0,
+                       'completed': 0, 'failed': 0}
+        self.max_queue_depth = 0
+
+    def submit(self, contract, endDateTime='', durationStr='30 D',
+               barSizeSetting='1 hour', whatToShow='MIDPOINT', useRTH=True,
+               hostname=default_hostname, port=default_port,
+               client_id=default_client_id, priority=background_priority,
+               timeout=None):
+        # Returns a concurrent.futures.Future for the bars DataFrame.
+        key = request_key(contract, endDateTime, durationStr, barSizeSetting,
+                          whatToShow, useRTH, hostname, port, client_id)
+        with self.condition:
+            if self.closed:
+                raise Exception("historical_scheduler", "closed",
+                                "scheduler has been closed")
+            self.counts['submitted'] += 1
+            now = time.monotonic()
+            recent = self.recent.get(key)
+            if recent is not None and \
+                    now - recent[0] < self.rules.identical_sec:
+                self.counts['coalesced'] += 1
+                future = Future()
+                future.set_result(recent[1])
+                return future
+            job = self.pending.get(key)
+            if job is not None:
+                self.counts['coalesced'] += 1
+                job.priority = max(job.priority, priority)
+                self.condition.notify_all()
+                return job.future
+            kwargs = dict(contract=contract, endDateTime=endDateTime,
+                          durationStr=durationStr,
+                          barSizeSetting=barSizeSetting,
+                          whatToShow=whatToShow, useRTH=useRTH,
+                          hostname=hostname, port=port, client_id=client_id)
+            if timeout is not None:
+                kwargs['timeout'] = timeout
+            job = historical_job(
+                next(self.seq), key,
+                (contract_key(contract), contract.conId, whatToShow),
+                priority, kwargs
+            )
+            self.queue.append(job)
+            self.pending[key] = job
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(
+                    target=self._dispatch, name='historical_scheduler',
+                    daemon=True
+                )
+                self.dispatcher.start()
+            self.condition.notify_all()
+            return job.future
+
+    def _next_job(self, now):
+        # The highest-priority job that may be sent now, or else the time at
+        # which the first one becomes free.
+        if self.running >= self.max_concurrent:
+            return None, None
+        wake_at = None
+        self.queue.sort(key=lambda job: (-job.priority, job.seq))
+        for job in self.queue:
+            free_at = self.rules.next_free(job, now)
+            if free_at <= now:
+                return job, None
+            wake_at = free_at if wake_at is None else min(wake_at, free_at)
+        return None, wake_at
+
+    def _dispatch(self):
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                job, wake_at = self._next_job(now)
+                if job is None:
+                    self.condition.wait(
+                        None if wake_at is None else wake_at - now
+                    )
+                    continue
+                self.queue.remove(job)
+                self.rules.record(job, now)
+                self.running += 1
+                self.counts['sent'] += 1
+                self.wait_times.append(now - job.submitted_at)
+                self.executor.submit(self._run, job)
+
+    def _run(self, job):
+        result = exception = None
+        try:
+            result = self.fetch(**job.kwargs)
+        except Exception as e:
+            exception = e
+        with self.condition:
+            self.running -= 1
+            self.pending.pop(job.key, None)
+            now = time.monotonic()
+            self.recent = {
+                key: recent for key, recent in self.recent.items()
+                if now - recent[0] < self.rules.identical_sec
+            }
+            if exception is None:
+                self.counts['completed'] += 1
+                self.recent[job.key] = (now, result)
+            else:
+                self.counts['failed'] += 1
+            self.condition.notify_all()
+        if exception is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(exception)
+
+    def stats(self):
+        with self.condition:
+            waits = np.array(self.wait_times, dtype=float)
+            stats = dict(self.counts)
+            stats.update({
+                'queue_depth': len(self.queue),
+                'max_queue_depth': self.max_queue_depth,
+                'running': self.running,
+                'wait_sec_mean': float(waits.mean()) if len(waits) else 0.0,
+                'wait_sec_p95': float(np.percentile(waits, 95))
+                if len(waits) else 0.0,
+                'wait_sec_max': float(waits.max()) if len(waits) else 0.0
+            })
+        return stats
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            queued = self.queue
+            self.queue = []
+            for job in queued:
+                self.pending.pop(job.key, None)
+            self.condition.notify_all()
+        for job in queued:
+            job.future.set_exception(Exception(
+                "historical_scheduler", "closed", "scheduler has been closed"
+            ))
+        self.executor.shutdown(wait=False)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = historical_scheduler()
+        return _default_scheduler
+
+
+def fetch_historical_data_scheduled(contract, endDateTime='',
+                                    durationStr='30 D',
+                                    barSizeSetting='1 hour',
+                                    whatToShow='MIDPOINT', useRTH=True,
+                                    hostname=default_hostname,
+                                    port=default_port,
+                                    client_id=default_client_id,
+                                    priority=background_priority,
+                                    scheduler=None):
+    # Same arguments and return value as fetch_historical_data, but waits
+    # its turn in the scheduler's queue.
+    if scheduler is None:
+        scheduler = default_scheduler()
+    future = scheduler.submit(
+        contract, endDateTime=endDateTime, durationStr=durationStr,
+        barSizeSetting=barSizeSetting, whatToShow=whatToShow, useRTH=useRTH,
+        hostname=hostname, port=port, client_id=client_id, priority=priority
+    )
+    # Coalesced callers share one frame; give each its own copy.
+    return future.result().copy()
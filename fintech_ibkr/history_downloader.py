@@ -0,0 +1,111 @@
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.historical_scheduler import default_scheduler
+from fintech_ibkr.historical_scheduler import background_priority
+from fintech_ibkr.bar_buffer import empty_bar_frame
+from fintech_ibkr.durations import bar_size_seconds, duration_seconds
+from fintech_ibkr.durations import duration_string, max_request_duration
+from fintech_ibkr.durations import parse_end_date_time, format_end_date_time
+from fintech_ibkr.durations import bar_epochs, to_epoch, from_epoch
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+
+# Downloads windows of history that are too long for one reqHistoricalData.
+#
+# The window is cut into chunks no longer than IB accepts for the bar size
+# (e.g. 1 D of 1 min bars, 1 M of hourly bars), newest first. All chunks go
+# to the historical_scheduler at once, so they run concurrently as far as
+# the pacing rules allow. A chunk that fails is submitted again, up to
+# `retries` times. The pieces are stitched into one frame in time order,
+# with the bars where chunks overlap kept once.
+#
+#     bars = fetch_long_historical_data(contract, durationStr='2 Y',
+#                                       barSizeSetting='1 hour')
+
+chunk_timeout_sec = 60
+
+
+def history_chunks(endDateTime, durationStr, barSizeSetting, now=None):
+    # [(endDateTime, durationStr), ...] covering the window, newest first.
+    bar_seconds = bar_size_seconds[barSizeSetting]
+    chunk_seconds = duration_seconds(max_request_duration[barSizeSetting])
+    end_ts = to_epoch(parse_end_date_time(endDateTime, now))
+    start_ts = end_ts - duration_seconds(durationStr)
+    chunks = []
+    chunk_end = end_ts
+    while chunk_end > start_ts:
+        seconds = min(chunk_seconds, chunk_end - start_ts)
+        if endDateTime == '' and chunk_end == end_ts:
+            # Keep asking for "now" so that the forming bar comes back too.
+            chunk_end_date_time = ''
+        else:
+            chunk_end_date_time = format_end_date_time(from_epoch(chunk_end))
+        chunks.append((chunk_end_date_time,
+                       duration_string(seconds, bar_seconds)))
+        chunk_end -= seconds
+    return chunks
+
+
+def stitch_bars(frames, start_ts=None):
+    # One time-ordered frame from overlapping chunks; a bar that came back in
+    # more than one chunk is kept once.
+    frames = [frame for frame in frames if frame is not None and len(frame)]
+    if not frames:
+        return empty_bar_frame()
+    frame = pd.concat(frames, ignore_index=True)
+    ts = bar_epochs(frame['date'])
+    order = np.argsort(ts, kind='stable')
+    ts = ts[order]
+    keep = np.append(ts[1:] != ts[:-1], True)
+    if start_ts is not None:
+        keep &= ts >= start_ts
+    return frame.iloc[order[keep]].reset_index(drop=True)
+
+
+def fetch_long_historical_data(contract, endDateTime='', durationStr='1 Y',
+                               barSizeSetting='1 hour',
+                               whatToShow='MIDPOINT', useRTH=True,
+                               hostname=default_hostname, port=default_port,
+                               client_id=default_client_id,
+                               priority=background_priority, retries=2,
+                               timeout=chunk_timeout_sec, progress=None,
+                               scheduler=None):
+    # Same arguments and return value as fetch_historical_data, for any
+    # durationStr. progress(chunks_done, chunks_total) is called as chunks
+    # come in; timeout applies to each chunk.
+    if scheduler is None:
+        scheduler = default_scheduler()
+    end = parse_end_date_time(endDateTime)
+    chunks = history_chunks(endDateTime, durationStr, barSizeSetting, end)
+    # Include the bar that was already open when the window starts.
+    start_ts = to_epoch(end) - duration_seconds(durationStr) - \
+        bar_size_seconds[barSizeSetting] + 1
+
+    def submit(chunk):
+        return scheduler.submit(
+            contract, endDateTime=chunk[0], durationStr=chunk[1],
+            barSizeSetting=barSizeSetting, whatToShow=whatToShow,
+            useRTH=useRTH, hostname=hostname, port=port,
+            client_id=client_id, priority=priority, timeout=timeout
+        )
+
+    futures = {submit(chunk): (chunk, 0) for chunk in chunks}
+    frames = []
+    if progress is not None:
+        progress(0, len(chunks))
+    while futures:
+        done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk, attempt = futures.pop(future)
+            try:
+                frames.append(future.result())
+            except Exception:
+                if attempt >= retries:
+                    raise
+                futures[submit(chunk)] = (chunk, attempt + 1)
+                continue
+            if progress is not None:
+                progress(len(frames), len(chunks))
+    return stitch_bars(frames, start_ts)
@@ -1,175 +1,227 @@
 
 import pandas as pd
+from fintech_ibkr.request_router import pending_request, request_router
+from fintech_ibkr.order_tracker import order_tracker
+from fintech_ibkr.error_channel import error_channel, error_exception
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 from datetime import datetime
+import queue
+import threading
+
+# Turns one ContractDetails object into the one-row frame that
+# fetch_contract_details returns.
+def contract_details_frame(contractDetails):
+    return pd.DataFrame({
+        "con_id": [contractDetails.contract.conId],
+        "symbol": [contractDetails.contract.symbol],
+        "long_name": [contractDetails.longName],
+        "industry": [contractDetails.industry],
+        "category": [contractDetails.category],
+        "subcategory": [contractDetails.subcategory],
+        "sec_type": [contractDetails.contract.secType],
+        "stock_type": [contractDetails.stockType],
+        "exchange": [contractDetails.contract.exchange],
+        "primary_exchange": [contractDetails.contract.primaryExchange],
+        "currency": [contractDetails.contract.currency],
+        "local_symbol": [contractDetails.contract.localSymbol],
+        "market_name": [contractDetails.marketName],
+        "min_tick": [contractDetails.minTick],
+        "order_types": [contractDetails.orderTypes],
+        "valid_exchanges": [contractDetails.validExchanges],
+        "price_magnifier": [contractDetails.priceMagnifier],
+        "time_zone_id": [contractDetails.timeZoneId],
+        "trading_hours": [contractDetails.tradingHours],
+        "liquid_hours": [contractDetails.liquidHours]
+    })
+
+def matching_symbols_frame(contractDescriptions):
+    return pd.DataFrame(
+        {
+            "con_id": [d.contract.conId for d in contractDescriptions],
+            "symbol": [d.contract.symbol for d in contractDescriptions],
+            "sec_type": [d.contract.secType for d in contractDescriptions],
+            "primary_exchange": [
+                d.contract.primaryExchange for d in contractDescriptions
+            ],
+            "currency": [d.contract.currency for d in contractDescriptions]
+        },
+        columns=[
+            'con_id', 'symbol', 'sec_type', 'primary_exchange', 'currency'
+        ]
+    )
+
+# EClient.msg_queue, except that every message's size is noted on the
+# router just before EClient.run decodes it (for the ibkr_request_bytes
+# metric).
+class _metered_queue(queue.Queue):
+    def __init__(self, router):
+        queue.Queue.__init__(self)
+        self.router = router
+
+    def get(self, *args, **kwargs):
+        text = queue.Queue.get(self, *args, **kwargs)
+        self.router.message_size = len(text)
+        return text
 
 # This is the main app that we'll be using for sync and async functions.
 class ibkr_app(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.error_messages = pd.DataFrame(columns=[
-            'reqId', 'errorCode', 'errorString'
-        ])
+        # The last few errors by reqId, and counts of everything else.
+        self.errors = error_channel()
         self.next_valid_id = None
+        self.id_lock = threading.Lock()
         self.current_time = None
-        ########################################################################
-        # Here, you'll need to change Line 30 to initialize
-        # self.historical_data as a dataframe having the column names you
-        # want to use. Clearly, you'll want to make sure your colnames match
-        # with what you tell the candlestick figure to expect when you create
-        # it in your app!
-        # I've already done the same general process you need to go through
-        # in the self.error_messages instance variable, so you can use that as
-        # a guide.
-        self.historical_data = pd.DataFrame(
-            columns=['date', 'open', 'high', 'low', 'close', 'volume',
-                     'bar_count', 'average']
-        )
-        self.historical_data_end = None
-        self.contract_details = None
-        self.contract_details_end = None
-        self.matching_symbols = None
-        self.order_status = pd.DataFrame(
-            columns=['orderId', 'status', 'filled', 'remaining', 'avgFillPrice',
-                     'permId', 'parentId', 'lastFillPrice', 'clientId',
-                     'whyHeld', 'mktCapPrice']
-        )
+        # Completion signals, set from the EWrapper callbacks below so that
+        # callers can block on them instead of sleep-polling attributes.
+        self.next_valid_id_event = threading.Event()
+        # Answers are routed to the request that asked for them by reqId (or
+        # orderId), so any number of requests can share this connection.
+        # reqCurrentTime has no reqId; every waiter gets the next answer.
+        self.router = request_router()
+        self.msg_queue = _metered_queue(self.router)
+        self.current_time_waiters = []
+        # keepUpToDate subscriptions (live_bars.live_bar_stream) by reqId.
+        self.bar_streams = {}
+        # Shared reqMktData subscriptions (market_data.market_data_manager)
+        # by reqId.
+        self.market_data = {}
+        # Every order seen on this connection, updated in place.
+        self.orders = order_tracker()
+
+    @property
+    def order_status(self):
+        # One row per order, latest state.
+        return self.orders.frame()
+
+    @property
+    def error_messages(self):
+        return self.errors.frame()
 
     def error(self, reqId, errorCode, errorString):
-        self.error_messages = pd.concat(
-            [self.error_messages, pd.DataFrame({
-                "reqId": [reqId],
-                "errorCode": [errorCode],
-                "errorString": [errorString]
-            })])
+        if self.errors.record(reqId, errorCode, errorString):
+            return
+        # Whoever is waiting on this reqId won't get an answer: fail them
+        # now rather than at their timeout.
+        exception = error_exception(reqId, errorCode, errorString)
+        self.router.finish(reqId, exception=exception)
+        self.orders.fail(reqId, exception)
+        self.fail_stream(reqId, exception)
+
+    def fail_stream(self, reqId, exception):
+        # A subscription IB has ended with an error.
+        self.bar_streams.pop(reqId, None)
+        subscription = self.market_data.pop(reqId, None)
+        if subscription is not None:
+            subscription.fail(exception)
 
     def managedAccounts(self, accountsList):
         self.managed_accounts = [i for i in accountsList.split(",") if i]
 
     def nextValidId(self, orderId: int):
         self.next_valid_id = orderId
+        self.next_valid_id_event.set()
+
+    def next_request_id(self):
+        # Connections are reused across calls, so every request and order
+        # needs its own id. Hand out nextValidId and bump it.
+        with self.id_lock:
+            req_id = self.next_valid_id
+            self.next_valid_id += 1
+        return req_id
+
+    def current_time_request(self):
+        # Register before calling reqCurrentTime.
+        waiter = pending_request(None, 'current_time')
+        with self.router.lock:
+            self.current_time_waiters.append(waiter)
+        return waiter
+
+    def fail_pending(self, exception):
+        self.router.fail_all(exception)
+        self.orders.fail_all(exception)
+        with self.router.lock:
+            waiters = self.current_time_waiters
+            self.current_time_waiters = []
+        for waiter in waiters:
+            waiter.finish(exception=exception)
+        for req_id in list(self.market_data):
+            self.fail_stream(req_id, exception)
+
+    def connectionClosed(self):
+        self.fail_pending(Exception("ibkr_app", "disconnected",
+                                    "connection to IBKR was lost"))
 
     def currentTime(self, time:int):
         self.current_time = datetime.fromtimestamp(time)
+        with self.router.lock:
+            waiters = self.current_time_waiters
+            self.current_time_waiters = []
+        for waiter in waiters:
+            waiter.finish(self.current_time)
 
     def historicalData(self, reqId, bar):
-
-        self.historical_data = pd.concat(
-            [
-                self.historical_data,
-                pd.DataFrame(
-                    {
-                        'date': [bar.date],
-                        'open': [bar.open],
-                        'high': [bar.high],
-                        'low': [bar.low],
-                        'close': [bar.close],
-                    }
-                )
-            ],
-            ignore_index=True
-        )
+        request = self.router.get(reqId)
+        if request is not None:
+            request.bars.append(bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
-        self.historical_data_end = reqId
-
-    def contractDetailsEnd(self, reqId: int):
-        self.contract_details_end = reqId
+        request = self.router.get(reqId)
+        if request is not None:
+            stream = self.bar_streams.get(reqId)
+            if stream is not None:
+                # historicalDataUpdate carries on from these bars.
+                stream.bars = request.bars
+            self.router.finish(reqId, request.bars.to_frame())
+
+    def historicalDataUpdate(self, reqId: int, bar):
+        stream = self.bar_streams.get(reqId)
+        if stream is not None:
+            stream.update(bar)
+
+    def tickPrice(self, reqId, tickType, price:float, attrib):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.tick(tickType, price)
+
+    def tickSize(self, reqId, tickType, size):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.tick(tickType, size)
 
     def contractDetails(self, reqId:int, contractDetails):
-        self.contract_details = pd.DataFrame({
-            "con_id": [contractDetails.contract.conId],
-            "symbol": [contractDetails.contract.symbol],
-            "long_name": [contractDetails.longName],
-            "industry": [contractDetails.industry],
-            "category": [contractDetails.category],
-            "subcategory": [contractDetails.subcategory],
-            "sec_type": [contractDetails.contract.secType],
-            "stock_type": [contractDetails.stockType],
-            "exchange": [contractDetails.contract.exchange],
-            "primary_exchange": [contractDetails.contract.primaryExchange],
-            "currency": [contractDetails.contract.currency],
-            "local_symbol": [contractDetails.contract.localSymbol],
-            "market_name": [contractDetails.marketName],
-            "min_tick": [contractDetails.minTick],
-            "order_types": [contractDetails.orderTypes],
-            "valid_exchanges": [contractDetails.validExchanges],
-            "price_magnifier": [contractDetails.priceMagnifier],
-            "time_zone_id": [contractDetails.timeZoneId],
-            "trading_hours": [contractDetails.tradingHours],
-            "liquid_hours": [contractDetails.liquidHours]
-        })
+        request = self.router.get(reqId)
+        if request is not None:
+            request.rows.append(contract_details_frame(contractDetails))
 
-    def symbolSamples(self, reqId:int, contractDescriptions):
-        df = pd.DataFrame(
-            columns=[
-                'con_id', 'symbol', 'sec_type', 'primary_exchange', 'currency'
-            ]
-        )
-        for contract_description in contractDescriptions:
-            df = pd.concat([
-                df,
-                pd.DataFrame({
-                    "con_id": [contract_description.contract.conId],
-                    "symbol": [contract_description.contract.symbol],
-                    "sec_type": [contract_description.contract.secType],
-                    "primary_exchange": [
-                        contract_description.contract.primaryExchange
-                    ],
-                    "currency": [contract_description.contract.currency]
-                })
-            ],
-                ignore_index=True
+    def contractDetailsEnd(self, reqId: int):
+        request = self.router.get(reqId)
+        if request is not None:
+            self.router.finish(
+                reqId,
+                pd.concat(request.rows, ignore_index=True)
+                if request.rows else None
             )
-        self.matching_symbols = df
+
+    def symbolSamples(self, reqId:int, contractDescriptions):
+        self.router.finish(reqId, matching_symbols_frame(contractDescriptions))
 
     def orderStatus(self, orderId, status:str, filled:float,
                     remaining:float, avgFillPrice:float, permId:int,
                     parentId:int, lastFillPrice:float, clientId:int,
                     whyHeld:str, mktCapPrice: float):
-
-        print('order status')
-        # print('orderId:' + str(orderId))
-        # print('status:' + status)
-        # print('filled:' + str(filled))
-        # print('remaining:' + str(remaining))
-        # print('avgFillPrice:' + str(avgFillPrice))
-        # print('permId:' + str(permId))
-        # print('parentId:' + str(parentId))
-        # print('lastFillPrice:' + str(lastFillPrice))
-        # print('clientId:' + str(clientId))
-        # print('whyHeld:' + str(69))
-        # print('mktCapPrice:' + str(mktCapPrice))
-
-        print(self.order_status)
-        print(type(self.order_status))
-        self.order_status = pd.concat(
-            [
-                self.order_status,
-                pd.DataFrame({
-                    'order_id': [orderId],
-                    'status': [status],
-                    'filled': [filled],
-                    'remaining': [remaining],
-                    'avg_fill_price': [avgFillPrice],
-                    'perm_id': [permId],
-                    'parent_id': [parentId],
-                    'last_fill_price': [lastFillPrice],
-                    'client_id': [clientId],
-                    'why_held': [whyHeld],
-                    'mkt_cap_price': [mktCapPrice]
-                })
-            ],
-            ignore_index=True
+        self.orders.on_order_status(
+            orderId, status, filled, remaining, avgFillPrice, permId,
+            parentId, lastFillPrice, clientId, whyHeld, mktCapPrice
         )
-        self.order_status.drop_duplicates(inplace=True)
+
 
     def openOrder(self, orderId, contract, order, orderState):
-        print('open order')
-        print(contract)
-        print(order)
-        print(orderState)
+        self.orders.on_open_order(orderId, contract, order, orderState)
 
     def openOrderEnd(self):
-        print('open order end')
+        pass
+
+    def execDetails(self, reqId, contract, execution):
+        self.orders.on_exec_details(reqId, contract, execution)
@@ -0,0 +1,358 @@
+import numpy as np
+import pandas as pd
+
+# Technical indicators for the bar frames fetch_historical_data returns.
+#
+# compute_indicators pulls each field out once as a contiguous float64
+# array and computes every indicator with whole-array operations: rolling
+# windows from cumulative sums, and the recursive ones (EMA, and Wilder's
+# smoothing in RSI and ATR) with pandas' compiled ewm kernel, since NumPy
+# has no linear-recurrence primitive. There is no Python loop over bars.
+#
+# incremental_indicators keeps just enough state (running sums over the
+# last few values, the last smoothed values) to take the indicators one bar
+# further in O(1): push() for a new bar, revise() when the last bar changes
+# (a live bar that's still forming). Both give the same numbers as
+# compute_indicators on the whole frame.
+#
+# A windowed indicator is NaN until it has a full window of bars.
+#
+#     values = compute_indicators(bars, ['sma', 'bollinger', 'rsi'])
+#     state = incremental_indicators.from_frame(bars)
+#     state.push(high, low, close, volume, average)    # {'sma': ..., ...}
+
+# name -> the columns it adds.
+indicator_columns = {
+    'sma': ['sma'],
+    'ema': ['ema'],
+    'bollinger': ['bb_upper', 'bb_middle', 'bb_lower'],
+    'vwap': ['vwap'],
+    'rsi': ['rsi'],
+    'atr': ['atr'],
+    'volatility': ['volatility']
+}
+all_indicators = list(indicator_columns)
+# Drawn over the candles; the rest get panels of their own.
+price_indicators = {'sma', 'ema', 'bollinger', 'vwap'}
+
+default_windows = {
+    'sma_window': 20,
+    'ema_window': 20,
+    'bollinger_window': 20,
+    'bollinger_k': 2.0,
+    'rsi_window': 14,
+    'atr_window': 14,
+    'volatility_window': 20
+}
+
+
+def _array(frame, column):
+    return np.ascontiguousarray(frame[column].to_numpy(dtype=np.float64))
+
+
+def _rolling_sum(x, window):
+    # sum(x[i - window + 1:i + 1]) at every i with a full window, NaN before.
+    out = np.full(len(x), np.nan)
+    if len(x) >= window:
+        cumulative = np.cumsum(x)
+        out[window - 1:] = cumulative[window - 1:] - np.concatenate(
+            ([0.0], cumulative[:len(x) - window])
+        )
+    return out
+
+
+def _smooth(x, alpha):
+    # y[0] = x[0], y[i] = y[i - 1] + alpha * (x[i] - y[i - 1])
+    if len(x) == 0:
+        return np.empty(0)
+    return pd.Series(x).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+
+def _masked(x, first):
+    # NaN before index `first`, where the window isn't full yet.
+    x[:max(0, first)] = np.nan
+    return x
+
+
+def _rsi(avg_gain, avg_loss):
+    total = avg_gain + avg_loss
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, 100.0 * avg_gain / total, 50.0)
+
+
+def _vwap(weighted, weights, plain, count):
+    # Volume-weighted average of `average` so far. MIDPOINT bars have
+    # volume -1: then it's a plain mean, as in downsampling.aggregate_bars.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weights > 0, weighted / weights, plain / count)
+
+
+def _compute(frame, names, windows):
+    # (DataFrame of the indicator columns, the arrays that seed
+    # incremental_indicators)
+    w = dict(default_windows, **windows)
+    close = _array(frame, 'close')
+    n = len(close)
+    out = {}
+    seeds = {'close': close}
+
+    if 'sma' in names:
+        out['sma'] = _rolling_sum(close, w['sma_window']) / w['sma_window']
+    if 'ema' in names:
+        seeds['ema'] = _smooth(close, 2.0 / (w['ema_window'] + 1))
+        out['ema'] = _masked(seeds['ema'].copy(), w['ema_window'] - 1)
+    if 'bollinger' in names:
+        window = w['bollinger_window']
+        # Shifted by the first close, so the sum of squares doesn't lose
+        # precision; the variance doesn't change.
+        shifted = close - (close[0] if n else 0.0)
+        mean = _rolling_sum(shifted, window) / window
+        variance = _rolling_sum(shifted * shifted, window) / window - \
+            mean * mean
+        std = np.sqrt(np.maximum(variance, 0.0))
+        middle = mean + (close[0] if n else 0.0)
+        out['bb_upper'] = middle + w['bollinger_k'] * std
+        out['bb_middle'] = middle
+        out['bb_lower'] = middle - w['bollinger_k'] * std
+    if 'rsi' in names:
+        window = w['rsi_window']
+        delta = np.diff(close)
+        avg_gain = _smooth(np.maximum(delta, 0.0), 1.0 / window)
+        avg_loss = _smooth(np.maximum(-delta, 0.0), 1.0 / window)
+        rsi = np.full(n, np.nan)
+        rsi[1:] = _rsi(avg_gain, avg_loss)
+        out['rsi'] = _masked(rsi, window)
+        seeds['avg_gain'], seeds['avg_loss'] = avg_gain, avg_loss
+    if 'atr' in names:
+        high, low = _array(frame, 'high'), _array(frame, 'low')
+        previous = np.concatenate((close[:1], close[:-1]))
+        true_range = np.maximum(high - low, np.maximum(
+            np.abs(high - previous), np.abs(low - previous)))
+        if n:
+            true_range[0] = high[0] - low[0]
+        seeds['atr'] = _smooth(true_range, 1.0 / w['atr_window'])
+        out['atr'] = _masked(seeds['atr'].copy(), w['atr_window'] - 1)
+    if 'vwap' in names:
+        volume, average = _array(frame, 'volume'), _array(frame, 'average')
+        weights = np.where(volume > 0, volume, 0.0)
+        seeds['vwap_weighted'] = np.cumsum(average * weights)
+        seeds['vwap_weights'] = np.cumsum(weights)
+        seeds['vwap_plain'] = np.cumsum(average)
+        out['vwap'] = _vwap(seeds['vwap_weighted'], seeds['vwap_weights'],
+                            seeds['vwap_plain'], np.arange(1, n + 1))
+    if 'volatility' in names:
+        window = w['volatility_window']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.log(close[1:] / close[:-1])
+        sums = _rolling_sum(returns, window)
+        squares = _rolling_sum(returns * returns, window)
+        volatility = np.full(n, np.nan)
+        if window > 1:
+            volatility[1:] = np.sqrt(np.maximum(
+                (squares - sums * sums / window) / (window - 1), 0.0))
+        out['volatility'] = volatility
+
+    columns = [column for name in all_indicators if name in names
+               for column in indicator_columns[name]]
+    return pd.DataFrame(out, columns=columns, index=frame.index), seeds
+
+
+def compute_indicators(frame, names=all_indicators, **windows):
+    # One float64 column per entry of indicator_columns[name] for each of
+    # `names`, aligned with `frame`'s rows. Window sizes default to
+    # default_windows, e.g. compute_indicators(bars, ['sma'], sma_window=50).
+    unknown = set(names) - set(indicator_columns)
+    if unknown:
+        raise ValueError("unknown indicators: %s" % sorted(unknown))
+    return _compute(frame, set(names), windows)[0]
+
+
+class _window:
+    # The last `size` values of a series with their sum and sum of squares.
+    # push() returns what undo() needs to take it back.
+    def __init__(self, size, values=()):
+        self.size = size
+        self.values = np.zeros(size)
+        self.pos = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum2 = 0.0
+        for value in values[-size:]:
+            self.push(float(value))
+
+    def push(self, value):
+        token = (self.pos, self.count, self.sum, self.sum2,
+                 self.values[self.pos])
+        if self.count == self.size:
+            old = self.values[self.pos]
+            self.sum -= old
+            self.sum2 -= old * old
+        else:
+            self.count += 1
+        self.values[self.pos] = value
+        self.sum += value
+        self.sum2 += value * value
+        self.pos = (self.pos + 1) % self.size
+        if self.pos == 0 and self.count == self.size:
+            # Once per lap, so rounding errors in the running sums don't
+            # build up over a long live stream.
+            self.sum = float(self.values.sum())
+            self.sum2 = float(np.dot(self.values, self.values))
+        return token
+
+    def undo(self, token):
+        self.pos, self.count, self.sum, self.sum2, old = token
+        self.values[self.pos] = old
+
+    def full(self):
+        return self.count == self.size
+
+
+class incremental_indicators:
+    def __init__(self, names=all_indicators, **windows):
+        unknown = set(names) - set(indicator_columns)
+        if unknown:
+            raise ValueError("unknown indicators: %s" % sorted(unknown))
+        self.names = set(names)
+        self.windows = dict(default_windows, **windows)
+        w = self.windows
+        self.sma = _window(w['sma_window'])
+        self.bollinger = _window(w['bollinger_window'])
+        self.returns = _window(w['volatility_window'])
+        # Everything else is a handful of scalars, copied whole for undo.
+        self.state = {
+            'n': 0, 'close': None, 'reference': None, 'ema': None,
+            'avg_gain': None, 'avg_loss': None, 'atr': None,
+            'vwap_weighted': 0.0, 'vwap_weights': 0.0, 'vwap_plain': 0.0
+        }
+        self.undo = None
+        self.latest = {}
+
+    @classmethod
+    def from_frame(cls, frame, names=all_indicators, **windows):
+        # State as of the frame's last bar, from one vectorized pass over
+        # all but that bar plus the last window of values. The last bar is
+        # then pushed, so it can be revise()d.
+        self = cls(names, **windows)
+        if len(frame) == 0:
+            return self
+        seeds = _compute(frame.iloc[:-1], self.names, windows)[1]
+        close = seeds['close']
+        if len(close):
+            self.sma = _window(self.windows['sma_window'], close)
+            self.bollinger = _window(self.windows['bollinger_window'],
+                                     close - close[0])
+            tail = close[-self.windows['volatility_window'] - 1:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.returns = _window(self.windows['volatility_window'],
+                                       np.log(tail[1:] / tail[:-1]))
+            self.state.update(n=len(close), close=float(close[-1]),
+                              reference=float(close[0]))
+            for key in ['ema', 'avg_gain', 'avg_loss', 'atr',
+                        'vwap_weighted', 'vwap_weights', 'vwap_plain']:
+                if key in seeds and len(seeds[key]):
+                    self.state[key] = float(seeds[key][-1])
+        last = frame.iloc[-1]
+        self.push(float(last['high']), float(last['low']),
+                  float(last['close']), float(last.get('volume', -1.0)),
+                  float(last['average']) if 'average' in last else None)
+        return self
+
+    def push(self, high, low, close, volume=-1.0, average=None):
+        # Adds a bar; returns {column: value} as of that bar.
+        previous = dict(self.state)
+        tokens = (self.sma.push(close),
+                  self.bollinger.push(close - (
+                      close if previous['reference'] is None
+                      else previous['reference'])),
+                  None if previous['close'] is None
+                  else self.returns.push(np.log(close / previous['close'])))
+        self.undo = (previous, tokens, self.latest)
+        self._advance(high, low, close, volume, average)
+        return self.latest
+
+    def revise(self, high, low, close, volume=-1.0, average=None):
+        # Replaces the last bar (a live bar that's still forming).
+        if self.undo is None:
+            return self.push(high, low, close, volume, average)
+        previous, tokens, latest = self.undo
+        for window, token in zip(
+                [self.sma, self.bollinger, self.returns], tokens):
+            if token is not None:
+                window.undo(token)
+        self.state = previous
+        self.latest = latest
+        return self.push(high, low, close, volume, average)
+
+    def _advance(self, high, low, close, volume, average):
+        w = self.windows
+        s = self.state
+        previous_close = s['close']
+        s['n'] += 1
+        n = s['n']
+        if s['reference'] is None:
+            s['reference'] = close
+        latest = {}
+
+        if 'sma' in self.names:
+            latest['sma'] = self.sma.sum / self.sma.size \
+                if self.sma.full() else np.nan
+        if 'ema' in self.names:
+            alpha = 2.0 / (w['ema_window'] + 1)
+            s['ema'] = close if s['ema'] is None else \
+                s['ema'] + alpha * (close - s['ema'])
+            latest['ema'] = s['ema'] if n >= w['ema_window'] else np.nan
+        if 'bollinger' in self.names:
+            window = self.bollinger
+            if window.full():
+                mean = window.sum / window.size
+                std = np.sqrt(max(window.sum2 / window.size - mean * mean,
+                                  0.0))
+                middle = mean + s['reference']
+                latest['bb_upper'] = middle + w['bollinger_k'] * std
+                latest['bb_middle'] = middle
+                latest['bb_lower'] = middle - w['bollinger_k'] * std
+            else:
+                latest['bb_upper'] = latest['bb_middle'] = \
+                    latest['bb_lower'] = np.nan
+        if 'vwap' in self.names:
+            if average is None:
+                average = close
+            weight = volume if volume > 0 else 0.0
+            s['vwap_weighted'] += average * weight
+            s['vwap_weights'] += weight
+            s['vwap_plain'] += average
+            latest['vwap'] = s['vwap_weighted'] / s['vwap_weights'] \
+                if s['vwap_weights'] > 0 else s['vwap_plain'] / n
+        if 'rsi' in self.names:
+            latest['rsi'] = np.nan
+            if previous_close is not None:
+                alpha = 1.0 / w['rsi_window']
+                gain = max(close - previous_close, 0.0)
+                loss = max(previous_close - close, 0.0)
+                if s['avg_gain'] is None:
+                    s['avg_gain'], s['avg_loss'] = gain, loss
+                else:
+                    s['avg_gain'] += alpha * (gain - s['avg_gain'])
+                    s['avg_loss'] += alpha * (loss - s['avg_loss'])
+                if n > w['rsi_window']:
+                    latest['rsi'] = float(_rsi(s['avg_gain'],
+                                               s['avg_loss']))
+        if 'atr' in self.names:
+            if previous_close is None:
+                true_range = high - low
+            else:
+                true_range = max(high - low, abs(high - previous_close),
+                                 abs(low - previous_close))
+            s['atr'] = true_range if s['atr'] is None else \
+                s['atr'] + (true_range - s['atr']) / w['atr_window']
+            latest['atr'] = s['atr'] if n >= w['atr_window'] else np.nan
+        if 'volatility' in self.names:
+            window = self.returns
+            latest['volatility'] = np.nan
+            if window.full() and window.size > 1:
+                latest['volatility'] = float(np.sqrt(max(
+                    (window.sum2 - window.sum * window.sum / window.size) /
+                    (window.size - 1), 0.0)))
+        s['close'] = close
+        self.latest = latest
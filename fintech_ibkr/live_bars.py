@@ -0,0 +1,219 @@
+from fintech_ibkr.synchronous_functions import _request
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.connection_pool import default_pool
+from fintech_ibkr.bar_buffer import bar_buffer
+from fintech_ibkr.bar_cache import series_key
+from collections import deque
+import itertools
+import threading
+import time
+
+# Live candlesticks. A live_bar_stream sends reqHistoricalData with
+# keepUpToDate=True and keeps the subscription open: after the initial bars,
+# IB sends historicalDataUpdate for the forming bar every few seconds and
+# for each new bar as it starts.
+#
+# Every update gets a sequence number, so a poller (the chart's
+# dcc.Interval) can ask for just the bars that changed since the last
+# sequence number it saw and patch them into the figure.
+#
+# Streams are shared: one subscription per series and connection, found
+# again by id. A stream nobody has polled for idle_timeout_sec is cancelled.
+
+idle_timeout_sec = 60
+max_changes = 1000
+
+_stream_ids = itertools.count(1)
+
+
+class live_bar_stream:
+    def __init__(self, contract, durationStr='1 D', barSizeSetting='1 min',
+                 whatToShow='MIDPOINT', useRTH=True,
+                 hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+        self.id = str(next(_stream_ids))
+        # Set by live_bar_stream_for, which looks streams up by it.
+        self.key = None
+        self.contract = contract
+        self.durationStr = durationStr
+        self.barSizeSetting = barSizeSetting
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.hostname = hostname
+        self.port = port
+        self.client_id = client_id
+        self.lock = threading.Lock()
+        self.bars = bar_buffer()
+        self.seq = 0
+        # (seq, index of the bar that changed), oldest first.
+        self.changes = deque(maxlen=max_changes)
+        self.app = None
+        self.req_id = None
+        self.last_polled = time.monotonic()
+        # Set once start() has returned or raised (start_error).
+        self.started = threading.Event()
+        self.start_error = None
+
+    def start(self, timeout=None):
+        # Blocks until the initial bars are in.
+        with default_pool.checkout(self.hostname, self.port, self.client_id,
+                                   "live_bar_stream") as app:
+            req_id = app.next_request_id()
+            self.app = app
+            self.req_id = req_id
+            app.bar_streams[req_id] = self
+
+            def cancel():
+                app.bar_streams.pop(req_id, None)
+                app.cancelHistoricalData(req_id)
+            try:
+                _request(
+                    app, req_id, 'historical',
+                    lambda: app.reqHistoricalData(
+                        req_id, self.contract, '', self.durationStr,
+                        self.barSizeSetting, self.whatToShow, self.useRTH,
+                        formatDate=1, keepUpToDate=True, chartOptions=[]),
+                    cancel, "live_bar_stream", "historical_data not received",
+                    timeout
+                )
+            except Exception:
+                app.bar_streams.pop(req_id, None)
+                raise
+        return self
+
+    def is_alive(self):
+        # A stream still starting counts as alive.
+        if not self.started.is_set():
+            return True
+        return self.app is not None and self.app.isConnected() and \
+            self.app.bar_streams.get(self.req_id) is self
+
+    def stop(self):
+        app = self.app
+        if app is not None and app.bar_streams.pop(self.req_id, None):
+            if app.isConnected():
+                app.cancelHistoricalData(self.req_id)
+
+    def update(self, bar):
+        # Called from the API thread for every historicalDataUpdate.
+        with self.lock:
+            index = self.bars.update(bar)
+            self.seq += 1
+            self.changes.append((self.seq, index))
+
+    def snapshot(self):
+        # (seq, all bars as a DataFrame)
+        with self.lock:
+            self.last_polled = time.monotonic()
+            return self.seq, self.bars.to_frame()
+
+    def changes_since(self, seq):
+        # (seq, {index: [date, open, high, low, close, volume, bar_count,
+        # average]}) for the bars that changed after `seq`, or None if the
+        # caller is too far behind and should take a new snapshot.
+        with self.lock:
+            self.last_polled = time.monotonic()
+            if seq == self.seq:
+                return seq, {}
+            if seq > self.seq or not self.changes or \
+                    self.changes[0][0] > seq + 1:
+                return None
+            indices = sorted({index for change_seq, index in self.changes
+                              if change_seq > seq})
+            return self.seq, {index: self.bars.row(index)
+                              for index in indices}
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def stop_idle_streams(max_idle_sec=idle_timeout_sec):
+    now = time.monotonic()
+    with _streams_lock:
+        idle = [stream for stream in _streams.values()
+                if now - stream.last_polled > max_idle_sec
+                or not stream.is_alive()]
+        for stream in idle:
+            _streams.pop(stream.id, None)
+    for stream in idle:
+        stream.stop()
+
+
+def get_live_bar_stream(stream_id):
+    # The running stream with this id, or None.
+    stop_idle_streams()
+    with _streams_lock:
+        return _streams.get(stream_id)
+
+
+def live_bar_stream_for(contract, durationStr='1 D', barSizeSetting='1 min',
+                        whatToShow='MIDPOINT', useRTH=True,
+                        hostname=default_hostname, port=default_port,
+                        client_id=default_client_id, timeout=None):
+    # Reuses a running stream for the same series and connection, or
+    # subscribes a new one.
+    stop_idle_streams()
+    key = (series_key(contract, whatToShow, barSizeSetting, useRTH),
+           durationStr, str(hostname), int(port), int(client_id))
+    # A new stream is registered before it subscribes, so that callers
+    # asking for the same series meanwhile wait for it rather than open a
+    # second subscription.
+    with _streams_lock:
+        for stream in _streams.values():
+            if stream.key == key:
+                stream.last_polled = time.monotonic()
+                starting = False
+                break
+        else:
+            stream = live_bar_stream(contract, durationStr, barSizeSetting,
+                                     whatToShow, useRTH, hostname, port,
+                                     client_id)
+            stream.key = key
+            _streams[stream.id] = stream
+            starting = True
+    if starting:
+        try:
+            stream.start(timeout)
+        except Exception as e:
+            stream.start_error = e
+            with _streams_lock:
+                _streams.pop(stream.id, None)
+            raise
+        finally:
+            stream.started.set()
+    elif not stream.started.wait(timeout):
+        raise Exception("live_bar_stream", "timeout",
+                        "historical_data not received")
+    if stream.start_error is not None:
+        raise stream.start_error
+    return stream
+
+
+# The same, as plain data, so that it can be asked for from another process
+# (see gateway.py).
+
+def live_bars_snapshot(contract, durationStr='1 D', barSizeSetting='1 min',
+                       whatToShow='MIDPOINT', useRTH=True,
+                       hostname=default_hostname, port=default_port,
+                       client_id=default_client_id, timeout=None):
+    # (stream_id, seq, all bars as a DataFrame)
+    stream = live_bar_stream_for(contract, durationStr, barSizeSetting,
+                                 whatToShow, useRTH, hostname, port,
+                                 client_id, timeout)
+    seq, bars = stream.snapshot()
+    return stream.id, seq, bars
+
+
+def live_bars_since(stream_id, seq):
+    # ('changes', seq, {index: row}) as in changes_since, ('snapshot', seq,
+    # bars) if the caller is too far behind, or None if the stream is gone.
+    stream = get_live_bar_stream(stream_id)
+    if stream is None:
+        return None
+    changes = stream.changes_since(seq)
+    if changes is None:
+        return ('snapshot',) + stream.snapshot()
+    return ('changes',) + changes
@@ -0,0 +1,294 @@
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.connection_pool import default_pool
+from fintech_ibkr.contract_cache import contract_key
+from ibapi.ticktype import TickTypeEnum
+import itertools
+import threading
+import time
+
+# Live quotes, shared. IB limits how many market data lines a login can have
+# open at once, so a market_data_manager holds exactly one reqMktData
+# subscription per contract and connection however many subscribers it has,
+# and cancels it when the last one leaves.
+#
+# The API thread writes every tickPrice / tickSize into the subscription's
+# latest values: a new dict swapped in whole, so subscribers read it with
+# snapshot() without taking a lock and never see half an update. A
+# subscriber that wants the changes rather than just the latest values asks
+# for a conflated queue, which keeps only the newest value of each field
+# until get() takes them: a slow reader gets fewer, fresher updates rather
+# than a growing backlog.
+#
+#     with default_market_data.subscribe(contract) as quotes:
+#         quotes.snapshot()          # {'BID': 1.0841, 'ASK': 1.0842, ...}
+#
+#     quotes = default_market_data.subscribe(contract, conflate=True)
+#     changes = quotes.get(timeout=1)    # {'BID': 1.0843}, or {}
+#     quotes.close()
+#
+# A Dash session can't keep a subscriber object between callbacks, so
+# quote_subscribe / quote_poll / quote_unsubscribe below work with
+# subscriber ids instead (also through the gateway). Those subscribers are
+# closed once nobody has polled them for idle_timeout_sec.
+
+idle_timeout_sec = 60
+
+_subscriber_ids = itertools.count(1)
+
+
+def tick_field(tickType):
+    # 'BID', 'ASK', 'LAST', 'BID_SIZE', ...; delayed data (DELAYED_BID, ...)
+    # goes into the same fields.
+    field = TickTypeEnum.to_str(tickType)
+    if field.startswith('DELAYED_'):
+        field = field[len('DELAYED_'):]
+    return field
+
+
+class conflated_queue:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.exception = None
+
+    def put(self, field, value):
+        with self.condition:
+            self.pending[field] = value
+            self.condition.notify_all()
+
+    def fail(self, exception):
+        with self.condition:
+            self.exception = exception
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        # {field: newest value} for every field that changed since the last
+        # get; {} if nothing did within `timeout`.
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.pending or self.exception is not None, timeout
+            )
+            if not self.pending and self.exception is not None:
+                raise self.exception
+            pending, self.pending = self.pending, {}
+            return pending
+
+
+class market_data_subscription:
+    def __init__(self, key, contract, genericTickList='',
+                 hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+        self.key = key
+        self.contract = contract
+        self.genericTickList = genericTickList
+        self.hostname = hostname
+        self.port = port
+        self.client_id = client_id
+        # Replaced, never changed in place: see tick().
+        self.latest = {}
+        # The subscribers' conflated queues; a tuple that's replaced rather
+        # than changed, so the API thread can loop over it without a lock.
+        self.queues = ()
+        # Guarded by the manager's lock; counts subscribers still waiting
+        # for start() too, so that nobody cancels it meanwhile.
+        self.subscribers = 0
+        self.exception = None
+        self.app = None
+        self.req_id = None
+        # Set once start() has returned or raised (start_error).
+        self.started = threading.Event()
+        self.start_error = None
+
+    def start(self):
+        with default_pool.checkout(self.hostname, self.port, self.client_id,
+                                   "market_data") as app:
+            req_id = app.next_request_id()
+            self.app = app
+            self.req_id = req_id
+            app.market_data[req_id] = self
+            app.reqMktData(req_id, self.contract, self.genericTickList,
+                           False, False, [])
+        return self
+
+    def is_alive(self):
+        # A subscription still starting counts as alive.
+        if not self.started.is_set():
+            return True
+        return self.exception is None and self.app is not None and \
+            self.app.isConnected() and \
+            self.app.market_data.get(self.req_id) is self
+
+    def stop(self):
+        app = self.app
+        if app is not None and app.market_data.pop(self.req_id, None):
+            if app.isConnected():
+                app.cancelMktData(self.req_id)
+
+    def tick(self, tickType, value):
+        # Called from the API thread, the only writer.
+        field = tick_field(tickType)
+        latest = dict(self.latest)
+        latest[field] = value
+        latest['time'] = time.time()
+        self.latest = latest
+        for queue in self.queues:
+            queue.put(field, value)
+
+    def fail(self, exception):
+        # IB ended the subscription, or the connection went away.
+        self.exception = exception
+        for queue in self.queues:
+            queue.fail(exception)
+
+
+class market_data_subscriber:
+    def __init__(self, manager, subscription, conflate=False,
+                 idle_timeout=None):
+        self.id = str(next(_subscriber_ids))
+        self.manager = manager
+        self.subscription = subscription
+        self.queue = conflated_queue() if conflate else None
+        # None: only close() ends it.
+        self.idle_timeout = idle_timeout
+        self.last_polled = time.monotonic()
+
+    def snapshot(self):
+        # The latest value of every field seen so far, plus 'time'.
+        self.last_polled = time.monotonic()
+        if self.subscription.exception is not None:
+            raise self.subscription.exception
+        return self.subscription.latest
+
+    def get(self, timeout=None):
+        self.last_polled = time.monotonic()
+        if self.queue is None:
+            raise Exception("market_data", "not_conflated",
+                            "subscribe with conflate=True to get updates")
+        return self.queue.get(timeout)
+
+    def close(self):
+        self.manager.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class market_data_manager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # One subscription per key, and every open subscriber by id.
+        self.subscriptions = {}
+        self.subscribers = {}
+
+    def subscribe(self, contract, genericTickList='',
+                  hostname=default_hostname, port=default_port,
+                  client_id=default_client_id, conflate=False,
+                  idle_timeout=None):
+        self.close_idle()
+        key = (str(contract.conId) if contract.conId
+               else contract_key(contract), genericTickList, str(hostname),
+               int(port), int(client_id))
+        # A new subscription is registered before it connects, so two
+        # subscribers can never send two reqMktData for the same contract;
+        # the connecting is done outside the lock, so a slow connect holds
+        # up only the subscribers to this contract.
+        with self.lock:
+            subscription = self.subscriptions.get(key)
+            starting = subscription is None or not subscription.is_alive()
+            if starting:
+                subscription = market_data_subscription(
+                    key, contract, genericTickList, hostname, port,
+                    client_id
+                )
+                self.subscriptions[key] = subscription
+            subscription.subscribers += 1
+        if starting:
+            try:
+                subscription.start()
+            except Exception as e:
+                subscription.start_error = e
+            finally:
+                subscription.started.set()
+        else:
+            subscription.started.wait()
+        with self.lock:
+            if subscription.start_error is not None:
+                subscription.subscribers -= 1
+                if self.subscriptions.get(key) is subscription:
+                    del self.subscriptions[key]
+                raise subscription.start_error
+            subscriber = market_data_subscriber(self, subscription, conflate,
+                                                idle_timeout)
+            if subscriber.queue is not None:
+                subscription.queues += (subscriber.queue,)
+            self.subscribers[subscriber.id] = subscriber
+        return subscriber
+
+    def get(self, subscriber_id):
+        self.close_idle()
+        return self.subscribers.get(subscriber_id)
+
+    def release(self, subscriber):
+        with self.lock:
+            if self.subscribers.pop(subscriber.id, None) is None:
+                return
+            subscription = subscriber.subscription
+            subscription.subscribers -= 1
+            if subscriber.queue is not None:
+                subscription.queues = tuple(
+                    queue for queue in subscription.queues
+                    if queue is not subscriber.queue
+                )
+            if subscription.subscribers > 0:
+                return
+            if self.subscriptions.get(subscription.key) is subscription:
+                del self.subscriptions[subscription.key]
+        subscription.stop()
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [subscriber for subscriber in self.subscribers.values()
+                    if subscriber.idle_timeout is not None
+                    and now - subscriber.last_polled >
+                    subscriber.idle_timeout]
+        for subscriber in idle:
+            self.release(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {'subscriptions': len(self.subscriptions),
+                    'subscribers': len(self.subscribers)}
+
+
+default_market_data = market_data_manager()
+
+
+# The same by subscriber id, as plain data, for Dash callbacks and the
+# gateway.
+
+def quote_subscribe(contract, genericTickList='', hostname=default_hostname,
+                    port=default_port, client_id=default_client_id):
+    return default_market_data.subscribe(
+        contract, genericTickList, hostname, port, client_id,
+        idle_timeout=idle_timeout_sec
+    ).id
+
+
+def quote_poll(subscriber_id):
+    # The latest quote as in snapshot(), or None once the subscriber is gone.
+    subscriber = default_market_data.get(subscriber_id)
+    if subscriber is None:
+        return None
+    return subscriber.snapshot()
+
+
+def quote_unsubscribe(subscriber_id):
+    subscriber = default_market_data.get(subscriber_id)
+    if subscriber is not None:
+        subscriber.close()
@@ -0,0 +1,253 @@
+from functools import wraps
+import bisect
+import threading
+import time
+
+# Per-stage timings for everything that talks to IB, plus the Dash callback
+# durations, kept as Prometheus-style histograms and rendered in the text
+# exposition format by metrics_registry.render() (app.py serves that on
+# /metrics). No prometheus_client needed: a histogram here is a list of
+# bucket counts, a sum and a count per label set.
+
+# Seconds, from a local round trip up to a long historical fetch.
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+bar_buckets = (1, 10, 100, 1000, 10000, 100000, 1000000)
+byte_buckets = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s takes labels %s, got %s" % (
+                self.name, list(self.labels), sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class _value_metric(_metric):
+    def value(self, **labels):
+        return self.series.get(self._key(labels), 0)
+
+    def lines(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        return ['%s%s %s' % (self.name, _label_text(self.labels, key),
+                             _number(value))
+                for key, value in series]
+
+
+class counter(_value_metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class gauge(_value_metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = value
+
+
+class histogram(_metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        _metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # [per-bucket counts (the last one is +Inf), sum, count]
+                series = self.series[key] = [[0] * (len(self.buckets) + 1),
+                                             0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self.series.get(self._key(labels))
+        return 0 if series is None else series[2]
+
+    def lines(self):
+        with self.lock:
+            series = sorted((key, [list(value[0]), value[1], value[2]])
+                            for key, value in self.series.items())
+        lines = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(
+                    self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _label_text(self.labels, key, [('le', _number(bound))]),
+                    cumulative))
+            labels = _label_text(self.labels, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, _number(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class metrics_registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _add(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                # Registering the same metric twice (e.g. a module imported
+                # under two names) hands back the first one.
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        return self._add(histogram(name, help, labels, buckets))
+
+    def render(self, prefix=''):
+        # Every metric whose name starts with `prefix` (or one of a tuple of
+        # prefixes), in the Prometheus text format (version 0.0.4).
+        with self.lock:
+            metrics = [metric for name, metric in self.metrics.items()
+                       if name.startswith(prefix)]
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = metrics_registry()
+
+connect_seconds = default_registry.histogram(
+    'ibkr_connect_seconds',
+    'TCP connect and API version exchange with TWS', ['client_id'])
+handshake_seconds = default_registry.histogram(
+    'ibkr_handshake_seconds',
+    'From startApi to nextValidId', ['client_id'])
+first_message_seconds = default_registry.histogram(
+    'ibkr_first_message_seconds',
+    'From sending a request to its first answer', ['function', 'contract'])
+request_seconds = default_registry.histogram(
+    'ibkr_request_seconds',
+    'From sending a request to its end (or error, or timeout)',
+    ['function', 'contract', 'outcome'])
+request_bars = default_registry.histogram(
+    'ibkr_request_bars', 'Bars received per request',
+    ['function', 'contract'], bar_buckets)
+request_bytes = default_registry.histogram(
+    'ibkr_request_bytes', 'Message bytes received per request',
+    ['function', 'contract'], byte_buckets)
+callback_seconds = default_registry.histogram(
+    'dash_callback_seconds', 'Dash callback run time',
+    ['callback', 'outcome'])
+# Set by server.py: seconds from its start to listening, to app.py being
+# imported, to being warmed up and to the first request.
+startup_seconds = default_registry.gauge(
+    'app_startup_seconds', 'Time from server start to each startup stage',
+    ['stage'])
+
+
+def ibkr_metrics_text():
+    # The ibkr_* metrics of this process. A gateway serves this as an
+    # operation, since with one the IB calls are made (and timed) there.
+    return default_registry.render('ibkr_')
+
+
+def contract_label(contract):
+    # 'EUR.USD' for the FX pairs app.py trades, 'AAPL.USD' for a stock.
+    if contract is None:
+        return ''
+    if contract.currency and contract.currency != contract.symbol:
+        return '%s.%s' % (contract.symbol, contract.currency)
+    return contract.symbol or str(contract.conId)
+
+
+def observe_request(request, function, contract, outcome):
+    # Called once a pending_request has finished, failed or timed out.
+    label = contract_label(contract)
+    end = request.finished_at or time.perf_counter()
+    request_seconds.observe(end - request.sent_at, function=function,
+                            contract=label, outcome=outcome)
+    if request.first_message_at is not None:
+        first_message_seconds.observe(
+            request.first_message_at - request.sent_at,
+            function=function, contract=label)
+    if request.kind == 'historical':
+        request_bars.observe(len(request.bars), function=function,
+                             contract=label)
+    request_bytes.observe(request.bytes_received, function=function,
+                          contract=label)
+
+
+def observe_order(function, contract, sent_at, outcome):
+    # place_order waits on the order_tracker rather than a pending_request,
+    # so only its round trip is recorded.
+    request_seconds.observe(time.perf_counter() - sent_at, function=function,
+                            contract=contract_label(contract),
+                            outcome=outcome)
+
+
+def timed(histogram, **labels):
+    # Decorator: observes how long each call takes, with an outcome label
+    # of 'ok' or the name of the exception it raised (PreventUpdate, ...).
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return function(*args, **kwargs)
+            except BaseException as exception:
+                outcome = type(exception).__name__
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start,
+                                  outcome=outcome, **labels)
+        return wrapper
+    return decorate
@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# An append-only journal of submitted orders, in SQLite (WAL mode).
+#
+# Appending an order is one INSERT, however long the history is, and
+# concurrent appends from several waitress threads are serialized by SQLite
+# rather than overwriting each other as a read-modify-write of a CSV would.
+# timestamp, symbol, order_id and perm_id are indexed, so lookups and time
+# range queries don't scan the table.
+#
+# import_csv loads the old submitted_orders.csv once; the default journal
+# does that by itself when it's first created.
+
+default_journal_path = 'order_journal.sqlite'
+default_csv_path = 'submitted_orders.csv'
+
+order_journal_columns = ['timestamp', 'order_id', 'client_id', 'perm_id',
+                         'con_id', 'symbol', 'action', 'size', 'order_type',
+                         'lmt_price']
+
+# SQL type of each column.
+order_journal_types = {
+    'timestamp': 'TEXT', 'order_id': 'INTEGER', 'client_id': 'INTEGER',
+    'perm_id': 'INTEGER', 'con_id': 'INTEGER', 'symbol': 'TEXT',
+    'action': 'TEXT', 'size': 'REAL', 'order_type': 'TEXT',
+    'lmt_price': 'REAL'
+}
+
+# Comparison operators page() understands. 'contains' and 'startswith' are
+# text matches. All of them are case-sensitive; prefixed with 'i' ('icontains',
+# 'ieq', ...) they ignore case on text columns.
+page_operators = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>',
+                  'ge': '>=', 'contains': None, 'startswith': None}
+
+
+def _timestamp(value):
+    # Stored as 'YYYY-MM-DD HH:MM:SS' so that text order is time order.
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _value(column, value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if column == 'timestamp':
+        return _timestamp(value)
+    if order_journal_types[column] == 'INTEGER':
+        return int(value)
+    if order_journal_types[column] == 'REAL':
+        return float(value)
+    return str(value)
+
+
+class order_journal:
+    def __init__(self, path=default_journal_path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    {}
+                )
+            """.format(', '.join(column + ' ' + order_journal_types[column]
+                                 for column in order_journal_columns)))
+            for column in ['timestamp', 'symbol', 'order_id', 'perm_id']:
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS orders_{0} ON orders "
+                    "({0})".format(column)
+                )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS imports (
+                    path TEXT PRIMARY KEY,
+                    imported_at TEXT NOT NULL,
+                    rows INTEGER NOT NULL
+                )
+            """)
+
+    def connection(self):
+        # One connection per thread, as in bar_cache.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def append(self, order):
+        # order: a dict with (some of) order_journal_columns.
+        self.append_many([order])
+
+    def append_many(self, orders):
+        conn = self.connection()
+        with conn:
+            self._insert(conn, orders)
+
+    def _insert(self, conn, orders):
+        conn.executemany(
+            "INSERT INTO orders ({}) VALUES ({})".format(
+                ', '.join(order_journal_columns),
+                ', '.join('?' * len(order_journal_columns))
+            ),
+            [[_value(column, order.get(column))
+              for column in order_journal_columns] for order in orders]
+        )
+
+    def _where(self, start=None, end=None, symbol=None, order_id=None,
+               perm_id=None):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('timestamp >= ?')
+            params.append(_timestamp(start))
+        if end is not None:
+            clauses.append('timestamp <= ?')
+            params.append(_timestamp(end))
+        for column, value in [('symbol', symbol), ('order_id', order_id),
+                              ('perm_id', perm_id)]:
+            if value is not None:
+                clauses.append(column + ' = ?')
+                params.append(_value(column, value))
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def query(self, start=None, end=None, symbol=None, order_id=None,
+              perm_id=None, limit=None, offset=0):
+        # Orders in journal order, optionally within [start, end] and for
+        # one symbol / order_id / perm_id.
+        where, params = self._where(start, end, symbol, order_id, perm_id)
+        sql = "SELECT {} FROM orders{} ORDER BY id".format(
+            ', '.join(order_journal_columns), where
+        )
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [int(limit), int(offset)]
+        return self._frame(self.connection().execute(sql, params).fetchall())
+
+    def count(self, start=None, end=None, symbol=None, order_id=None,
+              perm_id=None):
+        where, params = self._where(start, end, symbol, order_id, perm_id)
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM orders" + where, params
+        ).fetchone()[0]
+
+    def page(self, offset=0, limit=20, sort_by=None, filters=None):
+        # One page of orders and the number of orders that match.
+        # sort_by: [(column, 'asc' or 'desc'), ...], newest first if empty.
+        # filters: [(column, operator, value), ...] with operator one of
+        # page_operators. Columns are checked against the table's, so these
+        # can come straight from the browser.
+        clauses, params = [], []
+        for column, operator, value in filters or []:
+            ignore_case = operator[:1] == 'i' and \
+                operator[1:] in page_operators
+            if ignore_case:
+                operator = operator[1:]
+            if column not in order_journal_types or \
+                    operator not in page_operators:
+                raise ValueError("can't filter on %s %s" % (column, operator))
+            field, placeholder = column, '?'
+            if ignore_case and order_journal_types[column] == 'TEXT':
+                field, placeholder = 'LOWER(%s)' % column, 'LOWER(?)'
+            if page_operators[operator] is None:
+                # instr rather than LIKE, which ignores case in SQLite.
+                clauses.append('instr({}, {}) {}'.format(
+                    field, placeholder,
+                    '= 1' if operator == 'startswith' else '> 0'))
+                params.append(str(value))
+            else:
+                clauses.append('{} {} {}'.format(
+                    field, page_operators[operator], placeholder))
+                params.append(_value(column, value)
+                              if column != 'timestamp' else str(value))
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        order = []
+        for column, direction in sort_by or []:
+            if column not in order_journal_types or \
+                    direction not in ('asc', 'desc'):
+                raise ValueError("can't sort on %s %s" % (column, direction))
+            order.append(column + ' ' + direction.upper())
+        order.append('id DESC' if not order else 'id')
+        conn = self.connection()
+        total = conn.execute("SELECT COUNT(*) FROM orders" + where,
+                             params).fetchone()[0]
+        rows = conn.execute(
+            "SELECT {} FROM orders{} ORDER BY {} LIMIT ? OFFSET ?".format(
+                ', '.join(order_journal_columns), where, ', '.join(order)
+            ), params + [int(limit), int(offset)]
+        ).fetchall()
+        return self._frame(rows), total
+
+    def _frame(self, rows):
+        return pd.DataFrame(rows, columns=order_journal_columns)
+
+    def import_csv(self, path=default_csv_path):
+        # Loads a submitted_orders.csv once; importing the same path again
+        # does nothing. Returns the number of rows imported.
+        key = os.path.abspath(path)
+        conn = self.connection()
+        if conn.execute("SELECT 1 FROM imports WHERE path = ?",
+                        (key,)).fetchone():
+            return 0
+        orders = pd.read_csv(path).to_dict('records')
+        with conn:
+            # One transaction, so a crash can't import half a file. Claiming
+            # the path comes first: of two processes importing at once (the
+            # web server and the gateway starting together), the second
+            # waits for the first's write lock, then finds the path taken.
+            if conn.execute(
+                "INSERT OR IGNORE INTO imports (path, imported_at, rows) "
+                "VALUES (?, ?, ?)",
+                (key, _timestamp(datetime.now()), len(orders))
+            ).rowcount == 0:
+                return 0
+            self._insert(conn, orders)
+        return len(orders)
+
+
+_default_journal = None
+_default_journal_lock = threading.Lock()
+
+
+def default_order_journal():
+    # Created on first use; picks up submitted_orders.csv the first time.
+    global _default_journal
+    with _default_journal_lock:
+        if _default_journal is None:
+            journal = order_journal()
+            if os.path.exists(default_csv_path):
+                journal.import_csv(default_csv_path)
+            _default_journal = journal
+        return _default_journal
@@ -0,0 +1,186 @@
+from collections import OrderedDict, deque
+import threading
+import time
+import pandas as pd
+
+# Keeps track of where every order on a connection is in its lifecycle.
+#
+# There is one small record per order, keyed by orderId and findable by
+# permId, updated in place from orderStatus, openOrder and execDetails.
+# Every status change is also appended to a bounded history log. Callers can
+# block until an order reaches a state, with a deadline:
+#
+#     record = app.orders.wait_for(order_id, ['Filled'], timeout=30)
+#
+# Waiting for 'Submitted' is also satisfied by 'Filled', since IB may skip
+# straight to it. An order that ends (Cancelled, ApiCancelled, Inactive)
+# without reaching any of the states raises instead of waiting out the
+# deadline, and so does one IB rejected with an error (fail) or whose
+# connection was lost (fail_all).
+
+terminal_states = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+
+order_record_fields = [
+    'order_id', 'perm_id', 'client_id', 'parent_id', 'symbol', 'sec_type',
+    'action', 'order_type', 'total_quantity', 'lmt_price', 'status',
+    'filled', 'remaining', 'avg_fill_price', 'last_fill_price', 'why_held',
+    'mkt_cap_price', 'executions', 'last_exec_id', 'updated_at'
+]
+
+order_history_fields = ['time', 'order_id', 'perm_id', 'status', 'filled',
+                        'remaining', 'avg_fill_price']
+
+
+class order_record:
+    __slots__ = order_record_fields
+
+    def __init__(self, order_id):
+        for field in order_record_fields:
+            setattr(self, field, None)
+        self.order_id = order_id
+        self.executions = 0
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in order_record_fields}
+
+
+def _reached(status, states):
+    return status in states or (status == 'Filled' and 'Submitted' in states)
+
+
+class order_tracker:
+    def __init__(self, max_orders=10000, max_history=10000):
+        self.condition = threading.Condition()
+        self.max_orders = max_orders
+        self.records = OrderedDict()
+        self.by_perm_id = {}
+        self.history = deque(maxlen=max_history)
+        # order_id -> the IB error that ended it.
+        self.errors = {}
+        # Set once the connection is gone.
+        self.exception = None
+
+    def _record(self, order_id):
+        # Call with the condition held.
+        record = self.records.get(order_id)
+        if record is None:
+            record = order_record(order_id)
+            self.records[order_id] = record
+            while len(self.records) > self.max_orders:
+                _, old = self.records.popitem(last=False)
+                self.by_perm_id.pop(old.perm_id, None)
+                self.errors.pop(old.order_id, None)
+        record.updated_at = time.time()
+        return record
+
+    def _set_perm_id(self, record, perm_id):
+        if perm_id:
+            record.perm_id = perm_id
+            self.by_perm_id[perm_id] = record
+
+    def expect(self, order_id):
+        # Called before placeOrder, so that an error IB sends before any
+        # orderStatus is known to be about an order.
+        with self.condition:
+            self._record(order_id)
+
+    def fail(self, order_id, exception):
+        # An error for order_id; False if it isn't an order.
+        with self.condition:
+            if order_id not in self.records:
+                return False
+            self.errors[order_id] = exception
+            self.condition.notify_all()
+            return True
+
+    def fail_all(self, exception):
+        with self.condition:
+            self.exception = exception
+            self.condition.notify_all()
+
+    def on_order_status(self, orderId, status, filled, remaining,
+                        avgFillPrice, permId, parentId, lastFillPrice,
+                        clientId, whyHeld, mktCapPrice):
+        with self.condition:
+            record = self._record(orderId)
+            self._set_perm_id(record, permId)
+            record.status = status
+            record.filled = filled
+            record.remaining = remaining
+            record.avg_fill_price = avgFillPrice
+            record.parent_id = parentId
+            record.last_fill_price = lastFillPrice
+            record.client_id = clientId
+            record.why_held = whyHeld
+            record.mkt_cap_price = mktCapPrice
+            self.history.append((record.updated_at, orderId, permId, status,
+                                 filled, remaining, avgFillPrice))
+            self.condition.notify_all()
+        return record
+
+    def on_open_order(self, orderId, contract, order, orderState):
+        with self.condition:
+            record = self._record(orderId)
+            self._set_perm_id(record, order.permId)
+            record.client_id = order.clientId
+            record.symbol = contract.symbol
+            record.sec_type = contract.secType
+            record.action = order.action
+            record.order_type = order.orderType
+            record.total_quantity = order.totalQuantity
+            record.lmt_price = order.lmtPrice
+            if record.status is None:
+                record.status = orderState.status
+            self.condition.notify_all()
+
+    def on_exec_details(self, reqId, contract, execution):
+        with self.condition:
+            record = self._record(execution.orderId)
+            self._set_perm_id(record, execution.permId)
+            record.executions += 1
+            record.last_exec_id = execution.execId
+            record.last_fill_price = execution.price
+            self.condition.notify_all()
+
+    def get(self, order_id=None, perm_id=None):
+        # The order's record as a dict, or None.
+        with self.condition:
+            record = self.records.get(order_id) if perm_id is None \
+                else self.by_perm_id.get(perm_id)
+            return None if record is None else record.to_dict()
+
+    def wait_for(self, order_id, states=('Submitted',), timeout=None,
+                 caller="wait_for"):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                record = self.records.get(order_id)
+                status = None if record is None else record.status
+                if _reached(status, states):
+                    return record.to_dict()
+                if order_id in self.errors:
+                    raise self.errors[order_id]
+                if self.exception is not None:
+                    raise self.exception
+                if status in terminal_states:
+                    raise Exception(caller, "order_status",
+                                    "order %s is %s" % (order_id, status))
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception(caller, "timeout",
+                                    "order %s is %s, not %s" % (
+                                        order_id, status, '/'.join(states)))
+                self.condition.wait(remaining)
+
+    def frame(self):
+        # One row per order.
+        with self.condition:
+            rows = [record.to_dict() for record in self.records.values()]
+        return pd.DataFrame(rows, columns=order_record_fields)
+
+    def history_frame(self, order_id=None):
+        with self.condition:
+            rows = [row for row in self.history
+                    if order_id is None or row[1] == order_id]
+        return pd.DataFrame(rows, columns=order_history_fields)
@@ -0,0 +1,103 @@
+from fintech_ibkr.bar_buffer import bar_buffer
+import threading
+import time
+
+# Lets many requests share one ibkr_app connection. Every request gets its
+# own reqId (from ibkr_app.next_request_id) and its own pending_request here;
+# the EWrapper callbacks look the reqId up and write into that request's
+# buffer, so concurrent requests never see each other's data.
+
+
+class pending_request:
+    def __init__(self, req_id, kind):
+        self.req_id = req_id
+        self.kind = kind
+        # Per-request result buffers: bars for historical data, rows for
+        # everything that arrives as several callbacks (contract details,
+        # order status updates).
+        self.bars = bar_buffer()
+        self.rows = []
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        # perf_counter timestamps for metrics.observe_request. sent_at is
+        # reset by _request right before the request goes out.
+        self.sent_at = time.perf_counter()
+        self.first_message_at = None
+        self.finished_at = None
+        self.bytes_received = 0
+
+    def finish(self, result=None, exception=None):
+        with self.lock:
+            if self.done.is_set():
+                return
+            self.finished_at = time.perf_counter()
+            self.result = result
+            self.exception = exception
+            self.done.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class request_router:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        # Size of the message being decoded, set by the app's msg_queue; the
+        # first request it's routed to is charged for it.
+        self.message_size = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def register(self, req_id, kind):
+        # Register before sending the request, so that an answer that comes
+        # back quickly always finds its buffer.
+        request = pending_request(req_id, kind)
+        with self.lock:
+            self.requests[req_id] = request
+        return request
+
+    def _received(self, request):
+        # Only ever called from the thread that decodes messages.
+        if request.first_message_at is None:
+            request.first_message_at = time.perf_counter()
+        request.bytes_received += self.message_size
+        self.message_size = 0
+
+    def get(self, req_id):
+        request = self.requests.get(req_id)
+        if request is not None:
+            self._received(request)
+        return request
+
+    def discard(self, req_id):
+        with self.lock:
+            return self.requests.pop(req_id, None)
+
+    def finish(self, req_id, result=None, exception=None):
+        request = self.discard(req_id)
+        if request is not None:
+            self._received(request)
+            request.finish(result, exception)
+        return request
+
+    def fail_all(self, exception):
+        with self.lock:
+            requests = list(self.requests.values())
+            self.requests.clear()
+        for request in requests:
+            request.finish(exception=exception)
@@ -0,0 +1,195 @@
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+from fintech_ibkr.synchronous_functions import default_hostname
+from fintech_ibkr.synchronous_functions import default_port
+from fintech_ibkr.synchronous_functions import default_client_id
+from fintech_ibkr.bar_cache import default_bar_cache, series_key
+from fintech_ibkr.bar_cache import fetch_historical_data_cached
+from fintech_ibkr.downsampling import aggregate_bars
+from fintech_ibkr.bar_buffer import empty_bar_frame
+from fintech_ibkr.durations import bar_size_seconds, duration_seconds
+from fintech_ibkr.durations import parse_end_date_time, bar_epochs
+from fintech_ibkr.durations import to_epoch
+from datetime import datetime, timedelta
+from functools import partial
+import numpy as np
+import pandas as pd
+
+# Builds coarse bars out of finer ones, so that switching the chart from
+# 5 mins to 1 hour doesn't have to ask IB for bars we already hold.
+#
+# Intraday bars are cut on the clock (an hourly bar covers 14:00-15:00), but
+# never across the start of a trading session: with sessions opening at
+# 09:30, the first hourly bar of the day is 09:30-10:00. Daily bars are one
+# per session, labelled with the day the session ends on (FX sessions open
+# at 17:15 the evening before); weekly and monthly bars group those days.
+# Without trading hours, days are calendar days.
+#
+# Sessions come from the tradingHours / liquidHours strings in the contract
+# details. IB only lists the next few days, so the pattern for each weekday
+# is carried back over the whole history. Session times are in the
+# exchange's time zone (time_zone_id); bar dates are in TWS's, so the two
+# should match for sessions to line up.
+
+intraday_limit_sec = 86400
+
+
+def parse_trading_hours(trading_hours):
+    # [(start, end), ...] datetimes from e.g.
+    # '20220329:1715-20220330:1700;20220402:CLOSED' or the older
+    # '20220329:0930-1600,1700-1800;20220402:CLOSED'.
+    sessions = []
+    for day in filter(None, (trading_hours or '').split(';')):
+        date, _, hours = day.partition(':')
+        if not hours or hours == 'CLOSED':
+            continue
+        for span in hours.split(','):
+            start, _, end = span.partition('-')
+            start = _session_time(date, start)
+            end = _session_time(date, end)
+            if end <= start:
+                end += timedelta(days=1)
+            sessions.append((start, end))
+    return sorted(sessions)
+
+
+def _session_time(date, value):
+    if ':' in value:
+        date, value = value.split(':')
+    return datetime.strptime(date + value, '%Y%m%d%H%M')
+
+
+def session_bounds(sessions, first_ts, last_ts):
+    # (starts, ends) as int64 epochs for every session between two bar
+    # times, repeating each weekday's listed session back in time.
+    if not sessions:
+        return None
+    template = {}
+    for start, end in sessions:
+        template.setdefault(start.weekday(), (start - datetime(
+            start.year, start.month, start.day), end - start))
+    day = datetime(1970, 1, 1) + timedelta(seconds=int(first_ts) // 86400 *
+                                           86400 - 2 * 86400)
+    last = datetime(1970, 1, 1) + timedelta(seconds=int(last_ts))
+    starts, ends = [], []
+    while day <= last:
+        if day.weekday() in template:
+            offset, length = template[day.weekday()]
+            starts.append(to_epoch(day + offset))
+            ends.append(to_epoch(day + offset + length))
+        day += timedelta(days=1)
+    return np.array(starts, dtype='int64'), np.array(ends, dtype='int64')
+
+
+def can_resample(source_bar_size, target_bar_size):
+    source = bar_size_seconds[source_bar_size]
+    target = bar_size_seconds[target_bar_size]
+    if source >= target:
+        return False
+    if target < intraday_limit_sec:
+        return target % source == 0
+    return source <= intraday_limit_sec
+
+
+def resample_bars(frame, barSizeSetting, trading_hours=None):
+    # frame: bars of a finer size, in time order. Returns bars of
+    # barSizeSetting with the same columns.
+    if len(frame) == 0:
+        return empty_bar_frame()
+    target = bar_size_seconds[barSizeSetting]
+    ts = bar_epochs(frame['date'])
+    bounds = session_bounds(parse_trading_hours(trading_hours),
+                            ts[0], ts[-1])
+    session = session_end = None
+    if bounds is not None:
+        starts, ends = bounds
+        index = np.searchsorted(starts, ts, side='right') - 1
+        # Bars before the first known session keep their own times.
+        session = np.where(index >= 0, starts[np.maximum(index, 0)], ts)
+        session_end = np.where(index >= 0, ends[np.maximum(index, 0)],
+                               ts + 1)
+
+    if target < intraday_limit_sec:
+        key = ts // target * target
+        if session is not None:
+            key = np.maximum(key, session)
+        group_starts = _group_starts(key)
+        dates = pd.to_datetime(key[group_starts], unit='s') \
+            .strftime('%Y%m%d  %H:%M:%S')
+        return aggregate_bars(frame, group_starts, np.asarray(dates))
+
+    # A session belongs to the day it ends on; end times are exclusive.
+    day = (ts + 1 if session_end is None else session_end) - 1
+    day = day // 86400
+    if target == intraday_limit_sec:
+        key = day
+    elif barSizeSetting == '1 week':
+        # Epoch day 0 was a Thursday; count weeks from Monday.
+        key = (day + 3) // 7
+    else:
+        months = pd.to_datetime(day * 86400, unit='s')
+        key = np.asarray(months.year * 12 + months.month - 1)
+    group_starts = _group_starts(key)
+    dates = pd.to_datetime(day[group_starts] * 86400, unit='s') \
+        .strftime('%Y%m%d')
+    return aggregate_bars(frame, group_starts, np.asarray(dates))
+
+
+def _group_starts(key):
+    return np.flatnonzero(np.append(True, key[1:] != key[:-1]))
+
+
+def fetch_historical_data_resampled(contract, endDateTime='',
+                                    durationStr='30 D',
+                                    barSizeSetting='1 hour',
+                                    whatToShow='MIDPOINT', useRTH=True,
+                                    hostname=default_hostname,
+                                    port=default_port,
+                                    client_id=default_client_id,
+                                    trading_hours=None, cache=None,
+                                    fetch=fetch_historical_data):
+    # Same arguments and return value as fetch_historical_data_cached. If
+    # the bar cache has gaps in the window at barSizeSetting itself but
+    # fully covers it at a finer bar size, the bars are built from those;
+    # otherwise this is fetch_historical_data_cached.
+    if cache is None:
+        cache = default_bar_cache()
+    target = bar_size_seconds[barSizeSetting]
+    end_ts = to_epoch(parse_end_date_time(endDateTime))
+    fetch_cached = partial(
+        fetch_historical_data_cached, contract, endDateTime=endDateTime,
+        durationStr=durationStr, barSizeSetting=barSizeSetting,
+        whatToShow=whatToShow, useRTH=useRTH, hostname=hostname, port=port,
+        client_id=client_id, cache=cache, fetch=fetch
+    )
+    # Already cached as asked for: loaded as it is.
+    if not cache.missing(
+            series_key(contract, whatToShow, barSizeSetting, useRTH),
+            end_ts - duration_seconds(durationStr), end_ts):
+        return fetch_cached()
+    window_start = end_ts - duration_seconds(durationStr)
+    # Bars are loaded from the start of the coarse bar that was open when
+    # the window starts, but coverage is only needed from window_start, as
+    # fetching the window at the finer size would leave it.
+    start_ts = window_start - target + 1
+
+    finer = sorted(
+        [size for size in bar_size_seconds
+         if can_resample(size, barSizeSetting)],
+        key=lambda size: bar_size_seconds[size], reverse=True
+    )
+    # The coarsest covering size means the fewest bars to aggregate.
+    for source in finer:
+        series = series_key(contract, whatToShow, source, useRTH)
+        gaps = cache.missing(series, window_start, end_ts)
+        # Coverage of a window that ends now stops at the start of the last
+        # (still forming) bar, so up to one source bar missing at the end
+        # is fine.
+        if gaps and not (len(gaps) == 1 and gaps[0][1] == end_ts and
+                         end_ts - gaps[0][0] <= bar_size_seconds[source]):
+            continue
+        bars = resample_bars(cache.load(series, start_ts, end_ts),
+                             barSizeSetting, trading_hours)
+        keep = bar_epochs(bars['date']) >= start_ts
+        return bars[keep].reset_index(drop=True)
+
+    return fetch_cached()
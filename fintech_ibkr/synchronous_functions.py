@@ -1,8 +1,6 @@
-
-from fintech_ibkr.ibkr_app import ibkr_app
-import threading
+from fintech_ibkr.connection_pool import default_pool
+from fintech_ibkr.metrics import observe_request, observe_order
 import time
-from datetime import datetime
 
 # If you want different default values, configure it here.
 default_hostname = '127.0.0.1'
@@ -10,247 +8,129 @@ default_port = 7497
 default_client_id = 10645 # can set and use your Master Client ID
 timeout_sec = 5
 
+# All of the functions below run on warm connections from default_pool, one
+# per (hostname, port, client_id). The first call for a given key connects;
+# later calls reuse the same socket and API thread.
+# Every call registers its own reqId with the app's request_router, so calls
+# from several threads can be in flight on the same connection at once. The
+# caller blocks on that request's completion event and gives up after
+# timeout_sec.
+# Each request's stage timings, bars and bytes go to fintech_ibkr.metrics,
+# labeled with the caller and the contract.
+
+def _request(app, req_id, kind, send, cancel, caller, message, timeout=None,
+             contract=None):
+    request = app.router.register(req_id, kind)
+    outcome = 'error'
+    try:
+        request.sent_at = time.perf_counter()
+        send()
+        if not request.wait(timeout_sec if timeout is None else timeout):
+            outcome = 'timeout'
+            if cancel is not None:
+                cancel()
+            raise Exception(caller, "timeout", message)
+        outcome = 'ok' if request.exception is None else 'error'
+    finally:
+        app.router.discard(req_id)
+        observe_request(request, caller, contract, outcome)
+    if request.exception is not None:
+        raise request.exception
+    return request.result
+
 def fetch_managed_accounts(hostname=default_hostname, port=default_port,
                            client_id=default_client_id):
-
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_managed_accounts",
-                "timeout",
-                "couldn't connect to IBKR"
-            )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-    app.disconnect()
-    return app.managed_accounts
+    with default_pool.checkout(hostname, port, client_id,
+                               "fetch_managed_accounts") as app:
+        return app.managed_accounts
 
 def fetch_current_time(hostname=default_hostname,
                        port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_current_time",
-                "timeout",
-                "couldn't connect to IBKR"
-            )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_current_time",
-                "timeout",
-                "next_valid_id not received"
-            )
-
-    app.reqCurrentTime()
-    start_time = datetime.now()
-    while app.current_time is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_current_time",
-                "timeout",
-                "current_time not received"
-            )
-    app.disconnect()
-    return app.current_time
+    with default_pool.checkout(hostname, port, client_id,
+                               "fetch_current_time") as app:
+        waiter = app.current_time_request()
+        app.reqCurrentTime()
+        if not waiter.wait(timeout_sec):
+            raise Exception("fetch_current_time", "timeout",
+                            "current_time not received")
+        if waiter.exception is not None:
+            raise waiter.exception
+        return waiter.result
 
 
 def fetch_historical_data(contract, endDateTime='', durationStr='30 D',
                           barSizeSetting='1 hour', whatToShow='MIDPOINT',
                           useRTH=True, hostname=default_hostname,
-                          port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-    if (datetime.now() - start_time).seconds > timeout_sec:
-        app.disconnect()
-        raise Exception(
-            "fetch_historical_data",
-            "timeout",
-            "couldn't connect to IBKR"
+                          port=default_port, client_id=default_client_id,
+                          timeout=None):
+    # timeout defaults to timeout_sec; long windows of small bars can take
+    # IB a good deal longer than that.
+    with default_pool.checkout(hostname, port, client_id,
+                               "fetch_historical_data") as app:
+        tickerId = app.next_request_id()
+        return _request(
+            app, tickerId, 'historical',
+            lambda: app.reqHistoricalData(
+                tickerId, contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, formatDate=1, keepUpToDate=False,
+                chartOptions=[]),
+            lambda: app.cancelHistoricalData(tickerId),
+            "fetch_historical_data", "historical_data not received", timeout,
+            contract
         )
 
-    def run_loop():
-        app.run()
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_historical_data",
-                "timeout",
-                "next_valid_id not received"
-            )
-    tickerId = app.next_valid_id
-    app.reqHistoricalData(
-        tickerId, contract, endDateTime, durationStr, barSizeSetting,
-        whatToShow, useRTH, formatDate=1, keepUpToDate=False, chartOptions=[])
-    start_time = datetime.now()
-    while app.historical_data_end != tickerId:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_historical_data",
-                "timeout",
-                "historical_data not received"
-            )
-    app.disconnect()
-    return app.historical_data
-
 def fetch_contract_details(contract, hostname=default_hostname,
                            port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "couldn't connect to IBKR"
-            )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "next_valid_id not received"
-            )
-
-    tickerId = app.next_valid_id
-    app.reqContractDetails(tickerId, contract)
-
-    start_time = datetime.now()
-    while app.contract_details_end != tickerId:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "contract_details not received"
-            )
-
-    app.disconnect()
-
-    return app.contract_details
+    with default_pool.checkout(hostname, port, client_id,
+                               "fetch_contract_details") as app:
+        tickerId = app.next_request_id()
+        return _request(
+            app, tickerId, 'contract',
+            lambda: app.reqContractDetails(tickerId, contract), None,
+            "fetch_contract_details", "contract_details not received",
+            contract=contract
+        )
 
 def fetch_matching_symbols(pattern, hostname=default_hostname,
                            port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "couldn't connect to IBKR"
-            )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "next_valid_id not received"
-            )
-
-    req_id = app.next_valid_id
-    app.reqMatchingSymbols(req_id, pattern)
-
-    start_time = datetime.now()
-    while app.matching_symbols is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "contract_details not received"
-            )
-
-    app.disconnect()
-
-    return app.matching_symbols
+    with default_pool.checkout(hostname, port, client_id,
+                               "fetch_matching_symbols") as app:
+        req_id = app.next_request_id()
+        return _request(
+            app, req_id, 'symbols',
+            lambda: app.reqMatchingSymbols(req_id, pattern), None,
+            "fetch_matching_symbols", "matching_symbols not received"
+        )
 
 def place_order(contract, order, hostname=default_hostname,
                            port=default_port, client_id=default_client_id):
-
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(0.01)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-
-    app.placeOrder(app.next_valid_id, contract, order)
-    while not ('Submitted' in set(app.order_status['status'])):
-        time.sleep(0.25)
-
-    app.disconnect()
-
-    return app.order_status
-
+    with default_pool.checkout(hostname, port, client_id,
+                               "place_order") as app:
+        # Returns the order's order_tracker record once it's Submitted.
+        order_id = app.next_request_id()
+        app.orders.expect(order_id)
+        outcome = 'error'
+        sent_at = time.perf_counter()
+        try:
+            app.placeOrder(order_id, contract, order)
+            record = app.orders.wait_for(order_id, ('Submitted', 'Filled'),
+                                         timeout_sec, "place_order")
+            outcome = 'ok'
+            return record
+        except Exception as e:
+            if e.args[:2] == ("place_order", "timeout"):
+                outcome = 'timeout'
+            raise
+        finally:
+            observe_order("place_order", contract, sent_at, outcome)
+
+def wait_for_order(order_id, states=('Filled',), timeout=timeout_sec,
+                   hostname=default_hostname, port=default_port,
+                   client_id=default_client_id):
+    # Blocks until an order placed on this connection reaches one of
+    # `states` and returns its order_tracker record; raises if it's
+    # cancelled or the deadline passes first.
+    with default_pool.checkout(hostname, port, client_id,
+                               "wait_for_order") as app:
+        return app.orders.wait_for(int(order_id), states, timeout,
+                                   "wait_for_order")
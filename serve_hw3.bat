@@ -1,4 +1,4 @@
 cd C:\Users\wl239\PycharmProjects\homework_3-1
 git pull https://%TESTAPP_GIT_PAT%@github.com/wl239/homework_3-1.git
 venv\Scripts\python.exe -m pip install -r requirements.txt
-venv\Scripts\python.exe server.py
\ No newline at end of file
+venv\Scripts\python.exe server.py --fast-start
\ No newline at end of file
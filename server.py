@@ -1,5 +1,98 @@
 # Serve app on a local port via waitress
-from waitress import serve
-import app
+# Usage: python server.py [port] [--fast-start]; run several on different
+#   ports behind nginx, with IBKR_GATEWAY set so that they share one broker
+#   gateway.
+#
+# --fast-start is for restarts (the /hooks2 webhook restarts the service on
+#   every push): the port is opened straight away and app.py is imported and
+#   warmed up on a thread. Requests that come in meanwhile are held until
+#   it's ready (about a second), or for at most ready_timeout_sec before a
+#   503 with Retry-After, instead of nginx answering 502.
+#   app.py itself can't be imported lazily: Dash needs the whole layout
+#   (dash, dash_daq) and every callback (fintech_ibkr, so pandas, numpy and
+#   ibapi) registered before it can answer the page's first requests. So
+#   fast-start moves that cost after the port opens rather than removing it.
+#
+# Either way, the time to listening, to app.py imported, to warmed up and to
+#   the first request is printed and kept in app_startup_seconds on /metrics.
+import time
+started = time.perf_counter()
 
-serve(app.server, host='localhost', port=3001)
+import argparse
+import sys
+import threading
+import traceback
+from waitress import create_server
+
+# How long a request waits for app.py before getting a 503: well over the
+# usual startup time, but short enough that nobody sits on a hung page.
+ready_timeout_sec = 10
+
+
+class startup_app:
+    # A WSGI app that hands requests on to app.server once app.py has been
+    # imported and warmed up.
+    def __init__(self):
+        self.ready = threading.Event()
+        self.wsgi = None
+        self.error = None
+        self.stages = {}
+        self.first_request_lock = threading.Lock()
+
+    def record(self, stage):
+        seconds = time.perf_counter() - started
+        print("startup: %s after %.2fs" % (stage, seconds), flush=True)
+        self.stages[stage] = seconds
+        if self.wsgi is not None:
+            from fintech_ibkr.metrics import startup_seconds
+            for name, value in self.stages.items():
+                startup_seconds.set(value, stage=name)
+
+    def load(self):
+        try:
+            import app
+            self.record('imported')
+            app.warm_up()
+            self.wsgi = app.server
+            self.record('ready')
+        except BaseException:
+            self.error = traceback.format_exc()
+            print(self.error, file=sys.stderr, flush=True)
+        finally:
+            self.ready.set()
+
+    def __call__(self, environ, start_response):
+        if not self.ready.wait(ready_timeout_sec):
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', '5')])
+            return [b'starting up\n']
+        if self.wsgi is None:
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')])
+            return [b'app failed to start\n']
+        if 'first_request' not in self.stages:
+            with self.first_request_lock:
+                if 'first_request' not in self.stages:
+                    self.record('first_request')
+        return self.wsgi(environ, start_response)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="serve app.py via waitress")
+    parser.add_argument('port', nargs='?', type=int, default=3001)
+    parser.add_argument('--fast-start', action='store_true',
+                        help="listen before app.py is imported")
+    args = parser.parse_args()
+
+    wsgi = startup_app()
+    if not args.fast_start:
+        wsgi.load()
+        if wsgi.error is not None:
+            sys.exit(1)
+    server = create_server(wsgi, host='localhost', port=args.port)
+    server.print_listen("Serving on http://{}:{}")
+    wsgi.record('listening')
+    if args.fast_start:
+        threading.Thread(target=wsgi.load, daemon=True).start()
+    server.run()
@@ -0,0 +1,33 @@
+from ibapi.contract import Contract
+from fintech_ibkr.async_functions import ibkr_async_client
+from fintech_ibkr.fake_tws import start_fake_tws, fake_tws_config
+import asyncio
+import pytest
+
+
+def eur_usd():
+    contract = Contract()
+    contract.symbol = 'EUR'
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = 'USD'
+    return contract
+
+
+def test_stream_market_data_ends_when_tws_goes_away():
+    server = start_fake_tws(config=fake_tws_config(tick_interval_sec=0.05))
+
+    async def stream():
+        client = ibkr_async_client(port=server.port, client_id=1)
+        ticks = 0
+        try:
+            async for tick in client.stream_market_data(eur_usd()):
+                ticks += 1
+                if ticks == 1:
+                    server.stop()
+        finally:
+            client.disconnect()
+
+    with pytest.raises(Exception) as raised:
+        asyncio.run(asyncio.wait_for(stream(), 10))
+    assert raised.value.args[:2] == ("ibkr_app", "disconnected")
@@ -0,0 +1,42 @@
+from fintech_ibkr.order_journal import order_journal
+from app import parse_filter_query
+import pytest
+
+
+def journal_with_orders(tmp_path):
+    journal = order_journal(str(tmp_path / 'orders.sqlite'))
+    for order_id, symbol, action, size, order_type, day in [
+            (1, 'AAPL', 'BUY', 10.0, 'MKT', '2022-03-29 10:00:00'),
+            (2, 'aapl', 'SELL', 3.0, 'LMT', '2022-03-30 11:00:00'),
+            (3, 'TSLA', 'BUY', 50.0, 'MKT', '2022-03-30 12:00:00')]:
+        journal.append({'timestamp': day, 'order_id': order_id,
+                        'symbol': symbol, 'action': action, 'size': size,
+                        'order_type': order_type})
+    return journal
+
+
+# Written the way the DataTable sends them with its default filter_options
+# (case 'sensitive'), or after toggling a column to insensitive.
+@pytest.mark.parametrize('filter_query, order_ids', [
+    ('{symbol} scontains AAPL', [1]),
+    ('{symbol} icontains AAPL', [1, 2]),
+    ('{symbol} s= aapl', [2]),
+    ('{symbol} i= aapl', [1, 2]),
+    ('{size} s> 5', [1, 3]),
+    ('{size} s<= 10', [1, 2]),
+    ('{action} s!= BUY', [2]),
+    ('{order_type} seq "LMT"', [2]),
+    ('{timestamp} datestartswith 2022-03-30', [2, 3]),
+    ('{symbol} icontains aapl && {size} s> 5', [1]),
+])
+def test_orders_table_filters(tmp_path, filter_query, order_ids):
+    journal = journal_with_orders(tmp_path)
+    orders, total = journal.page(sort_by=[('order_id', 'asc')],
+                                 filters=parse_filter_query(filter_query))
+    assert orders['order_id'].tolist() == order_ids
+    assert total == len(order_ids)
+
+
+def test_parse_filter_query():
+    assert parse_filter_query('{symbol} scontains AAPL && {size} i> 5') == [
+        ('symbol', 'contains', 'AAPL'), ('size', 'igt', '5')]
@@ -0,0 +1,53 @@
+from datetime import timedelta
+from ibapi.contract import Contract
+from fintech_ibkr.bar_cache import bar_cache, fetch_historical_data_cached
+from fintech_ibkr.bar_buffer import historical_data_columns
+from fintech_ibkr.durations import bar_size_seconds, duration_seconds
+from fintech_ibkr.durations import parse_end_date_time
+from fintech_ibkr.resampling import fetch_historical_data_resampled
+import pandas as pd
+import pytest
+
+
+def eur_usd():
+    contract = Contract()
+    contract.symbol = 'EUR'
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = 'USD'
+    return contract
+
+
+def fake_fetch(requests):
+    # Answers like reqHistoricalData: every bar that starts in the window,
+    # and records what was asked for.
+    def fetch(contract, endDateTime='', durationStr='30 D',
+              barSizeSetting='1 hour', **kwargs):
+        requests.append((endDateTime, durationStr, barSizeSetting))
+        step = bar_size_seconds[barSizeSetting]
+        end = parse_end_date_time(endDateTime)
+        start = end - timedelta(seconds=duration_seconds(durationStr))
+        start -= timedelta(seconds=start.timestamp() % step)
+        dates = pd.date_range(start, end, freq='%ds' % step, inclusive='left')
+        return pd.DataFrame({
+            'date': dates.strftime('%Y%m%d  %H:%M:%S'),
+            'open': 1.0, 'high': 1.1, 'low': 0.9, 'close': 1.0,
+            'volume': 0.0, 'bar_count': 1, 'average': 1.0
+        }, columns=historical_data_columns)
+    return fetch
+
+
+@pytest.mark.parametrize('endDateTime', ['20220330 15:00:00', ''])
+def test_resamples_cached_finer_bars_without_asking_ib(tmp_path, endDateTime):
+    cache = bar_cache(str(tmp_path / 'bars.sqlite'))
+    requests = []
+    fetch_historical_data_cached(eur_usd(), endDateTime, '1 D', '5 mins',
+                                 cache=cache, fetch=fake_fetch(requests))
+    assert len(requests) == 1
+
+    requests.clear()
+    bars = fetch_historical_data_resampled(eur_usd(), endDateTime, '1 D',
+                                           '1 hour', cache=cache,
+                                           fetch=fake_fetch(requests))
+    assert requests == []
+    assert 24 <= len(bars) <= 25